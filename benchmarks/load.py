@@ -0,0 +1,477 @@
+'''
+Load generator
+
+Boots the app under gunicorn, as in the Procfile, against a seeded
+database and a local JWKS stand-in, then replays a mix of the actors and
+movies endpoints from a growing number of concurrent clients. Every
+gunicorn worker and thread combination is swept the same way. Reports the
+throughput, the p50/p95/p99 latency and the error rate of each endpoint
+at each concurrency, and the saturation point of each combination.
+
+    python -m benchmarks.load --servers 1x1 2x1 4x1 2x4 \
+        --concurrency 1 2 4 8 16 32 --duration 10 -o load.json
+'''
+import argparse
+import http.client
+import itertools
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks.suite import PERMISSIONS
+
+
+# Default weights of the operations replayed, see OPERATIONS
+DEFAULT_MIX = (
+    'get_actors=25,get_movies=25,get_actor=10,get_movie=10,'
+    'post_actor=6,post_movie=6,patch_actor=6,patch_movie=6,'
+    'delete_actor=3,delete_movie=3'
+)
+
+# A step whose throughput grows by less than this over the step before
+# adds latency without adding capacity
+SATURATION_GAIN = 0.1
+
+# Highest error rate of a step that still counts as serving the load
+MAX_ERROR_RATE = 0.01
+
+# Seconds to wait for gunicorn to answer after starting it
+BOOT_TIMEOUT = 30
+
+
+## Load client state
+'''
+Client
+One simulated client: its own keep-alive connection, random stream and
+counter for unique names. Ids created by POST requests are shared by all
+clients in created, the DELETE operations remove them.
+'''
+class Client:
+    names = itertools.count()
+
+    def __init__(self, host, port, token, created, seed):
+        self.connection = http.client.HTTPConnection(host, port, timeout=30)
+        self.headers = {
+            'Authorization': 'Bearer ' + token,
+            'Content-Type': 'application/json'
+        }
+        self.created = created
+        self.rng = random.Random(seed)
+
+    def unique(self, prefix):
+        return '{} {} {}'.format(prefix, os.getpid(), next(self.names))
+
+    # Send one request, returns the status and the decoded JSON body
+    def send(self, method, path, body=None):
+        data = json.dumps(body) if body is not None else None
+        try:
+            self.connection.request(method, path, data, self.headers)
+            response = self.connection.getresponse()
+            payload = response.read()
+        except (OSError, http.client.HTTPException):
+            # reconnect on the next request
+            self.connection.close()
+            return None, None
+        try:
+            return response.status, json.loads(payload)
+        except ValueError:
+            return response.status, None
+
+    def close(self):
+        self.connection.close()
+
+
+# Operations of the mix: a function of the client and the seeded row count
+# returning the method, path and body, and the table whose created ids the
+# operation consumes (DELETE) or fills (POST)
+def get_list(table):
+    return lambda client, rows: ('GET', '/{}?limit=20'.format(table), None)
+
+
+def get_one(table):
+    return lambda client, rows: (
+        'GET', '/{}/{}'.format(table, client.rng.randint(1, rows)), None
+    )
+
+
+def actor(client):
+    return {
+        'name': client.unique('Load Actor'),
+        'age': client.rng.randint(18, 80),
+        'gender': client.rng.choice(('Female', 'Male'))
+    }
+
+
+def movie(client):
+    return {
+        'title': client.unique('Load Movie'),
+        'release_date': client.rng.randint(1950, 2025)
+    }
+
+
+OPERATIONS = {
+    'get_actors': (get_list('actors'), None),
+    'get_movies': (get_list('movies'), None),
+    'get_actor': (get_one('actors'), None),
+    'get_movie': (get_one('movies'), None),
+    'post_actor': (lambda client, rows: (
+        'POST', '/actors', actor(client)), 'actors'),
+    'post_movie': (lambda client, rows: (
+        'POST', '/movies', movie(client)), 'movies'),
+    'patch_actor': (lambda client, rows: (
+        'PATCH', '/actors/{}'.format(client.rng.randint(1, rows)),
+        actor(client)), None),
+    'patch_movie': (lambda client, rows: (
+        'PATCH', '/movies/{}'.format(client.rng.randint(1, rows)),
+        movie(client)), None),
+    'delete_actor': (lambda client, rows: (
+        'DELETE', '/actors/{}'.format(client.created['actors'].pop()), None
+    ), 'actors'),
+    'delete_movie': (lambda client, rows: (
+        'DELETE', '/movies/{}'.format(client.created['movies'].pop()), None
+    ), 'movies'),
+}
+
+
+# Parse a mix like get_actors=30,post_actor=5 into operation weights
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(
+                'unknown operation {}, one of {}'.format(
+                    name, ', '.join(OPERATIONS))
+            )
+        try:
+            mix[name] = float(weight or 1)
+        except ValueError:
+            raise argparse.ArgumentTypeError('bad weight for ' + name)
+    return mix
+
+
+# Parse a gunicorn combination like 2x4 into (workers, threads)
+def parse_server(text):
+    workers, _, threads = text.partition('x')
+    try:
+        return int(workers), int(threads or 1)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'expected WORKERSxTHREADS, e.g. 2x4, got ' + text)
+
+
+# Nearest-rank percentile of sorted values
+def percentile(values, fraction):
+    if not values:
+        return None
+    index = max(0, math.ceil(fraction * len(values)) - 1)
+    return values[index]
+
+
+# Replay the mix from concurrency clients for duration seconds, returns the
+# latencies and errors of each operation
+def run_step(host, port, token, rows, mix, concurrency, duration, seed):
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    created = {'actors': [], 'movies': []}
+    samples = {name: {'latencies': [], 'errors': 0} for name in names}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def work(number):
+        client = Client(
+            host, port, token, created, '{}:{}'.format(seed, number)
+        )
+        latencies = {name: [] for name in names}
+        errors = dict.fromkeys(names, 0)
+        while time.monotonic() < deadline:
+            name = client.rng.choices(names, weights)[0]
+            make_request, table = OPERATIONS[name]
+            # a DELETE needs a row created earlier in the step
+            if name.startswith('delete_'):
+                with lock:
+                    if not created[table]:
+                        continue
+                    method, path, body = make_request(client, rows)
+            else:
+                method, path, body = make_request(client, rows)
+            start = time.perf_counter()
+            status, data = client.send(method, path, body)
+            latencies[name].append(time.perf_counter() - start)
+            if status is None or status >= 400:
+                errors[name] += 1
+            elif method == 'POST':
+                with lock:
+                    created[table].append(data[table][0]['id'])
+        client.close()
+        with lock:
+            for name in names:
+                samples[name]['latencies'] += latencies[name]
+                samples[name]['errors'] += errors[name]
+
+    threads = [
+        threading.Thread(target=work, args=(number,), daemon=True)
+        for number in range(concurrency)
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, time.perf_counter() - started
+
+
+# Throughput, latency percentiles in ms and error rate of samples
+def summarize(latencies, errors, seconds):
+    latencies = sorted(latencies)
+    count = len(latencies)
+
+    def ms(value):
+        return round(value * 1000, 2) if value is not None else None
+
+    return {
+        'requests': count,
+        'requests_per_second': round(count / seconds, 1),
+        'p50_ms': ms(percentile(latencies, 0.50)),
+        'p95_ms': ms(percentile(latencies, 0.95)),
+        'p99_ms': ms(percentile(latencies, 0.99)),
+        'error_rate': round(errors / count, 4) if count else 0,
+    }
+
+
+def summarize_step(samples, seconds):
+    endpoints = {
+        name: summarize(sample['latencies'], sample['errors'], seconds)
+        for name, sample in samples.items()
+    }
+    total = summarize(
+        [value for sample in samples.values()
+         for value in sample['latencies']],
+        sum(sample['errors'] for sample in samples.values()),
+        seconds
+    )
+    return dict(total, endpoints=endpoints)
+
+
+# Saturation point of a sweep: the concurrency past which throughput grows
+# by less than SATURATION_GAIN, or the last one before the error rate goes
+# above MAX_ERROR_RATE. None if the first step already failed too often.
+def saturation(steps):
+    best = None
+    for step in steps:
+        if step['error_rate'] > MAX_ERROR_RATE:
+            break
+        if best is not None and step['requests_per_second'] < \
+                best['requests_per_second'] * (1 + SATURATION_GAIN):
+            break
+        best = step
+    if best is None:
+        return None
+    return {
+        'concurrency': best['concurrency'],
+        'requests_per_second': best['requests_per_second'],
+        'p99_ms': best['p99_ms'],
+    }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+# Start gunicorn on the app as in the Procfile, returns the process once
+# it answers requests
+def start_server(environment, port, workers, threads):
+    process = subprocess.Popen([
+        sys.executable, '-m', 'gunicorn', 'casting:create_app()',
+        '--bind', '127.0.0.1:{}'.format(port),
+        '--workers', str(workers), '--threads', str(threads),
+        '--log-level', 'warning',
+    ], env=environment)
+    deadline = time.monotonic() + BOOT_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit('gunicorn exited with {}'.format(
+                process.returncode))
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port,
+                                                    timeout=1)
+            connection.request('GET', '/actors')
+            connection.getresponse().read()
+            connection.close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise SystemExit('gunicorn did not start in {}s'.format(BOOT_TIMEOUT))
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+# Create the tables and add rows actors and rows movies
+def seed_database(database_url, rows):
+    os.environ['POSTGRES_URL'] = database_url
+    from casting import create_app
+    from casting.models import Actors, Movies, db_drop_and_create_all
+    from casting.seed import seed_table
+
+    app = create_app()
+    with app.app_context():
+        db_drop_and_create_all()
+        seed_table(Actors, rows - 1)
+        seed_table(Movies, rows - 1)
+
+
+ROW = '{:>6} {:>5} {:>14} {:>10} {:>9} {:>9} {:>9} {:>8}'
+
+
+# Print the totals of a step then each endpoint
+def print_step(label, concurrency, step):
+    rows = [('all', step)] + sorted(step['endpoints'].items())
+    for name, result in rows:
+        print(ROW.format(
+            label, concurrency, name, result['requests_per_second'],
+            result['p50_ms'], result['p95_ms'], result['p99_ms'],
+            '{:.2%}'.format(result['error_rate'])
+        ), file=sys.stderr)
+
+
+# Run the sweep, returns the results document
+def run(servers, levels, mix, duration, rows, database_url=None, seed=0):
+    from casting.testing import LocalJWKS
+
+    directory = tempfile.TemporaryDirectory()
+    database_url = database_url or 'sqlite:///' + os.path.join(
+        directory.name, 'load.sqlite')
+    jwks = LocalJWKS().start()
+    token = jwks.token(
+        PERMISSIONS, issuer='https://casting.load/', audience='casting',
+        expires_in=24 * 3600
+    )
+    environment = dict(
+        os.environ,
+        POSTGRES_URL=database_url,
+        AUTH0_DOMAIN_NAME='casting.load',
+        AUTH0_CLIENT_ID='casting',
+        AUTH0_JWKS_URL=jwks.url,
+    )
+    environment.pop('POSTGRES_REPLICA_URL', None)
+
+    print(ROW.format(
+        'server', 'conc', 'endpoint', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms',
+        'errors'
+    ), file=sys.stderr)
+    results = []
+    try:
+        for workers, threads in servers:
+            label = '{}x{}'.format(workers, threads)
+            # every combination starts from the same data
+            seed_database(database_url, rows)
+            port = free_port()
+            process = start_server(environment, port, workers, threads)
+            steps = []
+            try:
+                for concurrency in levels:
+                    samples, seconds = run_step(
+                        '127.0.0.1', port, token, rows, mix, concurrency,
+                        duration, seed
+                    )
+                    step = dict(summarize_step(samples, seconds),
+                                concurrency=concurrency)
+                    steps.append(step)
+                    print_step(label, concurrency, step)
+            finally:
+                stop_server(process)
+            results.append({
+                'server': label,
+                'workers': workers,
+                'threads': threads,
+                'steps': steps,
+                'saturation': saturation(steps),
+            })
+    finally:
+        jwks.stop()
+        directory.cleanup()
+
+    return {
+        'meta': {
+            'database': database_url.split(':', 1)[0],
+            'rows': rows,
+            'duration': duration,
+            'mix': mix,
+        },
+        'servers': results,
+        'recommendation': recommend(results),
+    }
+
+
+# The combination with the highest throughput at its saturation point
+def recommend(results):
+    saturated = [result for result in results if result['saturation']]
+    if not saturated:
+        return None
+    best = max(saturated,
+               key=lambda result: result['saturation']['requests_per_second'])
+    return dict(best['saturation'], server=best['server'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--servers', type=parse_server, nargs='+',
+                        default=[(1, 1), (2, 1), (4, 1), (2, 4)],
+                        help='gunicorn WORKERSxTHREADS combinations.')
+    parser.add_argument('--concurrency', type=int, nargs='+',
+                        default=[1, 2, 4, 8, 16, 32],
+                        help='Concurrent clients of each step.')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='Seconds of each step.')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help='Operation weights, default ' + DEFAULT_MIX)
+    parser.add_argument('--rows', type=int, default=10000,
+                        help='Actors and movies seeded before each sweep.')
+    parser.add_argument('--database-url',
+                        help='Database to load, a temporary SQLite file by '
+                             'default. It is dropped and seeded.')
+    parser.add_argument('--output', '-o',
+                        help='JSON file to write the results to.')
+    args = parser.parse_args(argv)
+
+    document = run(args.servers, args.concurrency, args.mix, args.duration,
+                   args.rows, args.database_url)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(document, file, indent=2)
+
+    for result in document['servers']:
+        point = result['saturation']
+        if point is None:
+            print('{}: error rate above {:.0%} at every concurrency'.format(
+                result['server'], MAX_ERROR_RATE))
+        else:
+            print('{server}: saturates at {concurrency} clients, '
+                  '{requests_per_second} req/s, p99 {p99_ms} ms'.format(
+                      server=result['server'], **point))
+    best = document['recommendation']
+    if best is not None:
+        print('Recommended: {server} up to {concurrency} concurrent clients '
+              '({requests_per_second} req/s)'.format(**best))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+'''
+Read path benchmark
+
+Compares the original list endpoint read path, ORM instances + read() +
+jsonify, with the column row path used by the list endpoints, on an
+in-memory SQLite database. Reports rows per second and the bytes allocated
+(tracemalloc peak) per request.
+
+    python -m benchmarks.read_path --rows 1000 10000 --repeat 5
+'''
+import argparse
+import os
+import statistics
+import time
+import tracemalloc
+
+from flask import jsonify
+
+
+def legacy_read(model, key):
+    rows = model.query.all()
+    return jsonify({
+        'success': True,
+        key: [row.read() for row in rows]
+    }).get_data()
+
+
+def fast_read(model, key):
+    from casting import db
+    from casting.fastjson import json_response
+    from casting.routes import read_query
+
+    rows = db.session.execute(read_query(model)).all()
+    return json_response({
+        'success': True,
+        key: [row._asdict() for row in rows]
+    }).get_data()
+
+
+# Seed an in-memory database with count actors
+def make_app(count):
+    os.environ['POSTGRES_URL'] = 'sqlite://'
+    from casting import create_app, db
+    from casting.models import Actors, bulk_insert, db_drop_and_create_all
+
+    app = create_app()
+    with app.app_context():
+        db_drop_and_create_all()
+        bulk_insert(Actors, [
+            {'name': 'Actor {}'.format(i), 'age': 20 + i % 60,
+             'gender': 'Female' if i % 2 else 'Male'}
+            for i in range(count - 1)
+        ])
+    return app
+
+
+# Time one read path, each run in a fresh session like a request
+def measure(app, read, count, repeat):
+    from casting import db
+    from casting.models import Actors
+
+    timings = []
+    allocated = []
+    for _ in range(repeat):
+        with app.app_context():
+            start = time.perf_counter()
+            read(Actors, 'actors')
+            timings.append(time.perf_counter() - start)
+            db.session.remove()
+
+        with app.app_context():
+            tracemalloc.start()
+            read(Actors, 'actors')
+            allocated.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+            db.session.remove()
+
+    seconds = statistics.median(timings)
+    return {
+        'rows_per_second': round(count / seconds),
+        'ms_per_request': round(seconds * 1000, 2),
+        'peak_bytes_per_request': int(statistics.median(allocated))
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    from casting.fastjson import backend
+
+    print('JSON backend: {}'.format(backend))
+    print('{:>8} {:>8} {:>14} {:>10} {:>16}'.format(
+        'rows', 'path', 'rows/s', 'ms/req', 'peak bytes/req'
+    ))
+    for count in args.rows:
+        app = make_app(count)
+        for name, read in (('legacy', legacy_read), ('fast', fast_read)):
+            result = measure(app, read, count, args.repeat)
+            print('{:>8} {:>8} {:>14} {:>10} {:>16}'.format(
+                count, name, result['rows_per_second'],
+                result['ms_per_request'], result['peak_bytes_per_request']
+            ))
+
+
+if __name__ == '__main__':
+    main()
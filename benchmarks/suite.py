@@ -0,0 +1,408 @@
+'''
+Microbenchmark suite
+
+Times the auth layer (get_token_auth_header, verify_decode_jwt,
+check_permissions), the ORM read path (Actors.query.all() and read()) and
+every route of the blueprint through the Flask test client, at several
+table sizes, on an in-memory SQLite database. Tokens are signed with a
+locally generated RSA key served by an in-process JWKS stand-in, so the
+suite runs offline.
+
+The results go to a JSON file. Given a baseline file from another commit,
+the run fails when a benchmark got slower than the threshold allows.
+
+    python -m benchmarks.suite --rows 100 1000 10000 -o after.json \
+        --baseline before.json --threshold 0.25
+'''
+import argparse
+import datetime
+import itertools
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+
+# Every permission of the API, the benchmark token has them all
+PERMISSIONS = (
+    'get:actors', 'post:actors', 'patch:actors', 'delete:actors',
+    'get:movies', 'post:movies', 'patch:movies', 'delete:movies',
+    'get:stats',
+)
+
+# Minimum duration of one timed sample, fast calls are repeated in a loop
+# until a sample lasts this long
+MIN_SAMPLE_SECONDS = 0.002
+
+
+# Records with distinct names for the write routes
+def bulk_actors(prefix, i, count=10):
+    return [
+        {'name': '{} {}.{}'.format(prefix, i, j), 'age': 20 + (i + j) % 60,
+         'gender': 'Female' if j % 2 else 'Male'}
+        for j in range(count)
+    ]
+
+
+def bulk_movies(prefix, i, count=10):
+    return [
+        {'title': '{} {}.{}'.format(prefix, i, j), 'release_date': 1950 + j}
+        for j in range(count)
+    ]
+
+
+# Requests of each route of the blueprint, by endpoint: the table whose
+# fresh rows the request consumes (None if it needs none) and a function of
+# the iteration and those row ids returning the method, path and JSON body
+ROUTES = {
+    'get_actors': (None, lambda i, ids: (
+        'GET', '/actors?limit=100', None)),
+    'get_actor': (None, lambda i, ids: (
+        'GET', '/actors/1', None)),
+    'get_actor_movies': (None, lambda i, ids: (
+        'GET', '/actors/1/movies', None)),
+    'export_actors': (None, lambda i, ids: (
+        'GET', '/actors/export', None)),
+    'post_actor': (None, lambda i, ids: (
+        'POST', '/actors', bulk_actors('Posted', i, 1)[0])),
+    'post_actors_bulk': (None, lambda i, ids: (
+        'POST', '/actors/bulk', bulk_actors('Bulk', i))),
+    # the same roster with other ages, every actor after the first run is
+    # an update
+    'put_actors': (None, lambda i, ids: (
+        'PUT', '/actors', [
+            dict(actor, age=20 + i % 60) for actor in bulk_actors('Roster', 0)
+        ])),
+    'update_actor': (None, lambda i, ids: (
+        'PATCH', '/actors/1',
+        {'name': 'Patched Actor {}'.format(i), 'age': 84, 'gender': 'Male'})),
+    'delete_actor': ('actors', lambda i, ids: (
+        'DELETE', '/actors/{}'.format(ids[i]), None)),
+    'delete_actors': ('actors', lambda i, ids: (
+        'DELETE', '/actors?ids={}'.format(ids[i]), None)),
+    'get_movies': (None, lambda i, ids: (
+        'GET', '/movies?limit=100', None)),
+    'get_movie': (None, lambda i, ids: (
+        'GET', '/movies/1', None)),
+    'get_movie_cast': (None, lambda i, ids: (
+        'GET', '/movies/1/cast', None)),
+    'export_movies': (None, lambda i, ids: (
+        'GET', '/movies/export', None)),
+    'post_movie': (None, lambda i, ids: (
+        'POST', '/movies', bulk_movies('Posted', i, 1)[0])),
+    'post_movies_bulk': (None, lambda i, ids: (
+        'POST', '/movies/bulk', bulk_movies('Bulk', i))),
+    # the same movies every time, unchanged after the first run
+    'put_movies': (None, lambda i, ids: (
+        'PUT', '/movies', bulk_movies('Roster', 0))),
+    'update_movie': (None, lambda i, ids: (
+        'PATCH', '/movies/1',
+        {'title': 'Patched Movie {}'.format(i), 'release_date': 1968})),
+    'put_movie_cast': (None, lambda i, ids: (
+        'PUT', '/movies/1/cast', {'actors': [1 + i % 5, 2 + i % 5]})),
+    'delete_movie': ('movies', lambda i, ids: (
+        'DELETE', '/movies/{}'.format(ids[i]), None)),
+    'delete_movies': ('movies', lambda i, ids: (
+        'DELETE', '/movies?ids={}'.format(ids[i]), None)),
+    'get_search': (None, lambda i, ids: (
+        'GET', '/search?q=last&limit=20', None)),
+    'get_stats': (None, lambda i, ids: (
+        'GET', '/stats', None)),
+    'post_batch': (None, lambda i, ids: (
+        'POST', '/batch', {'operations': [
+            {'method': 'GET', 'path': '/actors/1'},
+            {'method': 'PATCH', 'path': '/movies/1', 'body': {
+                'title': 'Batched Movie {}'.format(i), 'release_date': 1968
+            }},
+        ]})),
+    'get_internal_stats': (None, lambda i, ids: (
+        'GET', '/internal/stats', None)),
+}
+
+
+# Point the auth module at a local JWKS stand-in, returns the stand-in
+def local_auth():
+    from casting import auth
+    from casting.testing import LocalJWKS
+
+    jwks = LocalJWKS().start()
+    auth.AUTH0_DOMAIN = 'casting.bench'
+    auth.API_AUDIENCE = 'casting'
+    auth.jwks_store = auth.JWKSKeyStore(jwks.url)
+    auth.token_cache = auth.VerifiedTokenCache()
+    return jwks
+
+
+def bench_token(jwks):
+    return jwks.token(
+        PERMISSIONS, issuer='https://casting.bench/', audience='casting'
+    )
+
+
+# App on a fresh in-memory database with rows actors and rows movies,
+# generated by the seed command
+def make_app(rows):
+    os.environ['POSTGRES_URL'] = 'sqlite://'
+    from casting import create_app
+    from casting.models import Actors, Movies, db_drop_and_create_all
+    from casting.seed import seed_table
+
+    app = create_app()
+    with app.app_context():
+        db_drop_and_create_all()
+        seed_table(Actors, rows - 1)
+        seed_table(Movies, rows - 1)
+    return app
+
+
+# Calls of function needed for a sample to last MIN_SAMPLE_SECONDS
+def calibrate(function):
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        if time.perf_counter() - start >= MIN_SAMPLE_SECONDS:
+            return number
+        number *= 10
+
+
+# Time a function in repeat samples of number calls each, by default as many
+# as calibrate() finds. before runs untimed ahead of each sample, with it a
+# sample is a single call.
+def measure(function, repeat, before=None, number=None):
+    if number is None:
+        number = 1 if before is not None else calibrate(function)
+
+    samples = []
+    for _ in range(repeat):
+        if before is not None:
+            before()
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        samples.append((time.perf_counter() - start) / number)
+
+    samples.sort()
+    return {
+        'median_ms': round(statistics.median(samples) * 1000, 4),
+        'min_ms': round(samples[0] * 1000, 4),
+        'p95_ms': round(samples[int(0.95 * (len(samples) - 1))] * 1000, 4),
+        'ops_per_second': round(1 / statistics.median(samples)),
+        'samples': repeat,
+        'calls_per_sample': number,
+    }
+
+
+# Auth layer, independent of the table size
+def auth_benchmarks(app, jwks, repeat):
+    from casting import auth
+
+    token = bench_token(jwks)
+    payload = auth.verify_decode_jwt(token)
+    headers = {'Authorization': 'Bearer ' + token}
+    with app.test_request_context(headers=headers):
+        yield 'auth.get_token_auth_header', measure(
+            auth.get_token_auth_header, repeat)
+    yield 'auth.verify_decode_jwt', measure(
+        lambda: auth.verify_decode_jwt(token), repeat)
+    yield 'auth.check_permissions', measure(
+        lambda: auth.check_permissions('get:actors', payload), repeat)
+
+
+# ORM read path of the original list endpoint
+def model_benchmarks(app, repeat):
+    from casting import db
+    from casting.models import Actors
+
+    def read_all():
+        with app.app_context():
+            [actor.read() for actor in Actors.query.all()]
+            db.session.remove()
+
+    yield 'models.actors_query_all_read', measure(read_all, repeat, number=1)
+
+
+# Fresh rows for a deleting route, one per call
+def fresh_ids(app, table, count):
+    from casting.models import Actors, Movies, bulk_insert
+
+    batch = next(fresh_batches)
+    with app.app_context():
+        if table == 'actors':
+            return bulk_insert(Actors, bulk_actors('Deleted', batch, count))
+        return bulk_insert(Movies, bulk_movies('Deleted', batch, count))
+
+
+fresh_batches = itertools.count()
+
+
+# Every route through the test client, the response cache emptied before
+# each request so it measures the full request and not a cache hit
+def route_benchmarks(app, token, repeat, warmup, endpoints):
+    from casting.cache import response_cache
+
+    client = app.test_client()
+    headers = {'Authorization': 'Bearer ' + token}
+    for endpoint in endpoints:
+        table, make_request = ROUTES[endpoint]
+        ids = fresh_ids(app, table, warmup + repeat) if table else None
+        calls = iter(range(warmup + repeat))
+
+        def call():
+            method, path, body = make_request(next(calls), ids)
+            response = client.open(
+                path, method=method, json=body, headers=headers
+            )
+            if response.status_code >= 400:
+                raise RuntimeError('{} {} returned {}'.format(
+                    method, path, response.status_code
+                ))
+
+        for _ in range(warmup):
+            response_cache.clear()
+            call()
+        yield 'routes.' + endpoint, measure(
+            call, repeat, before=response_cache.clear
+        )
+
+
+# Endpoints of the blueprint, each must have an entry in ROUTES
+def blueprint_endpoints(app):
+    endpoints = sorted(
+        rule.endpoint.split('.', 1)[1] for rule in app.url_map.iter_rules()
+        if rule.endpoint.startswith('routes.')
+    )
+    missing = [endpoint for endpoint in endpoints if endpoint not in ROUTES]
+    if missing:
+        raise SystemExit('No benchmark for: ' + ', '.join(missing))
+    return endpoints
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+            text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Run the suite, returns the results document
+def run(sizes, repeat, warmup=2, pattern=None):
+    from casting.fastjson import backend
+
+    jwks = local_auth()
+    results = {}
+    try:
+        for rows in sizes:
+            app = make_app(rows)
+            endpoints = blueprint_endpoints(app)
+            benchmarks = []
+            if rows == sizes[0]:
+                benchmarks.append(auth_benchmarks(app, jwks, repeat))
+            benchmarks.append(model_benchmarks(app, repeat))
+            benchmarks.append(route_benchmarks(
+                app, bench_token(jwks), repeat, warmup, [
+                    endpoint for endpoint in endpoints
+                    if pattern is None or pattern in 'routes.' + endpoint
+                ]
+            ))
+            for group in benchmarks:
+                for name, result in group:
+                    if pattern is not None and pattern not in name:
+                        continue
+                    # auth timings do not depend on the table size
+                    if not name.startswith('auth.'):
+                        name = '{}@{}'.format(name, rows)
+                    results[name] = result
+                    print('{:<40} {:>12.4f} ms {:>10} ops/s'.format(
+                        name, result['median_ms'], result['ops_per_second']
+                    ), file=sys.stderr)
+    finally:
+        jwks.stop()
+
+    return {
+        'meta': {
+            'commit': git_commit(),
+            'created': datetime.datetime.now(
+                datetime.timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'database': 'sqlite',
+            'json_backend': backend,
+            'rows': list(sizes),
+            'repeat': repeat,
+        },
+        'results': results,
+    }
+
+
+# Benchmarks of current slower than in baseline by more than threshold
+# (0.2 is 20%), compared on the median. Benchmarks missing from either
+# file are skipped.
+def compare(baseline, current, threshold):
+    regressions = []
+    for name, result in sorted(current['results'].items()):
+        before = baseline['results'].get(name)
+        if before is None or not before['median_ms']:
+            continue
+        ratio = result['median_ms'] / before['median_ms']
+        if ratio > 1 + threshold:
+            regressions.append({
+                'name': name,
+                'baseline_ms': before['median_ms'],
+                'current_ms': result['median_ms'],
+                'ratio': round(ratio, 3),
+            })
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--rows', type=int, nargs='+',
+                        default=[100, 1000, 10000],
+                        help='Table sizes to run the suite at.')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='Timed samples per benchmark.')
+    parser.add_argument('--warmup', type=int, default=2,
+                        help='Untimed requests per route first.')
+    parser.add_argument('--filter', dest='pattern',
+                        help='Only run the benchmarks whose name contains '
+                             'this text.')
+    parser.add_argument('--output', '-o', default='benchmark-results.json',
+                        help='JSON file to write the results to.')
+    parser.add_argument('--baseline',
+                        help='Results file of an earlier run to compare '
+                             'with; exits with 1 on a regression.')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Slowdown of the median, 0.2 is 20%%, above '
+                             'which a benchmark regressed.')
+    args = parser.parse_args(argv)
+
+    document = run(args.rows, args.repeat, args.warmup, args.pattern)
+    with open(args.output, 'w') as file:
+        json.dump(document, file, indent=2, sort_keys=True)
+    print('Results written to {}'.format(args.output), file=sys.stderr)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = compare(baseline, document, args.threshold)
+        for regression in regressions:
+            print('REGRESSION {name}: {baseline_ms} ms -> {current_ms} ms '
+                  '(x{ratio})'.format(**regression))
+        if regressions:
+            return 1
+        print('No regression above {:.0%} against {}'.format(
+            args.threshold, args.baseline
+        ))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,19 +1,25 @@
 import os
 from flask import Flask, request, jsonify, abort
-from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_cors import CORS
 from .auth import AuthError
+from .pool import engine_options
+from .replica import RoutingSQLAlchemy, init_replica
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 migrate = Migrate()
 
 def create_app():
     app = Flask(__name__)
+    database_uri = os.environ.get('POSTGRES_URL') or \
+        'sqlite:///' + os.path.join(app.instance_path, 'casting.sqlite')
+    # optional read replica for the GET endpoints
+    replica_uri = os.environ.get('POSTGRES_REPLICA_URL')
     app.config.from_mapping(
         SECRET_KEY = os.environ.get('SECRET_KEY') or 'dev_key',
-        SQLALCHEMY_DATABASE_URI = os.environ.get('POSTGRES_URL') or \
-            'sqlite:///' + os.path.join(app.instance_path, 'casting.sqlite'),
+        SQLALCHEMY_DATABASE_URI = database_uri,
+        SQLALCHEMY_ENGINE_OPTIONS = engine_options(database_uri),
+        SQLALCHEMY_BINDS = {'replica': replica_uri} if replica_uri else {},
         SQLALCHEMY_TRACK_MODIFICATIONS = False
     )
 
@@ -32,12 +38,17 @@ def create_app():
 
     db.init_app(app)
     migrate.init_app(app, db)
+    init_replica(app, db)
 
     from . import models
 
     from . import routes
     app.register_blueprint(routes.bp)
 
+    # flask export, flask import and flask seed
+    from .commands import register_commands
+    register_commands(app)
+
     #Error Handling
 
     @app.errorhandler(422)
@@ -96,6 +107,16 @@ def create_app():
         }), 405
 
 
+    # error handler for 413
+    @app.errorhandler(413)
+    def request_entity_too_large(error):
+        return jsonify({
+            "success": False,
+            "error": 413,
+            "message": "request entity too large"
+        }), 413
+
+
     # error handler for 500
     @app.errorhandler(500)
     def internal_error(error):
@@ -1,8 +1,12 @@
 import os
 import json
+import hashlib
+import threading
+import time
+from collections import OrderedDict
 from flask import request, _request_ctx_stack, abort
 from functools import wraps
-from jose import jwt
+from jose import jwk, jwt
 from urllib.request import urlopen
 from dotenv import load_dotenv
 
@@ -13,6 +17,18 @@ AUTH0_DOMAIN = os.getenv("AUTH0_DOMAIN_NAME")
 ALGORITHMS = ['RS256']
 API_AUDIENCE = os.getenv("AUTH0_CLIENT_ID")
 
+# JWKS key store settings (seconds unless noted)
+JWKS_URL = os.getenv("AUTH0_JWKS_URL") or \
+    f'https://{AUTH0_DOMAIN}/.well-known/jwks.json'
+JWKS_CACHE_TTL = int(os.getenv("JWKS_CACHE_TTL", 600))
+JWKS_FETCH_TIMEOUT = float(os.getenv("JWKS_FETCH_TIMEOUT", 5))
+JWKS_MIN_REFRESH_INTERVAL = int(os.getenv("JWKS_MIN_REFRESH_INTERVAL", 30))
+JWKS_FAILURE_THRESHOLD = int(os.getenv("JWKS_FAILURE_THRESHOLD", 3))
+JWKS_BREAKER_COOLDOWN = int(os.getenv("JWKS_BREAKER_COOLDOWN", 60))
+
+# Number of verified tokens kept in memory (0 disables the cache)
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", 1024))
+
 ## AuthError Exception
 '''
 AuthError Exception
@@ -24,6 +40,205 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+## JWKS key store
+'''
+JWKSKeyStore
+Process-wide cache of the Auth0 signing keys, parsed once per kid.
+- keys are served from memory until JWKS_CACHE_TTL expires
+- an unknown kid forces a refresh (at most once per JWKS_MIN_REFRESH_INTERVAL)
+- concurrent callers share a single in-flight refresh
+- stale keys are served right away while a background thread revalidates
+  them, and for as long as the JWKS endpoint is failing; only a cold miss
+  (empty store or unknown kid) waits for the fetch
+- after JWKS_FAILURE_THRESHOLD consecutive failures the circuit opens and
+  no fetch is attempted for JWKS_BREAKER_COOLDOWN seconds
+'''
+class JWKSKeyStore:
+    def __init__(self, url, ttl=JWKS_CACHE_TTL, timeout=JWKS_FETCH_TIMEOUT,
+                 min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL,
+                 failure_threshold=JWKS_FAILURE_THRESHOLD,
+                 breaker_cooldown=JWKS_BREAKER_COOLDOWN):
+        self.url = url
+        self.ttl = ttl
+        self.timeout = timeout
+        self.min_refresh_interval = min_refresh_interval
+        self.failure_threshold = failure_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.keys = {}
+        self.fetched_at = None
+        self.last_attempt = None
+        self.failures = 0
+        self.open_until = 0
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._refresher = None
+
+    def is_fresh(self):
+        return self.fetched_at is not None and \
+            time.monotonic() - self.fetched_at < self.ttl
+
+    def circuit_open(self):
+        return time.monotonic() < self.open_until
+
+    # Return the verification key for kid, or None if Auth0 does not know it
+    def get_key(self, kid):
+        key = self.keys.get(kid)
+        if key is not None:
+            if not self.is_fresh() and not self.circuit_open():
+                # stale: revalidate in the background unless a refresh is
+                # already running, and serve the cached key meanwhile
+                self._refresh(wait=False)
+            return key
+
+        # unknown kid: the keys may have been rotated, refresh and retry
+        if self.fetched_at is None or self._refresh_allowed():
+            self._refresh(wait=True)
+        key = self.keys.get(kid)
+        if key is None and self.fetched_at is None:
+            raise AuthError({
+                'code': 'jwks_unavailable',
+                'description': 'Unable to fetch the signing keys.'
+            }, 503)
+        return key
+
+    def _refresh_allowed(self):
+        return self.last_attempt is None or \
+            time.monotonic() - self.last_attempt >= self.min_refresh_interval
+
+    # Wait for the background refresh, if one is running
+    def join(self, timeout=None):
+        refresher = self._refresher
+        if refresher is not None:
+            refresher.join(timeout)
+
+    # Single-flight refresh: only one thread fetches, the others either wait
+    # for its result (wait=True) or return straight away (wait=False). With
+    # wait=False the fetch runs in a daemon thread, which holds the lock
+    # until it is done.
+    def _refresh(self, wait):
+        generation = self._generation
+        if not self._lock.acquire(blocking=wait):
+            return
+        if wait:
+            self._refresh_locked(generation)
+            return
+        self._refresher = threading.Thread(
+            target=self._refresh_locked, args=(generation,),
+            name='jwks-refresh', daemon=True
+        )
+        try:
+            self._refresher.start()
+        except RuntimeError:
+            self._lock.release()
+
+    # Fetch the keys with the lock held by the caller, then release it
+    def _refresh_locked(self, generation):
+        try:
+            # another thread refreshed while we were waiting for the lock
+            if self._generation != generation or self.circuit_open():
+                return
+            self.last_attempt = time.monotonic()
+            try:
+                keys = self._fetch()
+            except Exception:
+                self.failures += 1
+                if self.failures >= self.failure_threshold:
+                    self.open_until = time.monotonic() + self.breaker_cooldown
+                return
+            self.keys = keys
+            self.fetched_at = time.monotonic()
+            self.failures = 0
+            self.open_until = 0
+            self._generation += 1
+        finally:
+            self._lock.release()
+
+    # Download the JWKS document and parse every RSA signing key once
+    def _fetch(self):
+        jsonurl = urlopen(self.url, timeout=self.timeout)
+        jwks = json.loads(jsonurl.read())
+        keys = {}
+        for key in jwks['keys']:
+            if key.get('kty') != 'RSA' or key.get('use', 'sig') != 'sig':
+                continue
+            keys[key['kid']] = jwk.construct(key, ALGORITHMS[0])
+        return keys
+
+
+jwks_store = JWKSKeyStore(JWKS_URL)
+
+
+## Verified token cache
+'''
+VerifiedTokenCache
+Bounded LRU of tokens that already passed verify_decode_jwt, keyed by the
+SHA-256 of the raw token. Each entry holds the decoded payload, with its
+permissions as a frozenset, and is dropped once the token's exp is reached.
+Tokens without an exp claim are never cached.
+'''
+class VerifiedTokenCache:
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode()).digest()
+
+    # Return the cached payload for token, or None
+    def get(self, token):
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                payload, exp = entry
+                if exp > time.time():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return payload
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    # Store a verified payload and return it with frozen permissions
+    def put(self, token, payload):
+        if 'permissions' in payload:
+            payload = dict(
+                payload, permissions=frozenset(payload['permissions'])
+            )
+        exp = payload.get('exp')
+        if self.maxsize <= 0 or not isinstance(exp, (int, float)):
+            return payload
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (payload, exp)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return payload
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._entries),
+                'maxsize': self.maxsize
+            }
+
+
+token_cache = VerifiedTokenCache()
+
+
 # Create the JWT validation decorator
 # Format error response and append status code
 def get_token_auth_header():
@@ -75,26 +290,15 @@ def check_permissions(permission, payload):
 
 
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
-    if rsa_key:
+    rsa_key = jwks_store.get_key(unverified_header['kid'])
+    if rsa_key is not None:
         try:
             payload = jwt.decode(
                 token,
@@ -142,18 +346,26 @@ def check_permissions(permission, payload):
     return True
 
 
+# Verified payload of the request's bearer token. Repeat callers skip the
+# RS256 signature check, their payload comes from the token cache.
+def verified_payload():
+    token = get_token_auth_header()
+    payload = token_cache.get(token)
+    if payload is None:
+        payload = token_cache.put(token, verify_decode_jwt(token))
+    return payload
+
+
 def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            
-            payload = verify_decode_jwt(token)
-            
-            
+            payload = verified_payload()
             check_permissions(permission, payload)
 
             return f(payload, *args, **kwargs)
 
+        # read by POST /batch, which checks the permission of each operation
+        wrapper.permission = permission
         return wrapper
     return requires_auth_decorator
\ No newline at end of file
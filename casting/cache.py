@@ -0,0 +1,106 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+# Response cache limits, per worker process (0 entries disables the cache)
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', 256))
+RESPONSE_CACHE_MAX_BYTES = int(
+    os.getenv('RESPONSE_CACHE_MAX_BYTES', 16 * 1024 * 1024)
+)
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', 60))
+
+
+## Response cache
+'''
+ResponseCache
+Bounded TTL + LRU cache of serialized response bodies. Every entry belongs to
+the tables it was built from, a table name or a list of them, so writes can
+drop exactly the entries built from a table. It is limited both in entries
+and in bytes of cached bodies.
+'''
+class ResponseCache:
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE,
+                 max_bytes=RESPONSE_CACHE_MAX_BYTES, ttl=RESPONSE_CACHE_TTL):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Return the cached body for key, or None
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                table, body, expires_at = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return body
+                self._remove(key)
+                self.evictions += 1
+            self.misses += 1
+            return None
+
+    def put(self, key, table, body):
+        if self.maxsize <= 0 or len(body) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            tables = {table} if isinstance(table, str) else set(table)
+            self._entries[key] = (tables, body, time.monotonic() + self.ttl)
+            self.bytes += len(body)
+            while len(self._entries) > self.maxsize or \
+                    self.bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    # Drop every entry built from table
+    def invalidate(self, table):
+        with self._lock:
+            keys = [
+                key for key, entry in self._entries.items()
+                if table in entry[0]
+            ]
+            for key in keys:
+                self._remove(key)
+            self.invalidations += len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.invalidations = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                'maxsize': self.maxsize,
+                'max_bytes': self.max_bytes
+            }
+
+    def _remove(self, key):
+        _, body, _ = self._entries.pop(key)
+        self.bytes -= len(body)
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,77 @@
+import click
+from flask.cli import with_appcontext
+
+from casting.seed import seed_table
+from casting.transfer import TABLES, export_csv, gzip_chunks, import_file
+
+
+# flask export actors -o actors.csv.gz
+@click.command('export')
+@click.argument('table', type=click.Choice(sorted(TABLES)))
+@click.option('--output', '-o', default='-',
+              help='File to write, - for the standard output.')
+@click.option('--gzip', 'compress', is_flag=True,
+              help='Compress the CSV, the default for a .gz output.')
+@with_appcontext
+def export_command(table, output, compress):
+    '''Export a table as CSV, streamed in EXPORT_CHUNK_SIZE rows.'''
+    chunks = export_csv(TABLES[table])
+    if compress or output.endswith('.gz'):
+        chunks = gzip_chunks(chunks)
+    with click.open_file(output, 'wb') as file:
+        for chunk in chunks:
+            file.write(chunk)
+
+
+# flask import actors actors.csv --resume
+@click.command('import')
+@click.argument('table', type=click.Choice(sorted(TABLES)))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'format', type=click.Choice(['csv', 'ndjson']),
+              help='File format, by default from the file extension.')
+@click.option('--chunk-size', type=click.IntRange(min=1),
+              help='Rows per transaction [IMPORT_CHUNK_SIZE].')
+@click.option('--resume', is_flag=True,
+              help='Continue after the last chunk committed by a previous '
+                   'import of the same file.')
+@with_appcontext
+def import_command(table, path, format, chunk_size, resume):
+    '''Import a CSV or NDJSON file (optionally .gz) into a table.'''
+    report = import_file(TABLES[table], path, format, chunk_size, resume)
+    for error in report['errors']:
+        click.echo('row {}: {}'.format(
+            error['row'], '; '.join(error['errors'])
+        ), err=True)
+    click.echo(
+        'Imported {loaded} {table} ({rejected} rejected, {skipped} skipped) '
+        'in {seconds}s, {rows_per_second} rows/s'.format(table=table, **report)
+    )
+
+
+# flask seed --actors 1000000 --movies 100000
+@click.command('seed')
+@click.option('--actors', type=click.IntRange(min=0), default=0,
+              help='Actors to add.')
+@click.option('--movies', type=click.IntRange(min=0), default=0,
+              help='Movies to add.')
+@click.option('--seed', type=int, default=0,
+              help='Random seed, the same seed generates the same rows.')
+@click.option('--chunk-size', type=click.IntRange(min=1),
+              help='Rows per transaction [SEED_CHUNK_SIZE].')
+@with_appcontext
+def seed_command(actors, movies, seed, chunk_size):
+    '''Add generated actors and movies for load and benchmark runs.'''
+    for table, count in (('actors', actors), ('movies', movies)):
+        if not count:
+            continue
+        report = seed_table(TABLES[table], count, seed, chunk_size)
+        click.echo(
+            'Seeded {rows} {table} in {seconds}s, {rows_per_second} rows/s'
+            .format(table=table, **report)
+        )
+
+
+def register_commands(app):
+    app.cli.add_command(export_command)
+    app.cli.add_command(import_command)
+    app.cli.add_command(seed_command)
@@ -0,0 +1,49 @@
+import json
+import os
+
+from flask import Response
+
+try:
+    import orjson
+except ImportError:  # optional, pip install orjson
+    orjson = None
+
+
+# JSON encoder used by the read endpoints: auto, orjson or stdlib.
+# auto picks orjson when it is installed.
+JSON_BACKEND = os.getenv('JSON_BACKEND', 'auto')
+
+
+def stdlib_dumps(obj):
+    return json.dumps(obj, separators=(',', ':')).encode()
+
+
+def orjson_dumps(obj):
+    return orjson.dumps(obj)
+
+
+BACKENDS = {
+    'stdlib': stdlib_dumps,
+    'orjson': orjson_dumps,
+}
+
+
+# Return the encoder for a backend name, falling back to the standard
+# library when orjson is asked for but not installed
+def get_backend(name):
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'stdlib'
+    if name == 'orjson' and orjson is None:
+        name = 'stdlib'
+    if name not in BACKENDS:
+        raise ValueError('Unknown JSON backend: {}'.format(name))
+    return name, BACKENDS[name]
+
+
+backend, dumps = get_backend(JSON_BACKEND)
+
+
+# Flask 1.0 has no pluggable JSON provider (jsonify always goes through
+# the stdlib encoder), so the read endpoints build their responses here
+def json_response(data, status=200):
+    return Response(dumps(data), status=status, mimetype='application/json')
@@ -1,4 +1,22 @@
+import csv
+import io
+import sqlite3
+from contextlib import contextmanager
+from sqlalchemy import (
+    DDL, event, func, inspect, literal_column, or_, select, text, tuple_
+)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine
 from casting import db
+from casting.cache import response_cache
+
+# Tables whose writes bump their row in table_versions. A change of the
+# cast (movie_actors) bumps both, as both sides list it.
+VERSIONED_TABLES = ('actors', 'movies')
+
+# Records per INSERT ... ON CONFLICT statement of upsert_rows() and per
+# natural key lookup of conflicting()
+UPSERT_CHUNK_SIZE = 1000
 
 
 def db_drop_and_create_all():
@@ -18,27 +36,553 @@ def db_drop_and_create_all():
     # Clear tables and start fresh
     db.drop_all()
     db.create_all()
+    for name in VERSIONED_TABLES:
+        db.session.add(TableVersions(name=name, version=0))
 
-    # add one demo row
+    # add one demo row, the actor plays in the movie
+    movie.cast.append(actor)
     movie.insert()
     actor.insert()
     
 
+# Unit of work
+
+# Stage several model writes and commit them once:
+#
+#     with unit_of_work():
+#         actor.insert()
+#         movie.update()
+#
+# Inside the block insert(), update(), delete() and the bulk helpers only
+# flush; the block commits when it ends and rolls everything back if it
+# raises. Nested blocks join the outer one. Works as a decorator too.
+@contextmanager
+def unit_of_work():
+    if in_unit_of_work():
+        yield db.session
+        return
+    db.session.info['unit_of_work'] = True
+    try:
+        yield db.session
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        db.session.info.pop('unit_of_work', None)
+
+
+def in_unit_of_work():
+    return db.session.info.get('unit_of_work', False)
+
+
+# Savepoint inside a unit of work: if its block raises only the writes of
+# the block are rolled back, the caller can catch the error and go on
+def savepoint():
+    return db.session.begin_nested()
+
+
+# Transaction of one model write: commits on its own, or joins the open
+# unit of work and flushes so errors and new ids show up right away
+@contextmanager
+def transaction():
+    if in_unit_of_work():
+        yield
+        db.session.flush()
+        return
+    try:
+        yield
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+# Bulk insert
+
+# Positions of the records whose natural key is already in the table or
+# repeats the key of an earlier record. Run in the inserting transaction;
+# a concurrent insert of the same key still fails on the unique index.
+def conflicting(model, records):
+    table = model.__table__
+    columns = [table.c[name] for name in model.NATURAL_KEY]
+    keys = [
+        tuple(record[name] for name in model.NATURAL_KEY)
+        for record in records
+    ]
+    taken = set()
+    for start in range(0, len(keys), UPSERT_CHUNK_SIZE):
+        taken.update(tuple(row) for row in db.session.execute(
+            select(*columns).where(
+                tuple_(*columns).in_(keys[start:start + UPSERT_CHUNK_SIZE])
+            )
+        ))
+    positions = []
+    for position, key in enumerate(keys):
+        if key in taken:
+            positions.append(position)
+        taken.add(key)
+    return positions
+
+
+# Insert many validated records in one transaction and return their ids in
+# the same order, None for a record skipped because its natural key is
+# taken (see conflicting()). On PostgreSQL the ids are reserved from the
+# table sequence and the rows loaded with COPY; on SQLite they go through
+# one executemany, and since SQLite holds the write lock until commit the
+# rows receive consecutive ids ending at max(id).
+def bulk_insert(model, records):
+    if not records:
+        return []
+    table = model.__table__
+    with transaction():
+        skipped = set(conflicting(model, records))
+        kept = [
+            record for position, record in enumerate(records)
+            if position not in skipped
+        ]
+        if not kept:
+            return [None] * len(records)
+        records = kept
+        if db.engine.dialect.name == 'postgresql':
+            ids = [row[0] for row in db.session.execute(
+                text("SELECT nextval(pg_get_serial_sequence(:table, 'id')) "
+                     "FROM generate_series(1, :count)"),
+                {'table': table.name, 'count': len(records)}
+            )]
+            rows = [dict(record, id=id) for id, record in zip(ids, records)]
+            copy_rows(table, rows)
+        else:
+            db.session.execute(table.insert(), records)
+            last = db.session.execute(select(func.max(table.c.id))).scalar()
+            ids = list(range(last - len(records) + 1, last + 1))
+        mark_changed(db.session, [table.name])
+    ids = iter(ids)
+    return [
+        None if position in skipped else next(ids)
+        for position in range(len(skipped) + len(records))
+    ]
+
+
+# Insert validated records without reading back their ids, with COPY on
+# PostgreSQL and one executemany elsewhere. Records whose natural key is
+# taken are skipped, returns their positions.
+def load_rows(model, records):
+    if not records:
+        return []
+    table = model.__table__
+    with transaction():
+        skipped = conflicting(model, records)
+        if skipped:
+            rejected = set(skipped)
+            records = [
+                record for position, record in enumerate(records)
+                if position not in rejected
+            ]
+        if records:
+            if db.engine.dialect.name == 'postgresql':
+                copy_rows(table, records)
+            else:
+                db.session.execute(table.insert(), records)
+            mark_changed(db.session, [table.name])
+    return skipped
+
+
+# Insert the records, or update the row with the same natural key, with
+# INSERT ... ON CONFLICT DO UPDATE. Rows whose values would not change are
+# not written. Returns the inserted, updated and unchanged counts.
+def upsert_rows(model, records):
+    counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+    if not records:
+        return counts
+    table = model.__table__
+    key = [table.c[name] for name in model.NATURAL_KEY]
+    postgres = db.engine.dialect.name == 'postgresql'
+    insert = postgresql.insert if postgres else sqlite.insert
+
+    with transaction():
+        for start in range(0, len(records), UPSERT_CHUNK_SIZE):
+            chunk = records[start:start + UPSERT_CHUNK_SIZE]
+            statement = insert(table).values(chunk)
+            values = {
+                name: statement.excluded[name] for name in chunk[0]
+                if name not in model.NATURAL_KEY
+            }
+            if values:
+                statement = statement.on_conflict_do_update(
+                    index_elements=key,
+                    set_=values,
+                    where=or_(*(
+                        table.c[name].is_distinct_from(value)
+                        for name, value in values.items()
+                    ))
+                )
+            else:
+                # every column is part of the key, an existing row is equal
+                statement = statement.on_conflict_do_nothing(
+                    index_elements=key
+                )
+            if postgres:
+                # only written rows are returned, xmax is 0 for inserted ones
+                written = db.session.execute(statement.returning(
+                    literal_column('xmax = 0')
+                )).scalars().all()
+                inserted = sum(written)
+                changed = len(written)
+            else:
+                # SQLite counts both the inserted and the updated rows
+                inserted = len(chunk) - db.session.execute(
+                    select(func.count()).select_from(table).where(
+                        tuple_(*key).in_([
+                            tuple(record[name] for name in model.NATURAL_KEY)
+                            for record in chunk
+                        ])
+                    )
+                ).scalar()
+                changed = db.session.execute(statement).rowcount
+            counts['inserted'] += inserted
+            counts['updated'] += changed - inserted
+            counts['unchanged'] += len(chunk) - changed
+        if counts['inserted'] or counts['updated']:
+            mark_changed(db.session, [table.name])
+    return counts
+
+
+# Single statement writes
+
+# Update the row with this id in one UPDATE ... RETURNING statement and
+# return it (the READ_COLUMNS), or None if there is no such row. SQLite has
+# no RETURNING support in SQLAlchemy 1.4, there the UPDATE is followed by a
+# SELECT of the row in the same transaction.
+def update_returning(model, id, values):
+    table = model.__table__
+    columns = [table.c[name] for name in model.READ_COLUMNS]
+    statement = table.update().where(table.c.id == id).values(**values)
+    with transaction():
+        if getattr(db.engine.dialect, 'full_returning', False):
+            row = db.session.execute(statement.returning(*columns)).first()
+        else:
+            row = None
+            if db.session.execute(statement).rowcount:
+                row = db.session.execute(
+                    select(*columns).where(table.c.id == id)
+                ).first()
+        if row is not None:
+            mark_changed(db.session, [table.name])
+    return row
+
+
+# Delete the row with this id in one DELETE statement, returns False if
+# there was no such row. Its movie_actors rows go with it (ON DELETE
+# CASCADE), so the other side of the cast changes too.
+def delete_by_id(model, id):
+    table = model.__table__
+    with transaction():
+        deleted = db.session.execute(
+            table.delete().where(table.c.id == id)
+        ).rowcount
+        if deleted:
+            mark_changed(db.session, VERSIONED_TABLES)
+    return deleted > 0
+
+
+# Rows per DELETE ... WHERE id IN when the ids are deleted in chunks
+DELETE_CHUNK_SIZE = 500
+
+
+# Delete the rows with these ids, or with an id in the (first, last) range,
+# in one transaction and return the deleted ids. With dry_run the ids are
+# only selected. PostgreSQL deletes a list of ids with a single DELETE ...
+# RETURNING; elsewhere the matching ids are selected first and exactly those
+# are deleted. A range is selected first on both dialects, at most limit
+# ids and locked on PostgreSQL, then deleted with one DELETE ... WHERE id
+# BETWEEN the first and last selected ids; ids are only handed out above
+# the current maximum, so no other row can enter that span meanwhile.
+# Raises ValueError if the range holds more than limit rows.
+def delete_many(model, ids=None, id_range=None, dry_run=False, limit=None):
+    table = model.__table__
+    with transaction():
+        if id_range is not None:
+            query = select(table.c.id) \
+                .where(table.c.id.between(*id_range)).order_by(table.c.id)
+            if limit is not None:
+                query = query.limit(limit + 1)
+            if not dry_run:
+                query = query.with_for_update()
+            deleted = [row[0] for row in db.session.execute(query)]
+            if limit is not None and len(deleted) > limit:
+                raise ValueError(
+                    'more than {} rows in the range'.format(limit)
+                )
+            if dry_run or not deleted:
+                return deleted
+            db.session.execute(table.delete().where(
+                table.c.id.between(deleted[0], deleted[-1])
+            ))
+        elif dry_run:
+            return [row[0] for row in db.session.execute(
+                select(table.c.id).where(table.c.id.in_(ids))
+                .order_by(table.c.id)
+            )]
+        elif getattr(db.engine.dialect, 'full_returning', False):
+            deleted = sorted(row[0] for row in db.session.execute(
+                table.delete().where(table.c.id.in_(ids))
+                .returning(table.c.id)
+            ))
+        else:
+            deleted = [row[0] for row in db.session.execute(
+                select(table.c.id).where(table.c.id.in_(ids))
+                .order_by(table.c.id)
+            )]
+            for start in range(0, len(deleted), DELETE_CHUNK_SIZE):
+                chunk = deleted[start:start + DELETE_CHUNK_SIZE]
+                db.session.execute(table.delete().where(table.c.id.in_(chunk)))
+        if deleted:
+            mark_changed(db.session, VERSIONED_TABLES)
+    return deleted
+
+
+# Replace the cast of a movie. Returns False if there is no such movie and
+# raises ValueError if an actor id does not exist.
+def set_cast(movie_id, actor_ids):
+    actor_ids = sorted(set(actor_ids))
+    with transaction():
+        if db.session.get(Movies, movie_id) is None:
+            return False
+        found = db.session.execute(
+            select(func.count(Actors.id)).where(Actors.id.in_(actor_ids))
+        ).scalar()
+        if found != len(actor_ids):
+            raise ValueError('Unknown actor id')
+        db.session.execute(
+            movie_actors.delete().where(movie_actors.c.movie_id == movie_id)
+        )
+        if actor_ids:
+            db.session.execute(movie_actors.insert(), [
+                {'movie_id': movie_id, 'actor_id': actor_id}
+                for actor_id in actor_ids
+            ])
+        mark_changed(db.session, VERSIONED_TABLES)
+    return True
+
+
+# Load rows into a PostgreSQL table with COPY FROM STDIN, falling back to
+# executemany when the driver has no copy support
+def copy_rows(table, rows):
+    cursor = db.session.connection().connection.cursor()
+    if not hasattr(cursor, 'copy_expert'):
+        db.session.execute(table.insert(), rows)
+        return
+
+    columns = list(rows[0])
+    buffer = io.StringIO()
+    # quote text so empty strings are not read back as NULL
+    writer = csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC)
+    for row in rows:
+        writer.writerow([row[column] for column in columns])
+    buffer.seek(0)
+    cursor.copy_expert(
+        'COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+            table.name, ', '.join(columns)
+        ),
+        buffer
+    )
+
+
+# Table versions
+
+# Return the current version of a model's table, a cheap primary key lookup
+# that lets readers tell whether anything changed without reading the rows
+def table_version(model):
+    version = db.session.query(TableVersions.version) \
+        .filter_by(name=model.__tablename__).scalar()
+    return version or 0
+
+
+# Increment the version of each table, in the transaction of the write
+def bump_versions(connection, names):
+    versions = TableVersions.__table__
+    for name in names:
+        result = connection.execute(
+            versions.update()
+            .where(versions.c.name == name)
+            .values(version=versions.c.version + 1)
+        )
+        if result.rowcount == 0:
+            connection.execute(versions.insert().values(name=name, version=1))
+
+
+# Bump the versions of the written tables and remember them so their
+# cached responses are dropped once the transaction commits
+def mark_changed(session, names):
+    bump_versions(session.connection(), names)
+    session.info.setdefault('changed_tables', set()).update(names)
+
+
+@event.listens_for(db.session, 'after_commit')
+def invalidate_committed(session):
+    for name in session.info.pop('changed_tables', ()):
+        response_cache.invalidate(name)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_rolled_back(session):
+    session.info.pop('changed_tables', None)
+
+
+# Every flush that inserts, updates or deletes actors or movies bumps the
+# version of their table, so the insert/update/delete methods below and any
+# other ORM write keep the versions and the response cache current. Deletes
+# and cast changes bump both tables.
+@event.listens_for(db.session, 'after_flush')
+def bump_flushed_versions(session, flush_context):
+    names = set()
+    for obj in list(session.new) + list(session.deleted):
+        names.add(getattr(obj, '__tablename__', None))
+        if obj in session.deleted or cast_changed(obj):
+            names.update(VERSIONED_TABLES)
+    for obj in session.dirty:
+        if session.is_modified(obj):
+            names.add(getattr(obj, '__tablename__', None))
+            if cast_changed(obj):
+                names.update(VERSIONED_TABLES)
+    names = sorted(names.intersection(VERSIONED_TABLES))
+    if names:
+        mark_changed(session, names)
+
+
+# True if the cast or movies collection of an actor or movie was changed
+def cast_changed(obj):
+    if not isinstance(obj, (Movies, Actors)):
+        return False
+    state = inspect(obj)
+    return any(
+        state.attrs[relation.key].history.has_changes()
+        for relation in state.mapper.relationships
+    )
+
+
+# SQLite only enforces foreign keys, and so the ON DELETE CASCADE of
+# movie_actors, when asked to on each connection
+@event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+
+# Validation helpers, each appends a message to errors when the field is bad
+
+def check_text(data, field, errors, max_length=None):
+    value = data.get(field)
+    if not isinstance(value, str) or not value.strip():
+        errors.append(f'{field} must be a non-empty string')
+    elif max_length is not None and len(value) > max_length:
+        errors.append(f'{field} must be at most {max_length} characters')
+    return value
+
+
+def check_integer(data, field, errors, minimum=None):
+    value = data.get(field)
+    if not isinstance(value, int) or isinstance(value, bool):
+        errors.append(f'{field} must be an integer')
+    elif minimum is not None and value < minimum:
+        errors.append(f'{field} must be at least {minimum}')
+    return value
+
+
 # ROUTES
 
 
+# Write counter of each versioned table
+class TableVersions(db.Model):
+    __tablename__ = 'table_versions'
+    name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<TableVersions: {} {}>'.format(self.name, self.version)
+
+
+# Rows of each import source (table and file) already loaded. It is
+# updated in the transaction of each chunk, so a resumed import starts
+# exactly after the last committed chunk.
+class ImportCheckpoints(db.Model):
+    __tablename__ = 'import_checkpoints'
+    source = db.Column(db.String(255), primary_key=True)
+    rows = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<ImportCheckpoints: {} {}>'.format(self.source, self.rows)
+
+
+# Cast of each movie, the actors that play in it
+movie_actors = db.Table(
+    'movie_actors',
+    db.Column('movie_id', db.Integer,
+              db.ForeignKey('movies.id', ondelete='CASCADE'),
+              primary_key=True),
+    db.Column('actor_id', db.Integer,
+              db.ForeignKey('actors.id', ondelete='CASCADE'),
+              primary_key=True),
+    # the primary key serves the cast of a movie, this the movies of an actor
+    db.Index('ix_movie_actors_actor_id', 'actor_id', 'movie_id')
+)
+
+
 # Movies with attributes title and release date
 
 class Movies(db.Model):
+    # Indexes for the filters and sorts of GET /movies, id makes the
+    # keyset pagination cursor part of the index
+    __table_args__ = (
+        db.Index('ix_movies_release_date', 'release_date', 'id'),
+        # natural key of a movie, the conflict target of PUT /movies; it
+        # also serves the title filter and sort
+        db.Index('uq_movies_title_release_date', 'title', 'release_date',
+                 unique=True),
+        # LIKE prefix filter on PostgreSQL, see drop_pattern_indexes()
+        db.Index('ix_movies_title_pattern', 'title',
+                 postgresql_ops={'title': 'varchar_pattern_ops'}),
+    )
+
+    # Columns returned by read(), selected directly by the list endpoints
+    READ_COLUMNS = ('id', 'title', 'release_date')
+
+    # Relations the list endpoint can add to each row with ?include=
+    INCLUDES = ('cast',)
+
+    # Columns identifying a movie for PUT /movies, uq_movies_title_release_date
+    NATURAL_KEY = ('title', 'release_date')
+
     # Autoincrementing, unique primary key
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String, nullable=False)
     release_date = db.Column(db.Integer, nullable=False)
 
+    # Actors of the movie, the other side is Actors.movies
+    cast = db.relationship(
+        'Actors', secondary=movie_actors, order_by='Actors.id',
+        backref=db.backref('movies', order_by='Movies.id')
+    )
+
+    # Validate a JSON record, returns the column values and a list of errors
+    @staticmethod
+    def validate(data):
+        errors = []
+        if not isinstance(data, dict):
+            return None, ['record must be an object']
+        values = {
+            'title': check_text(data, 'title', errors),
+            'release_date': check_integer(data, 'release_date', errors)
+        }
+        return values, errors
+
     # Create
     def insert(self):
-        db.session.add(self)
-        db.session.commit()
+        with transaction():
+            db.session.add(self)
 
     # Read
     def read(self):
@@ -50,28 +594,63 @@ class Movies(db.Model):
 
     # Update
     def update(self):
-        db.session.commit()
+        with transaction():
+            db.session.add(self)
     
     # Delete
     def delete(self):
-        db.session.delete(self)
-        db.session.commit()
+        with transaction():
+            db.session.delete(self)
 
     def __repr__(self):
         return '<Movie: {}>'.format(self.title)
 
 # Actors with attributes name, age and gender
 class Actors(db.Model):
+    # Indexes for the filters and sorts of GET /actors
+    __table_args__ = (
+        db.Index('ix_actors_age', 'age', 'id'),
+        db.Index('ix_actors_gender', 'gender', 'id'),
+        # natural key of an actor, the conflict target of PUT /actors; it
+        # also serves the name filter and sort
+        db.Index('uq_actors_name', 'name', unique=True),
+        # LIKE prefix filter on PostgreSQL, see drop_pattern_indexes()
+        db.Index('ix_actors_name_pattern', 'name',
+                 postgresql_ops={'name': 'varchar_pattern_ops'}),
+    )
+
+    # Columns returned by read(), selected directly by the list endpoints
+    READ_COLUMNS = ('id', 'name', 'age', 'gender')
+
+    # Relations the list endpoint can add to each row with ?include=
+    INCLUDES = ('movies',)
+
+    # Columns identifying an actor for PUT /actors, uq_actors_name
+    NATURAL_KEY = ('name',)
+
     # Autoincrementing, unique primary key
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120), nullable=False)
     age = db.Column(db.Integer, nullable=False)
     gender = db.Column(db.String(120), nullable=False)
 
+    # Validate a JSON record, returns the column values and a list of errors
+    @staticmethod
+    def validate(data):
+        errors = []
+        if not isinstance(data, dict):
+            return None, ['record must be an object']
+        values = {
+            'name': check_text(data, 'name', errors, 120),
+            'age': check_integer(data, 'age', errors, 0),
+            'gender': check_text(data, 'gender', errors, 120)
+        }
+        return values, errors
+
     # Create
     def insert(self):
-        db.session.add(self)
-        db.session.commit()
+        with transaction():
+            db.session.add(self)
     
     # Read
     def read(self):
@@ -84,12 +663,28 @@ class Actors(db.Model):
 
     # Update
     def update(self):
-        db.session.commit()
+        with transaction():
+            db.session.add(self)
 
    # Delete
     def delete(self):
-        db.session.delete(self)
-        db.session.commit()
+        with transaction():
+            db.session.delete(self)
     
     def __repr__(self):
-        return '<Actors: {}>'.format(self.name)
\ No newline at end of file
+        return '<Actors: {}>'.format(self.name)
+
+
+# The pattern_ops indexes only serve LIKE prefix searches on PostgreSQL;
+# on SQLite they would duplicate the unique indexes, so db.create_all()
+# drops them again there, as the migration 8d2e4b6c1f93 never makes them
+def drop_pattern_indexes(table):
+    for index in table.indexes:
+        if index.name.endswith('_pattern'):
+            event.listen(table, 'after_create', DDL(
+                'DROP INDEX {}'.format(index.name)
+            ).execute_if(dialect='sqlite'))
+
+
+for model in (Movies, Actors):
+    drop_pattern_indexes(model.__table__)
@@ -0,0 +1,144 @@
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import QueuePool
+
+
+logger = logging.getLogger(__name__)
+
+# Connection pool settings, per gunicorn worker process. Keep
+# workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) below the database's
+# connection limit. A sync worker serves one request at a time, the spare
+# connections cover streamed responses and gunicorn --threads.
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 2))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 3))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 10))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'true').lower() \
+    in ('1', 'true', 'yes')
+
+# Seconds between pool statistics log lines, 0 disables them
+POOL_STATS_LOG_INTERVAL = int(os.getenv('POOL_STATS_LOG_INTERVAL', 0))
+
+
+## Pool statistics
+'''
+PoolStats
+Counters fed by InstrumentedQueuePool: checkouts, time spent waiting for a
+connection, checkouts that opened an overflow connection and pool timeouts.
+'''
+class PoolStats:
+    def __init__(self, log_interval=POOL_STATS_LOG_INTERVAL):
+        self.log_interval = log_interval
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.overflow_checkouts = 0
+        self.overflow_max = 0
+        self.timeouts = 0
+        self.logged_at = time.monotonic()
+
+    def record_checkout(self, wait):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+        self._maybe_log()
+
+    def record_overflow(self, overflow):
+        with self._lock:
+            self.overflow_checkouts += 1
+            self.overflow_max = max(self.overflow_max, overflow)
+
+    def record_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+        self._maybe_log()
+
+    def snapshot(self, pool=None):
+        with self._lock:
+            stats = {
+                'checkouts': self.checkouts,
+                'wait_avg_ms': round(
+                    1000 * self.wait_total / self.checkouts, 3
+                ) if self.checkouts else 0,
+                'wait_max_ms': round(1000 * self.wait_max, 3),
+                'overflow_checkouts': self.overflow_checkouts,
+                'overflow_max': self.overflow_max,
+                'timeouts': self.timeouts
+            }
+        if isinstance(pool, QueuePool):
+            stats.update({
+                'size': pool.size(),
+                'checked_out': pool.checkedout(),
+                'overflow': max(pool.overflow(), 0)
+            })
+        return stats
+
+    def _maybe_log(self):
+        if not self.log_interval:
+            return
+        now = time.monotonic()
+        if now - self.logged_at >= self.log_interval:
+            self.logged_at = now
+            logger.info('pool stats %s', self.snapshot())
+
+
+pool_stats = PoolStats()
+
+
+## Instrumented pool
+'''
+InstrumentedQueuePool
+QueuePool that times every checkout through the public connect(),
+including the wait for a free connection, and counts in pool_stats the
+checkouts that opened a connection beyond pool_size and the timeouts. New
+connections are seen through the pool connect event.
+'''
+class InstrumentedQueuePool(QueuePool):
+    _opened = threading.local()
+
+    def connect(self):
+        self._opened.connection = False
+        start = time.perf_counter()
+        try:
+            connection = super().connect()
+        except TimeoutError:
+            pool_stats.record_timeout()
+            raise
+        pool_stats.record_checkout(time.perf_counter() - start)
+        if self._opened.connection and self.overflow() > 0:
+            pool_stats.record_overflow(self.overflow())
+        return connection
+
+
+# Flag the checkouts that open a new connection, for every instrumented pool
+# including the ones recreated by engine.dispose()
+@event.listens_for(InstrumentedQueuePool, 'connect')
+def connection_opened(dbapi_connection, connection_record):
+    InstrumentedQueuePool._opened.connection = True
+
+
+# SQLALCHEMY_ENGINE_OPTIONS for the given database URI. SQLite keeps the
+# pool Flask-SQLAlchemy picks for it, sizing options do not apply there.
+def engine_options(uri):
+    options = {
+        'pool_pre_ping': DB_POOL_PRE_PING,
+        'pool_recycle': DB_POOL_RECYCLE
+    }
+    if not uri.startswith('sqlite'):
+        options.update({
+            'poolclass': InstrumentedQueuePool,
+            'pool_size': DB_POOL_SIZE,
+            'max_overflow': DB_MAX_OVERFLOW,
+            'pool_timeout': DB_POOL_TIMEOUT
+        })
+    return options
@@ -0,0 +1,166 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask import g, has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, exc, orm, text
+
+
+# Seconds after a client's write during which its reads stay on the primary
+READ_YOUR_WRITES_WINDOW = float(os.getenv('READ_YOUR_WRITES_WINDOW', 5))
+
+# Seconds between replica health checks, and before retrying a failed one
+REPLICA_CHECK_INTERVAL = float(os.getenv('REPLICA_CHECK_INTERVAL', 30))
+
+# Clients remembered for read-your-writes by each worker
+RECENT_WRITERS_SIZE = 10000
+
+READ_METHODS = ('GET', 'HEAD')
+WRITE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+
+
+## Replica health
+'''
+ReplicaHealth
+Remembers whether the replica answered a SELECT 1 during the last
+REPLICA_CHECK_INTERVAL seconds. Any connection error on the replica marks it
+down until the next check, so reads fall back to the primary.
+'''
+class ReplicaHealth:
+    def __init__(self, interval=REPLICA_CHECK_INTERVAL):
+        self.interval = interval
+        self.healthy = False
+        self.checked_at = None
+        self._lock = threading.Lock()
+
+    def available(self, engine):
+        if self.checked_at is None or \
+                time.monotonic() - self.checked_at >= self.interval:
+            with self._lock:
+                if self.checked_at is None or \
+                        time.monotonic() - self.checked_at >= self.interval:
+                    self.healthy = self._ping(engine)
+                    self.checked_at = time.monotonic()
+        return self.healthy
+
+    def mark_down(self):
+        self.healthy = False
+        self.checked_at = time.monotonic()
+
+    @staticmethod
+    def _ping(engine):
+        try:
+            with engine.connect() as connection:
+                connection.execute(text('SELECT 1'))
+            return True
+        except Exception:
+            return False
+
+
+replica_health = ReplicaHealth()
+
+
+## Recent writers
+'''
+RecentWriters
+Last write time of each client of this worker, keyed by a hash of its
+Authorization header.
+'''
+class RecentWriters:
+    def __init__(self, maxsize=RECENT_WRITERS_SIZE):
+        self.maxsize = maxsize
+        self._writes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, client):
+        with self._lock:
+            self._writes[client] = time.time()
+            self._writes.move_to_end(client)
+            while len(self._writes) > self.maxsize:
+                self._writes.popitem(last=False)
+
+    def last_write(self, client):
+        with self._lock:
+            return self._writes.get(client, 0)
+
+
+recent_writers = RecentWriters()
+
+
+def client_key():
+    auth = request.headers.get('Authorization', '')
+    return hashlib.sha256(auth.encode()).hexdigest()
+
+
+# True if the current client wrote within the window
+def recently_wrote():
+    last_write = recent_writers.last_write(client_key())
+    return time.time() - last_write < READ_YOUR_WRITES_WINDOW
+
+
+## Routing session
+'''
+RoutingSession
+Session that sends the statements of requests flagged by route_reads() to
+the replica bind, and everything else, including any flush, to the primary.
+A read that fails on the replica marks it down and runs again on the
+primary, as does the rest of the request.
+'''
+class RoutingSession(SignallingSession):
+    def __init__(self, db, **options):
+        self.db = db
+        self._on_replica = False
+        SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and has_request_context() and \
+                g.get('read_replica', False):
+            engine = self.db.get_engine(self.app, bind='replica')
+            if replica_health.available(engine):
+                self._on_replica = True
+                return engine
+        return super().get_bind(mapper, clause)
+
+    def execute(self, statement, *args, **kwargs):
+        self._on_replica = False
+        try:
+            return super().execute(statement, *args, **kwargs)
+        except exc.OperationalError:
+            if not self._on_replica:
+                raise
+            replica_health.mark_down()
+            g.read_replica = False
+            return super().execute(statement, *args, **kwargs)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+# Register the request hooks that decide where each request reads from
+def init_replica(app, db):
+    if 'replica' not in app.config.get('SQLALCHEMY_BINDS', {}):
+        return
+
+    @app.before_request
+    def route_reads():
+        g.read_replica = request.method in READ_METHODS and \
+            not recently_wrote()
+
+    @app.after_request
+    def remember_writes(response):
+        if request.method in WRITE_METHODS and response.status_code < 400:
+            recent_writers.record(client_key())
+        return response
+
+    # a replica that fails mid-request is skipped until the next check
+    engine = db.get_engine(app, bind='replica')
+
+    @event.listens_for(engine, 'handle_error')
+    def replica_error(context):
+        if context.is_disconnect or context.connection is None:
+            replica_health.mark_down()
@@ -1,22 +1,538 @@
+import os
+import hashlib
+import json
+import sys
 from flask import (
-    Blueprint, request, abort, jsonify
+    Blueprint, request, abort, jsonify, Response, current_app,
+    stream_with_context
 )
 
-from casting.models import Actors, Movies
-from .auth import requires_auth
+from sqlalchemy import and_, func, select, tuple_
+from sqlalchemy.orm import selectinload
+from werkzeug.exceptions import HTTPException, InternalServerError
+from werkzeug.test import EnvironBuilder
+
+from casting import db
+from casting.models import (
+    Actors, Movies, bulk_insert, delete_by_id, delete_many, movie_actors,
+    set_cast,
+    table_version, unit_of_work, update_returning, upsert_rows
+)
+from . import auth
+from .auth import AuthError, requires_auth
+from .cache import response_cache
+from .fastjson import dumps, json_response
+from .pool import pool_stats
+from .search import SEARCH_MODELS, search_rows, search_terms
+from .stats import compute_stats, stats_versions
+from .transfer import export_csv, gzip_chunks
 
 
 bp = Blueprint('routes', __name__)
 
+# Hard limit on the rows returned by one page of a list endpoint
+MAX_PAGE_SIZE = int(os.getenv('MAX_PAGE_SIZE', 100))
+
+# Rows fetched from the server-side cursor and sent per chunk when streaming
+STREAM_BATCH_SIZE = int(os.getenv('STREAM_BATCH_SIZE', 1000))
+
+# Hard limit on the records accepted by one bulk request
+MAX_BULK_SIZE = int(os.getenv('MAX_BULK_SIZE', 10000))
+
+# Hard limit on the operations of one POST /batch request
+MAX_BATCH_SIZE = int(os.getenv('MAX_BATCH_SIZE', 100))
+
+NDJSON = 'application/x-ndjson'
+
+
+# Read an optional non-negative integer query parameter, 400 if invalid
+def int_arg(name, default=None):
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        abort(400)
+    if value < 0:
+        abort(400)
+    return value
+
+
+# Filters accepted by each list endpoint: query parameter -> (column, test).
+# Each one is served by an index from migration 8d2e4b6c1f93.
+FILTERS = {
+    'actors': {
+        'age_min': ('age', 'min'),
+        'age_max': ('age', 'max'),
+        'gender': ('gender', 'equal'),
+        'name': ('name', 'prefix'),
+    },
+    'movies': {
+        'release_date_min': ('release_date', 'min'),
+        'release_date_max': ('release_date', 'max'),
+        'title': ('title', 'prefix'),
+    }
+}
+
+# Columns accepted by ?sort=, prefix with - for descending order
+SORTS = {
+    'actors': ('id', 'name', 'age'),
+    'movies': ('id', 'title', 'release_date'),
+}
+
+
+# SQL condition for "column starts with prefix". On SQLite the range lets
+# the btree index find the rows and substr keeps the match exact; trailing
+# U+10FFFF characters have no successor and are left out of the upper
+# bound, which a prefix of only those does not have. PostgreSQL uses LIKE,
+# served by the pattern_ops indexes whatever the collation.
+def prefix_condition(column, prefix):
+    if db.engine.dialect.name == 'postgresql':
+        escaped = prefix.replace('\\', '\\\\') \
+            .replace('%', '\\%').replace('_', '\\_')
+        return column.like(escaped + '%', escape='\\')
+    conditions = [
+        column >= prefix,
+        func.substr(column, 1, len(prefix)) == prefix
+    ]
+    stem = prefix.rstrip(chr(sys.maxunicode))
+    if stem:
+        conditions.append(column < stem[:-1] + chr(ord(stem[-1]) + 1))
+    return and_(*conditions)
+
+
+# Read the filter query parameters of a list endpoint, 400 if invalid
+def filter_args(model):
+    conditions = []
+    for name, (field, test) in FILTERS[model.__tablename__].items():
+        if name not in request.args:
+            continue
+        column = getattr(model, field)
+        if test == 'min':
+            conditions.append(column >= int_arg(name))
+        elif test == 'max':
+            conditions.append(column <= int_arg(name))
+        else:
+            value = request.args[name]
+            if not value:
+                abort(400)
+            if test == 'equal':
+                conditions.append(column == value)
+            else:
+                conditions.append(prefix_condition(column, value))
+    return conditions
+
+
+# Read the ?limit=, ?after_id=, ?offset= and ?sort= page parameters
+def page_args(model):
+    limit = min(int_arg('limit', MAX_PAGE_SIZE), MAX_PAGE_SIZE)
+    after_id = int_arg('after_id')
+    offset = int_arg('offset')
+    if limit == 0 or (after_id is not None and offset is not None):
+        abort(400)
+
+    sort = request.args.get('sort', 'id')
+    descending = sort.startswith('-')
+    sort = sort[1:] if descending else sort
+    if sort not in SORTS[model.__tablename__]:
+        abort(400)
+    return limit, after_id, offset, getattr(model, sort), descending
+
+
+# Read the ?include= parameter, a comma separated list of the relations in
+# model.INCLUDES, 400 if invalid
+def include_args(model):
+    value = request.args.get('include')
+    if value is None:
+        return []
+    names = value.split(',')
+    if any(name not in model.INCLUDES for name in names):
+        abort(400)
+    return names
+
+
+# Read the ?ids= parameter, comma separated ids, 400 if invalid and 413 if
+# there are more than maximum (MAX_PAGE_SIZE). Repeated ids are read once.
+def ids_arg(maximum=None):
+    if maximum is None:
+        maximum = MAX_PAGE_SIZE
+    try:
+        ids = [int(value) for value in request.args['ids'].split(',')]
+    except ValueError:
+        abort(400)
+    if any(id < 0 for id in ids):
+        abort(400)
+    ids = list(dict.fromkeys(ids))
+    if len(ids) > maximum:
+        abort(413)
+    return ids
+
+
+# Delete the rows given by ?ids= or by the ?id_min= and ?id_max= range in
+# one transaction, or with ?dry_run=true only report them, 413 if that is
+# more than MAX_BULK_SIZE rows. Returns the count and the ids.
+def bulk_delete(model):
+    dry_run = request.args.get('dry_run', 'false').lower() == 'true'
+    id_min = int_arg('id_min')
+    id_max = int_arg('id_max')
+    if 'ids' in request.args:
+        if id_min is not None or id_max is not None:
+            abort(400)
+        ids, id_range = ids_arg(MAX_BULK_SIZE), None
+    elif id_min is not None and id_max is not None and id_min <= id_max:
+        ids, id_range = None, (id_min, id_max)
+    else:
+        abort(400)
+
+    # use the try-except method to delete the rows
+    try:
+        deleted = delete_many(model, ids, id_range, dry_run, MAX_BULK_SIZE)
+
+    # a range over MAX_BULK_SIZE rows is refused, nothing was deleted
+    except ValueError:
+        abort(413)
+
+    # if the delete fails, nothing was deleted
+    except Exception:
+        abort(422)
+
+    return jsonify({
+        'success': True,
+        'dry_run': dry_run,
+        'deleted': len(deleted),
+        'ids': deleted
+    })
+
+
+# SELECT of the columns returned by model.read(). The list endpoints read
+# plain row tuples, skipping ORM instances and the identity map.
+def read_query(model, filters=()):
+    columns = [getattr(model, name) for name in model.READ_COLUMNS]
+    return select(*columns).where(*filters)
+
+
+# Return one page of rows and the cursor of the next page.
+# Keyset by default (WHERE id > :after_id ORDER BY id LIMIT :limit) so deep
+# pages cost the same as the first one; ?offset= is kept as a fallback.
+# When sorting on another column the cursor is still the last id: its sort
+# value is looked up and the page continues after (value, id), with id as
+# the tie breaker.
+def paginate(query, model, page):
+    limit, after_id, offset, column, descending = page
+    if column is model.id:
+        keys = [model.id]
+    else:
+        keys = [column, model.id]
+    query = query.order_by(*[key.desc() if descending else key for key in keys])
+
+    if after_id is not None:
+        cursor = [after_id]
+        if column is not model.id:
+            row = db.session.execute(
+                select(column).where(model.id == after_id)
+            ).first()
+            if row is None:
+                abort(404)
+            cursor = [row[0], after_id]
+        if descending:
+            query = query.where(tuple_(*keys) < tuple_(*cursor))
+        else:
+            query = query.where(tuple_(*keys) > tuple_(*cursor))
+    elif offset is not None:
+        query = query.offset(offset)
+
+    # fetch one extra row to know whether there is a next page
+    rows = db.session.execute(query.limit(limit + 1)).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1].id
+    return rows, next_cursor
+
+
+# Read the rows with these ids in one WHERE id IN (...) query. Returns them
+# in the order of ids, and the ids that do not exist.
+def rows_by_id(model, ids):
+    by_id = {
+        row.id: row for row in
+        db.session.execute(read_query(model).where(model.id.in_(ids)))
+    }
+    rows = [by_id[id] for id in ids if id in by_id]
+    missing = [id for id in ids if id not in by_id]
+    return rows, missing
+
+
+# Rows of a page as dicts with the included relations. The page is loaded
+# again as instances with selectinload, so it takes one query for the
+# instances and one per relation, whatever the page size.
+def include_relations(model, rows, include):
+    items = [row._asdict() for row in rows]
+    if not include or not items:
+        return items
+    objects = db.session.execute(
+        select(model)
+        .where(model.id.in_([item['id'] for item in items]))
+        .options(*[selectinload(getattr(model, name)) for name in include])
+    ).scalars()
+    by_id = {obj.id: obj for obj in objects}
+    for item in items:
+        obj = by_id.get(item['id'])
+        for name in include:
+            related = getattr(obj, name) if obj is not None else []
+            item[name] = [other.read() for other in related]
+    return items
+
+
+# movie_actors column holding the ids of model
+def link_column(model):
+    for column in movie_actors.c:
+        if column.references(model.__table__.c.id):
+            return column
+
+
+# Rows of the related model linked to the row with this id through
+# movie_actors, in id order, 404 if there is no such row
+def linked_rows(model, id, related):
+    if db.session.execute(select(model.id).where(model.id == id)).first() \
+            is None:
+        abort(404)
+    query = read_query(related) \
+        .join(movie_actors, link_column(related) == related.id) \
+        .where(link_column(model) == id) \
+        .order_by(related.id)
+    return db.session.execute(query).all()
+
+
+# True if the client asked for newline delimited JSON (Accept header)
+def wants_ndjson():
+    best = request.accept_mimetypes.best_match(['application/json', NDJSON])
+    return best == NDJSON
+
+
+# Stream every row after the optional ?after_id= cursor as NDJSON.
+# Rows come from a server-side cursor in STREAM_BATCH_SIZE batches and are
+# sent as they are read, so worker memory does not grow with the table.
+def stream_rows(query, model):
+    after_id = int_arg('after_id')
+    query = query.order_by(model.id)
+    if after_id is not None:
+        query = query.where(model.id > after_id)
+    result = db.session.execute(
+        query, execution_options={'stream_results': True}
+    )
+
+    def generate():
+        for rows in result.partitions(STREAM_BATCH_SIZE):
+            yield b''.join(dumps(row._asdict()) + b'\n' for row in rows)
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON)
+
+
+# Stream the whole table as a CSV download, gzip compressed when the client
+# accepts it. Rows are read and sent EXPORT_CHUNK_SIZE at a time.
+def export_response(model):
+    chunks = export_csv(model)
+    compress = request.accept_encodings['gzip'] > 0
+    if compress:
+        chunks = gzip_chunks(chunks)
+    response = Response(stream_with_context(chunks), mimetype='text/csv')
+    response.headers['Content-Disposition'] = \
+        'attachment; filename={}.csv'.format(model.__tablename__)
+    response.vary.add('Accept-Encoding')
+    if compress:
+        response.content_encoding = 'gzip'
+    return response
+
+
+# Models of the relations added with ?include=
+def included_models(model, include):
+    return [getattr(model, name).property.mapper.class_ for name in include]
+
+
+# Strong ETag of a read response. It changes with the table version, and
+# with the versions of the included relations' tables, and differs between
+# URLs (pages, items) and representations (JSON or NDJSON).
+def list_etag(model, include=()):
+    versions = [
+        '{}:{}'.format(other.__tablename__, table_version(other))
+        for other in [model] + included_models(model, include)
+    ]
+    key = '{}:{}:{}'.format(
+        ','.join(versions), request.full_path, wants_ndjson()
+    )
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+# 304 answer for a client that already holds the current representation
+def not_modified(etag):
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+
+# Response cache key of a list page or item. The ETag already covers the
+# table version, the URL and the representation. A list or item response
+# does not vary by caller: requires_auth checks the read permission before
+# the cache is looked up, and every caller allowed gets the same body.
+def cache_key(model, etag):
+    return (request.endpoint, etag)
+
+
+# Cached JSON page for this request, or None
+def cached_page(model, etag):
+    body = response_cache.get(cache_key(model, etag))
+    if body is None:
+        return None
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    return response
+
+
+# A page read inside a transaction with uncommitted writes (a GET of a
+# POST /batch) is not cached: its version may be rolled back and reused.
+# A page with included relations is dropped by a write on their tables too.
+def cache_page(model, etag, response, include=()):
+    if db.session.info.get('changed_tables'):
+        return
+    tables = [model.__tablename__] + [
+        other.__tablename__ for other in included_models(model, include)
+    ]
+    response_cache.put(cache_key(model, etag), tables, response.get_data())
+
+
+# Validate every record of the JSON array of a bulk request, returns the
+# valid records, their positions in the array and the errors of the others
+def bulk_records(model):
+    data = request.get_json(silent=True)
+    if not isinstance(data, list) or len(data) == 0:
+        abort(400)
+    if len(data) > MAX_BULK_SIZE:
+        abort(413)
+
+    records = []
+    positions = []
+    errors = []
+    for index, item in enumerate(data):
+        values, problems = model.validate(item)
+        if problems:
+            errors.append({'index': index, 'errors': problems})
+        else:
+            records.append(values)
+            positions.append(index)
+    return data, records, positions, errors
+
+
+# Validate every record of a JSON array up front, insert the valid ones in a
+# single transaction and report, in request order, the new ids (null for a
+# rejected record) and the errors of each rejected record. A record whose
+# natural key is taken, or repeats an earlier record's, is rejected too.
+def bulk_create(model):
+    data, records, positions, errors = bulk_records(model)
+
+    # use the try-except method to insert the data
+    try:
+        created = bulk_insert(model, records)
+
+    # if insert fails, nothing was written
+    except Exception:
+        abort(422)
+
+    ids = [None] * len(data)
+    for index, id in zip(positions, created):
+        if id is None:
+            errors.append({'index': index, 'errors': [
+                'duplicate ' + ' and '.join(model.NATURAL_KEY)
+            ]})
+        ids[index] = id
+    errors.sort(key=lambda error: error['index'])
+
+    return jsonify({
+        'success': True,
+        'created': sum(id is not None for id in created),
+        'ids': ids,
+        'errors': errors
+    })
+
+
+# Insert or update the valid records of a JSON array by their natural key
+# in a single transaction. A record repeating the key of an earlier one is
+# rejected. Reports the inserted, updated and unchanged counts and the
+# errors of each rejected record.
+def bulk_upsert(model):
+    data, records, positions, errors = bulk_records(model)
+
+    unique = []
+    seen = {}
+    for index, values in zip(positions, records):
+        key = tuple(values[name] for name in model.NATURAL_KEY)
+        if key in seen:
+            errors.append({'index': index, 'errors': [
+                'duplicate of record {}'.format(seen[key])
+            ]})
+        else:
+            seen[key] = index
+            unique.append(values)
+    errors.sort(key=lambda error: error['index'])
+
+    # use the try-except method to write the data
+    try:
+        counts = upsert_rows(model, unique)
+
+    # if the upsert fails, nothing was written
+    except Exception:
+        abort(422)
+
+    return jsonify(dict(counts, success=True, errors=errors))
+
+
 @bp.route('/actors', methods=['GET'], endpoint='get_actors')
 @requires_auth('get:actors')
 def read_all_actors(jwt):
 
+    # read the filter and page parameters first so bad values give a 400
+    filters = filter_args(Actors)
+    page = page_args(Actors)
+    include = include_args(Actors)
+    ids = ids_arg() if 'ids' in request.args else None
+
+    # answer from the table version alone if the client is up to date
+    etag = list_etag(Actors, include)
+    if etag in request.if_none_match:
+        return not_modified(etag)
+
+    # stream the whole table when the client accepts NDJSON
+    if wants_ndjson() and ids is None:
+        if include:
+            abort(400)
+        response = stream_rows(read_query(Actors, filters), Actors)
+        response.set_etag(etag)
+        return response
+
+    # serve the page already serialized by a previous request
+    response = cached_page(Actors, etag)
+    if response is not None:
+        return response
+
+    # read the actors with these ids, in the order asked
+    if ids is not None:
+        rows, missing = rows_by_id(Actors, ids)
+        response = json_response({
+            'success': True,
+            'actors': include_relations(Actors, rows, include),
+            'missing': missing
+        })
+        response.set_etag(etag)
+        cache_page(Actors, etag, response, include)
+        return response
+
     # using the try-except method to create the query
     try:
 
-        # create the query actors order by id
-        query_actors = Actors.query.all()
+        # create the filtered query actors, one page at a time
+        query_actors, next_cursor = paginate(
+            read_query(Actors, filters), Actors, page
+        )
 
         # check if the query has no results and abort
         if len(query_actors) == 0:
@@ -25,15 +541,54 @@ def read_all_actors(jwt):
         # if has results, return them
         else:
 
-            return jsonify({
+            response = json_response({
                 'success': True,
-                'actors': [actor.read() for actor in query_actors]
+                'actors': include_relations(Actors, query_actors, include),
+                'next_cursor': next_cursor
             })
+            response.set_etag(etag)
+            cache_page(Actors, etag, response, include)
+            return response
 
     # if the query fails, abort
     except:
         abort(404)
 
+@bp.route('/actors/export', methods=['GET'], endpoint='export_actors')
+@requires_auth('get:actors')
+def export_actors(jwt):
+
+    # stream every actor as CSV
+    return export_response(Actors)
+
+@bp.route('/actors/<int:id>', methods=['GET'], endpoint='get_actor')
+@requires_auth('get:actors')
+def read_actor(jwt, id):
+
+    # answer from the table version alone if the client is up to date
+    etag = list_etag(Actors)
+    if etag in request.if_none_match:
+        return not_modified(etag)
+
+    # serve the actor already serialized by a previous request
+    response = cached_page(Actors, etag)
+    if response is not None:
+        return response
+
+    # the identity map answers without a query if the actor is loaded
+    actor = db.session.get(Actors, id)
+    if actor is None:
+        abort(404)
+
+    response = json_response({
+        'success': True,
+        'actors': [actor.read()]
+    })
+    response.set_etag(etag)
+    cache_page(Actors, etag, response)
+    return response
+
+
 @bp.route('/actors', methods=['POST'], endpoint='post_actor')
 @requires_auth('post:actors')
 def create_actor(jwt):
@@ -61,6 +616,23 @@ def create_actor(jwt):
     except:
         abort(400)
 
+@bp.route('/actors/bulk', methods=['POST'], endpoint='post_actors_bulk')
+@requires_auth('post:actors')
+def create_actors_bulk(jwt):
+
+    # create all the actors of the JSON array in one transaction
+    return bulk_create(Actors)
+
+@bp.route('/actors', methods=['PUT'], endpoint='put_actors')
+@requires_auth('post:actors')
+def upsert_actors(jwt):
+
+    # existing actors are updated, which needs the patch permission too
+    auth.check_permissions('patch:actors', jwt)
+
+    # insert or update the actors of the JSON array by name
+    return bulk_upsert(Actors)
+
 @bp.route('/actors/<id>', methods=['PATCH'])
 @requires_auth('patch:actors')
 def update_actor(jwt, id):
@@ -72,63 +644,74 @@ def update_actor(jwt, id):
     age_update = data.get('age')
     gender_update = data.get('gender')
 
-    # use the try-except method to insert the data
+    # use the try-except method to update the data
     try:
 
-        # create the query drink using requested id
-        query_actors = Actors.query.get(id_update)
+        # update the actor and read it back in a single statement
+        query_actors = update_returning(Actors, id_update, {
+            'name': name_update,
+            'age': age_update,
+            'gender': gender_update
+        })
 
-        # update query title and recipe
-        query_actors.name = name_update
-        query_actors.age = age_update
-        query_actors.gender = gender_update
+    # if the update fails, abort
+    except:
+        abort(422)
 
-        # if the query drink is not empty, update the drink
-        if query_actors is not None:
+    # if there is no actor with this id, abort
+    if query_actors is None:
+        abort(404)
 
-            query_actors.update()
+    # return the JSON object with the updated actor
+    return jsonify({
+        'success': True,
+        'actors': [query_actors._asdict()]
+    })
 
-            # return the JSON object with the long drink
-            return jsonify({
-                'success': True,
-                'actors': [query_actors.read()]
-            })
+@bp.route('/actors', methods=['DELETE'], endpoint='delete_actors')
+@requires_auth('delete:actors')
+def delete_actors(jwt):
 
-        # if there are no results, abort
-        else:
-            abort(404)
-
-    # if the query fails, abort
-    except:
-        abort(422)
+    # delete the actors of an id list or range in one transaction
+    return bulk_delete(Actors)
 
 @bp.route('/actors/<int:id>', methods=['DELETE'])
 @requires_auth('delete:actors')
 def delete_actor(jwt, id):
 
-    # using the try-except method to delete the movie
+    # using the try-except method to delete the actor
     try:
 
-        # create the query drinks with the the id
-        query_actors = Actors.query.get(id)
+        # delete the actor with the id in a single statement
+        deleted = delete_by_id(Actors, id)
 
-        # if the drink is not empty, delete the drink
-        if query_actors is not None:
-            query_actors.delete()
+    # if the delete fails, abort
+    except Exception:
+        abort(404)
 
-            # return the JSON object with the long drink
-            return jsonify({
-                'success': True,
-                'delete': id
-            })
+    # if there was no actor with this id, abort
+    if not deleted:
+        abort(404)
 
-        # if the quere is empty, abort
-        else:
-            abort(404)
+    # return the JSON object with the deleted id
+    return jsonify({
+        'success': True,
+        'delete': id
+    })
 
-    # if the query fails, abort
-    except Exception:
-        abort(404)
+@bp.route('/actors/<int:id>/movies', methods=['GET'],
+          endpoint='get_actor_movies')
+@requires_auth('get:actors')
+def read_actor_movies(jwt, id):
+
+    # read the movies of the actor, 404 if there is no such actor
+    movies = linked_rows(Actors, id, Movies)
+
+    return json_response({
+        'success': True,
+        'actor': id,
+        'movies': [movie._asdict() for movie in movies]
+    })
 
 # Movies routes
 
@@ -136,11 +719,49 @@ def delete_actor(jwt, id):
 @requires_auth('get:movies')
 def read_all_movies(jwt):
 
+    # read the filter and page parameters first so bad values give a 400
+    filters = filter_args(Movies)
+    page = page_args(Movies)
+    include = include_args(Movies)
+    ids = ids_arg() if 'ids' in request.args else None
+
+    # answer from the table version alone if the client is up to date
+    etag = list_etag(Movies, include)
+    if etag in request.if_none_match:
+        return not_modified(etag)
+
+    # stream the whole table when the client accepts NDJSON
+    if wants_ndjson() and ids is None:
+        if include:
+            abort(400)
+        response = stream_rows(read_query(Movies, filters), Movies)
+        response.set_etag(etag)
+        return response
+
+    # serve the page already serialized by a previous request
+    response = cached_page(Movies, etag)
+    if response is not None:
+        return response
+
+    # read the movies with these ids, in the order asked
+    if ids is not None:
+        rows, missing = rows_by_id(Movies, ids)
+        response = json_response({
+            'success': True,
+            'movies': include_relations(Movies, rows, include),
+            'missing': missing
+        })
+        response.set_etag(etag)
+        cache_page(Movies, etag, response, include)
+        return response
+
     # using the try-except method to create the query
     try:
 
-        # create the query movies order by id
-        query_movies = Movies.query.all()
+        # create the filtered query movies, one page at a time
+        query_movies, next_cursor = paginate(
+            read_query(Movies, filters), Movies, page
+        )
 
         # check if the query has no results and abort
         if len(query_movies) == 0:
@@ -149,10 +770,14 @@ def read_all_movies(jwt):
         # if has results, return them
         else:
 
-            return jsonify({
+            response = json_response({
                 'success': True,
-                'movies': [movie.read() for movie in query_movies]
+                'movies': include_relations(Movies, query_movies, include),
+                'next_cursor': next_cursor
             })
+            response.set_etag(etag)
+            cache_page(Movies, etag, response, include)
+            return response
 
     # if the query fails, abort
     except:
@@ -161,6 +786,43 @@ def read_all_movies(jwt):
 
 
 
+@bp.route('/movies/export', methods=['GET'], endpoint='export_movies')
+@requires_auth('get:movies')
+def export_movies(jwt):
+
+    # stream every movie as CSV
+    return export_response(Movies)
+
+
+@bp.route('/movies/<int:id>', methods=['GET'], endpoint='get_movie')
+@requires_auth('get:movies')
+def read_movie(jwt, id):
+
+    # answer from the table version alone if the client is up to date
+    etag = list_etag(Movies)
+    if etag in request.if_none_match:
+        return not_modified(etag)
+
+    # serve the movie already serialized by a previous request
+    response = cached_page(Movies, etag)
+    if response is not None:
+        return response
+
+    # the identity map answers without a query if the movie is loaded
+    movie = db.session.get(Movies, id)
+    if movie is None:
+        abort(404)
+
+    response = json_response({
+        'success': True,
+        'movies': [movie.read()]
+    })
+    response.set_etag(etag)
+    cache_page(Movies, etag, response)
+    return response
+
+
+
 @bp.route('/movies', methods=['POST'], endpoint='post_movie')
 @requires_auth('post:movies')
 def create_movie(jwt):
@@ -189,6 +851,24 @@ def create_movie(jwt):
 
 
 
+@bp.route('/movies/bulk', methods=['POST'], endpoint='post_movies_bulk')
+@requires_auth('post:movies')
+def create_movies_bulk(jwt):
+
+    # create all the movies of the JSON array in one transaction
+    return bulk_create(Movies)
+
+
+@bp.route('/movies', methods=['PUT'], endpoint='put_movies')
+@requires_auth('post:movies')
+def upsert_movies(jwt):
+
+    # existing movies are updated, which needs the patch permission too
+    auth.check_permissions('patch:movies', jwt)
+
+    # insert or update the movies of the JSON array by title and release date
+    return bulk_upsert(Movies)
+
 @bp.route('/movies/<id>', methods=['PATCH'])
 @requires_auth('patch:movies')
 def update_movie(jwt, id):
@@ -199,34 +879,36 @@ def update_movie(jwt, id):
     title_update = data.get('title')
     release_date_update = data.get('release_date')
 
-    # use the try-except method to insert the data
+    # use the try-except method to update the data
     try:
 
-        # create the query drink using requested id
-        query_movies = Movies.query.get(id_update)
+        # update the movie and read it back in a single statement
+        query_movies = update_returning(Movies, id_update, {
+            'title': title_update,
+            'release_date': release_date_update
+        })
 
-        # update query title and recipe
-        query_movies.title = title_update
-        query_movies.release_date = release_date_update
+    # if the update fails, abort
+    except:
+        abort(422)
 
-        # if the query drink is not empty, update the drink
-        if query_movies is not None:
+    # if there is no movie with this id, abort
+    if query_movies is None:
+        abort(404)
 
-            query_movies.update()
+    # return the JSON object with the updated movie
+    return jsonify({
+        'success': True,
+        'movies': [query_movies._asdict()]
+    })
 
-            # return the JSON object with the long drink
-            return jsonify({
-                'success': True,
-                'movies': [query_movies.read()]
-            })
 
-        # if there are no results, abort
-        else:
-            abort(404)
+@bp.route('/movies', methods=['DELETE'], endpoint='delete_movies')
+@requires_auth('delete:movies')
+def delete_movies(jwt):
 
-    # if the query fails, abort
-    except:
-        abort(422)
+    # delete the movies of an id list or range in one transaction
+    return bulk_delete(Movies)
 
 
 @bp.route('/movies/<int:id>', methods=['DELETE'])
@@ -236,26 +918,241 @@ def delete_movie(jwt, id):
     # using the try-except method to delete the movie
     try:
 
-        # create the query drinks with the the id
-        query_movies = Movies.query.get(id)
+        # delete the movie with the id in a single statement
+        deleted = delete_by_id(Movies, id)
 
-        # if the drink is not empty, delete the drink
-        if query_movies is not None:
-            query_movies.delete()
+    # if the delete fails, abort
+    except Exception:
+        abort(404)
 
-            # return the JSON object with the long drink
-            return jsonify({
-                'success': True,
-                'delete': id
-            })
+    # if there was no movie with this id, abort
+    if not deleted:
+        abort(404)
 
-        # if the quere is empty, abort
-        else:
-            abort(404)
+    # return the JSON object with the deleted id
+    return jsonify({
+        'success': True,
+        'delete': id
+    })
 
-    # if the query fails, abort
+
+@bp.route('/movies/<int:id>/cast', methods=['GET'], endpoint='get_movie_cast')
+@requires_auth('get:movies')
+def read_movie_cast(jwt, id):
+
+    # read the actors of the movie, 404 if there is no such movie
+    cast = linked_rows(Movies, id, Actors)
+
+    return json_response({
+        'success': True,
+        'movie': id,
+        'cast': [actor._asdict() for actor in cast]
+    })
+
+
+@bp.route('/movies/<int:id>/cast', methods=['PUT'], endpoint='put_movie_cast')
+@requires_auth('patch:movies')
+def update_movie_cast(jwt, id):
+
+    # retrieve the actor ids of the new cast
+    data = request.get_json(silent=True)
+    actor_ids = data.get('actors') if isinstance(data, dict) else None
+    if not isinstance(actor_ids, list) or not all(
+        isinstance(actor_id, int) and not isinstance(actor_id, bool)
+        for actor_id in actor_ids
+    ):
+        abort(400)
+
+    # use the try-except method to replace the cast
+    try:
+        found = set_cast(id, actor_ids)
+
+    # if an actor does not exist, abort
     except Exception:
+        abort(422)
+
+    # if there is no movie with this id, abort
+    if not found:
         abort(404)
 
+    # return the JSON object with the new cast
+    cast = linked_rows(Movies, id, Actors)
+    return jsonify({
+        'success': True,
+        'movie': id,
+        'cast': [actor._asdict() for actor in cast]
+    })
+
+
+# Statistics
+
+@bp.route('/stats', methods=['GET'], endpoint='get_stats')
+@requires_auth('get:actors')
+def read_stats(jwt):
+
+    # the statistics cover both tables
+    auth.check_permissions('get:movies', jwt)
+
+    # serve the statistics already computed for the current table versions,
+    # any write on actors or movies changes the key
+    versions = stats_versions()
+    key = (request.endpoint, versions)
+    body = response_cache.get(key)
+    if body is not None:
+        return Response(body, mimetype='application/json')
+
+    stats, current = compute_stats(versions)
+    response = json_response(dict(stats, success=True))
+    if current and not db.session.info.get('changed_tables'):
+        response_cache.put(key, ('actors', 'movies'), response.get_data())
+    return response
+
+
+# Search
+
+@bp.route('/search', methods=['GET'], endpoint='get_search')
+def search():
+
+    # search the tables asked with ?type=, or all the token may read
+    payload = auth.verified_payload()
+    kind = request.args.get('type')
+    if kind is None:
+        tables = [
+            table for table in SEARCH_MODELS
+            if 'get:' + table in payload.get('permissions', ())
+        ]
+        if not tables:
+            auth.check_permissions('get:movies', payload)
+    elif kind in SEARCH_MODELS:
+        auth.check_permissions('get:' + kind, payload)
+        tables = [kind]
+    else:
+        abort(400)
 
+    # read the query and page parameters first so bad values give a 400
+    terms = search_terms(request.args.get('q', ''))
+    if not terms:
+        abort(400)
+    limit = min(int_arg('limit', MAX_PAGE_SIZE), MAX_PAGE_SIZE)
+    offset = int_arg('offset', 0)
+    if limit == 0:
+        abort(400)
 
+    # fetch one extra row to know whether there is a next page
+    rows = search_rows(tables, terms, limit + 1, offset)
+    next_offset = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_offset = offset + limit
+
+    return json_response({
+        'success': True,
+        'results': rows,
+        'next_offset': next_offset
+    })
+
+
+# Batch
+
+# Status of the operations of an atomic batch left out after a failure
+FAILED_DEPENDENCY = 424
+
+
+class BatchRollback(Exception):
+    pass
+
+
+# Run one operation of a batch, {"method", "path", "body"}, through the view
+# of the route it targets, in a request context of its own. The permission
+# of the route is checked against the payload of the batch token, which was
+# verified once. Returns the status code and JSON body of the response.
+def run_operation(operation, payload):
+    app = current_app._get_current_object()
+    if not isinstance(operation, dict) or \
+            not isinstance(operation.get('path'), str):
+        return {'status': 400, 'body': None}
+
+    builder = EnvironBuilder(
+        path=operation['path'],
+        base_url=request.url_root,
+        method=str(operation.get('method', 'GET')).upper(),
+        headers={'Authorization': request.headers.get('Authorization', '')},
+        data=json.dumps(operation['body']) if 'body' in operation else None,
+        content_type='application/json'
+    )
+    with app.request_context(builder.get_environ()):
+        try:
+            if request.routing_exception is not None:
+                raise request.routing_exception
+            view = app.view_functions[request.endpoint]
+            if view is run_batch or not hasattr(view, 'permission'):
+                abort(400)
+            auth.check_permissions(view.permission, payload)
+            rv = view.__wrapped__(payload, **request.view_args)
+        except (HTTPException, AuthError) as error:
+            rv = app.handle_user_exception(error)
+
+        # any other error fails this operation only, logged like Flask does
+        except Exception:
+            app.log_exception(sys.exc_info())
+            rv = app.handle_http_exception(InternalServerError())
+        response = app.make_response(rv)
+    return {'status': response.status_code, 'body': response.get_json()}
+
+
+@bp.route('/batch', methods=['POST'], endpoint='post_batch')
+def run_batch():
+
+    # verify the token once for every operation of the batch
+    payload = auth.verified_payload()
+
+    # read the operations, a JSON array, and the transaction mode
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        abort(400)
+    operations = data.get('operations')
+    atomic = data.get('atomic', True)
+    if not isinstance(operations, list) or len(operations) == 0 or \
+            not isinstance(atomic, bool):
+        abort(400)
+    if len(operations) > MAX_BATCH_SIZE:
+        abort(413)
+
+    # independent operations commit one by one, whatever the others do
+    if not atomic:
+        results = [run_operation(operation, payload) for operation in operations]
+
+    # atomic operations commit together, the first failure rolls back all
+    else:
+        results = []
+        try:
+            with unit_of_work():
+                for operation in operations:
+                    results.append(run_operation(operation, payload))
+                    if results[-1]['status'] >= 400:
+                        raise BatchRollback()
+        except BatchRollback:
+            results += [{'status': FAILED_DEPENDENCY, 'body': None}] * \
+                (len(operations) - len(results))
+
+    return jsonify({
+        'success': all(result['status'] < 400 for result in results),
+        'atomic': atomic,
+        'results': results
+    })
+
+
+# Internal statistics
+
+@bp.route('/internal/stats', methods=['GET'], endpoint='get_internal_stats')
+@requires_auth('get:stats')
+def read_internal_stats(jwt):
+
+    # counters of this worker process only
+    return jsonify({
+        'success': True,
+        'pid': os.getpid(),
+        'pool': pool_stats.snapshot(db.engine.pool),
+        'token_cache': auth.token_cache.stats(),
+        'response_cache': response_cache.stats()
+    })
@@ -0,0 +1,116 @@
+import re
+
+from sqlalchemy import DDL, event, select, text
+
+from casting import db
+from casting.models import Actors, Movies
+
+
+# Searchable models and their text column, by table name
+SEARCH_MODELS = {
+    'movies': (Movies, 'title'),
+    'actors': (Actors, 'name'),
+}
+
+# SQLite: an external content FTS5 table per searched table, kept in sync by
+# triggers so every write path (ORM, bulk insert, single statement writes)
+# updates it in the same transaction
+SQLITE_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS {table}_search "
+    "USING fts5({column}, content='{table}', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS {table}_search_insert "
+    "AFTER INSERT ON {table} BEGIN "
+    "INSERT INTO {table}_search(rowid, {column}) "
+    "VALUES (new.id, new.{column}); END",
+    "CREATE TRIGGER IF NOT EXISTS {table}_search_delete "
+    "AFTER DELETE ON {table} BEGIN "
+    "INSERT INTO {table}_search({table}_search, rowid, {column}) "
+    "VALUES ('delete', old.id, old.{column}); END",
+    "CREATE TRIGGER IF NOT EXISTS {table}_search_update "
+    "AFTER UPDATE OF {column} ON {table} BEGIN "
+    "INSERT INTO {table}_search({table}_search, rowid, {column}) "
+    "VALUES ('delete', old.id, old.{column}); "
+    "INSERT INTO {table}_search(rowid, {column}) "
+    "VALUES (new.id, new.{column}); END",
+    "INSERT INTO {table}_search({table}_search) VALUES ('rebuild')",
+)
+
+# PostgreSQL: a generated tsvector column with a GIN index, computed by the
+# database on every insert and update
+POSTGRESQL_DDL = (
+    "ALTER TABLE {table} ADD COLUMN search_vector tsvector "
+    "GENERATED ALWAYS AS (to_tsvector('simple', {column})) STORED",
+    "CREATE INDEX ix_{table}_search ON {table} USING gin (search_vector)",
+)
+
+
+# Create the search index along with the table in db.create_all(), the
+# migration 9a4c6e1d2b57 does the same for existing databases
+def register_search_index(model, column):
+    table = model.__table__
+    for statement in SQLITE_DDL:
+        event.listen(table, 'after_create', DDL(
+            statement.format(table=table.name, column=column)
+        ).execute_if(dialect='sqlite'))
+    for statement in POSTGRESQL_DDL:
+        event.listen(table, 'after_create', DDL(
+            statement.format(table=table.name, column=column)
+        ).execute_if(dialect='postgresql'))
+    # the FTS5 table is not in the metadata, drop_all() would leave it behind
+    event.listen(table, 'before_drop', DDL(
+        'DROP TABLE IF EXISTS {}_search'.format(table.name)
+    ).execute_if(dialect='sqlite'))
+
+
+for model, column in SEARCH_MODELS.values():
+    register_search_index(model, column)
+
+
+# Words of a search query, punctuation and operators are ignored
+def search_terms(query):
+    return re.findall(r'\w+', query)
+
+
+# Return one page of (table, id) of the rows matching every term as a
+# prefix, best match first
+def ranked_ids(tables, terms, limit, offset):
+    if db.engine.dialect.name == 'postgresql':
+        query = ' & '.join(term + ':*' for term in terms)
+        part = (
+            "SELECT '{table}' AS type, id, "
+            "ts_rank(search_vector, to_tsquery('simple', :query)) AS rank "
+            "FROM {table} "
+            "WHERE search_vector @@ to_tsquery('simple', :query)"
+        )
+    else:
+        query = ' '.join('"{}"*'.format(term) for term in terms)
+        # bm25() is lower for better matches
+        part = (
+            "SELECT '{table}' AS type, rowid AS id, "
+            "-bm25({table}_search) AS rank "
+            "FROM {table}_search WHERE {table}_search MATCH :query"
+        )
+    statement = ' UNION ALL '.join(part.format(table=table) for table in tables)
+    statement += ' ORDER BY rank DESC, type, id LIMIT :limit OFFSET :offset'
+    return db.session.execute(text(statement), {
+        'query': query, 'limit': limit, 'offset': offset
+    }).all()
+
+
+# Rows of a search page, in rank order, each with the table it comes from
+def search_rows(tables, terms, limit, offset):
+    ranked = ranked_ids(tables, terms, limit, offset)
+    rows = {}
+    for table in tables:
+        model = SEARCH_MODELS[table][0]
+        ids = [row.id for row in ranked if row.type == table]
+        if not ids:
+            continue
+        columns = [getattr(model, name) for name in model.READ_COLUMNS]
+        for row in db.session.execute(
+            select(*columns).where(model.id.in_(ids))
+        ):
+            rows[table, row.id] = dict(row._asdict(), type=table)
+    return [
+        rows[row.type, row.id] for row in ranked if (row.type, row.id) in rows
+    ]
@@ -0,0 +1,196 @@
+import datetime
+import os
+import random
+import time
+
+from sqlalchemy import func, select
+
+from casting import db
+from casting.models import load_rows, unit_of_work
+
+
+# Rows generated and committed per transaction by flask seed
+SEED_CHUNK_SIZE = int(os.getenv('SEED_CHUNK_SIZE', 10000))
+
+# Rows generated from one random stream. A row only depends on the seed and
+# its position, not on the chunk size or on how many runs seeded the table.
+SEED_BLOCK = 1000
+
+FIRST_NAMES = (
+    'Ada', 'Alejandro', 'Amara', 'Anna', 'Arjun', 'Beatriz', 'Ben', 'Carmen',
+    'Chen', 'Chloe', 'Daniel', 'Diego', 'Elena', 'Emma', 'Ethan', 'Fatima',
+    'Felix', 'Grace', 'Hana', 'Hugo', 'Ines', 'Isaac', 'Jack', 'Julia',
+    'Kenji', 'Laura', 'Leo', 'Lucas', 'Maria', 'Mateo', 'Maya', 'Mei',
+    'Mohammed', 'Nadia', 'Noah', 'Nora', 'Olivia', 'Omar', 'Paulo', 'Priya',
+    'Rafael', 'Rosa', 'Sam', 'Sofia', 'Tariq', 'Thomas', 'Valentina',
+    'Victor', 'Yuki', 'Zoe', 'Alexandra', 'Bartholomew', 'Christopher',
+    'Evangeline', 'Gwendolyn', 'Maximilian', 'Sebastian', 'Wilhelmina',
+    'Jo', 'Al', 'Ed', 'Li', 'Bo', 'Eve',
+)
+LAST_NAMES = (
+    'Abara', 'Alvarez', 'Andersen', 'Bauer', 'Bianchi', 'Brown', 'Campbell',
+    'Costa', 'Da Silva', 'Dubois', 'Evans', 'Fernandes', 'Fischer', 'Garcia',
+    'Gonzalez', 'Green', 'Hall', 'Hansen', 'Hernandez', 'Hoffmann', 'Ito',
+    'Jensen', 'Johnson', 'Kaur', 'Khan', 'Kim', 'Kowalski', 'Kumar', 'Lee',
+    'Lopez', 'Martin', 'Martinez', 'Meyer', 'Mendes', 'Moreau', 'Morris',
+    'Muller', 'Nakamura', 'Nguyen', 'Novak', 'Oliveira', 'Okafor', 'Park',
+    'Patel', 'Pereira', 'Petrov', 'Ramirez', 'Rossi', 'Santos', 'Schmidt',
+    'Silva', 'Singh', 'Smith', 'Sousa', 'Suzuki', 'Tanaka', 'Taylor',
+    'Thompson', 'Torres', 'Wang', 'Weber', 'Williams', 'Wilson', 'Yilmaz',
+    'Zhang', 'Ng', 'Wu', 'Li', 'Bergstrom-Lindqvist', 'Van der Berg',
+    'Montgomery', 'Fitzgerald', 'Papadopoulos', 'Wojciechowski',
+    'Castellanos', 'MacAllister', 'Abernathy', 'Delacroix', 'Oyelaran',
+    'Rasmussen',
+)
+MIDDLE_INITIALS = ('',) + tuple('{}.'.format(letter) for letter in
+                                'ABCDEFGHIJKLMNOPRSTW')
+
+TITLE_ADJECTIVES = (
+    'Last', 'Silent', 'Broken', 'Golden', 'Hidden', 'Lost', 'Dark', 'Final',
+    'Eternal', 'Crimson', 'Frozen', 'Wild', 'Secret', 'Burning', 'Distant',
+    'Forgotten', 'Endless', 'Electric', 'Midnight', 'Quiet', 'Savage',
+    'Scarlet', 'Shattered', 'Sleeping', 'Stolen', 'Twisted', 'Velvet',
+    'Wandering', 'Invisible', 'Iron', 'Paper', 'Glass', 'Northern', 'Red',
+    'Blue', 'Long', 'Little', 'Great', 'Strange', 'Bright',
+)
+TITLE_NOUNS = (
+    'River', 'Garden', 'Empire', 'Road', 'Kingdom', 'Storm', 'Shadow',
+    'Harbor', 'Mountain', 'City', 'Dream', 'Island', 'Promise', 'Horizon',
+    'Machine', 'Summer', 'Winter', 'Witness', 'Stranger', 'Heart', 'Frontier',
+    'Ocean', 'Station', 'Letter', 'Country', 'Symphony', 'Desert', 'Forest',
+    'Circus', 'Detective', 'Voyage', 'Mirror', 'Signal', 'Bridge', 'Train',
+    'Hotel', 'Journey', 'Legacy', 'Silence', 'Valley', 'Lighthouse',
+    'Conspiracy', 'Revolution', 'Masquerade', 'Labyrinth', 'Orchard',
+    'Carnival', 'Republic', 'Tide', 'Fire',
+)
+TITLE_PATTERNS = (
+    '{adjective} {noun}',
+    'The {adjective} {noun}',
+    'The {noun} Is {adjective}',
+    'Return to the {adjective} {noun}',
+    'A {noun} in the {adjective} Night',
+    'The {adjective} {noun} Who Knew Too Much',
+    'Beyond the {adjective} {noun}: Chapter One',
+)
+
+# Gender spread of the generated actors
+GENDERS = ('Female', 'Male', 'Non-binary')
+GENDER_WEIGHTS = (48, 48, 4)
+
+
+# Decompose index over the sizes, the last one varying fastest
+def mixed_radix(index, sizes):
+    digits = []
+    for size in reversed(sizes):
+        index, digit = divmod(index, size)
+        digits.append(digit)
+    return digits[::-1]
+
+
+# Unique label for a position: every combination of the parts is used once,
+# in a scrambled order, before the combinations repeat with a number
+def unique_parts(position, sizes):
+    total = 1
+    for size in sizes:
+        total *= size
+    # multiplying by a prime that does not divide total permutes 0..total-1
+    step = 1000003
+    repeat, index = divmod(position, total)
+    return mixed_radix(index * step % total, sizes), repeat
+
+
+# Normally distributed integer
+def round_gauss(rng, mean, deviation):
+    return int(round(rng.gauss(mean, deviation)))
+
+
+# Actor at a position: name lengths from 4 to 40 characters, ages mostly
+# 20 to 60 and a few children and seniors
+def actor_row(rng, position):
+    (first, middle, last), repeat = unique_parts(position, (
+        len(FIRST_NAMES), len(MIDDLE_INITIALS), len(LAST_NAMES)
+    ))
+    name = ' '.join(part for part in (
+        FIRST_NAMES[first], MIDDLE_INITIALS[middle], LAST_NAMES[last]
+    ) if part)
+    if repeat:
+        name += ' {}'.format(repeat + 1)
+    return {
+        'name': name,
+        'age': min(95, max(5, round_gauss(rng, 40, 15))),
+        'gender': rng.choices(GENDERS, GENDER_WEIGHTS)[0]
+    }
+
+
+# Movie at a position: titles of 2 to 7 words, release years spread from
+# 1920 to this year and skewed toward recent ones; titles past every
+# combination become sequels
+def movie_row(rng, position):
+    (pattern, adjective, noun), repeat = unique_parts(position, (
+        len(TITLE_PATTERNS), len(TITLE_ADJECTIVES), len(TITLE_NOUNS)
+    ))
+    title = TITLE_PATTERNS[pattern].format(
+        adjective=TITLE_ADJECTIVES[adjective], noun=TITLE_NOUNS[noun]
+    )
+    if repeat:
+        title += ' {}'.format(repeat + 1)
+    year = datetime.date.today().year
+    return {
+        'title': title,
+        'release_date': int(rng.triangular(1920, year + 1, year))
+    }
+
+
+ROW_MAKERS = {
+    'actors': actor_row,
+    'movies': movie_row,
+}
+
+
+# Yield count rows of a table from position start on, deterministic for a
+# seed, with a distinct name or title each. Each SEED_BLOCK positions share
+# a random stream, a run starting inside a block replays the start of the
+# block.
+def generate_rows(model, start, count, seed=0):
+    make_row = ROW_MAKERS[model.__tablename__]
+    rng = None
+    for position in range(start - start % SEED_BLOCK, start + count):
+        if rng is None or position % SEED_BLOCK == 0:
+            rng = random.Random('{}:{}:{}'.format(
+                seed, model.__tablename__, position // SEED_BLOCK
+            ))
+        row = make_row(rng, position)
+        if position >= start:
+            yield row
+
+
+# Add count generated rows to a table, SEED_CHUNK_SIZE per transaction.
+# The positions continue at max(id): a row seeded at a position gets an id
+# above it, so seeding again after deletes still adds new names instead of
+# repeating the ones left in the table. A row whose name or title was added
+# by other means is skipped.
+def seed_table(model, count, seed=0, chunk_size=None):
+    chunk_size = chunk_size or SEED_CHUNK_SIZE
+    start = db.session.execute(
+        select(func.coalesce(func.max(model.__table__.c.id), 0))
+    ).scalar()
+
+    began = time.perf_counter()
+    loaded = 0
+    chunk = []
+    for row in generate_rows(model, start, count, seed):
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            with unit_of_work():
+                loaded += len(chunk) - len(load_rows(model, chunk))
+            chunk = []
+    if chunk:
+        with unit_of_work():
+            loaded += len(chunk) - len(load_rows(model, chunk))
+
+    seconds = time.perf_counter() - began
+    return {
+        'rows': loaded,
+        'seconds': round(seconds, 3),
+        'rows_per_second': round(loaded / seconds) if seconds else 0
+    }
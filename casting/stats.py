@@ -0,0 +1,148 @@
+import os
+import threading
+import time
+
+from sqlalchemy import DDL, event, func, select, text
+
+from casting import db
+from casting.models import Actors, Movies, table_version
+
+
+# Width in years of the age histogram buckets
+STATS_AGE_BUCKET = int(os.getenv('STATS_AGE_BUCKET', 10))
+
+# On PostgreSQL read the statistics from the stats_summary materialized view
+STATS_MATERIALIZED_VIEW = os.getenv(
+    'STATS_MATERIALIZED_VIEW', 'false').lower() == 'true'
+
+# Minimum seconds between two refreshes of the materialized view
+STATS_REFRESH_INTERVAL = float(os.getenv('STATS_REFRESH_INTERVAL', 60))
+
+# PostgreSQL materialized view of every group, (metric, key, count). The
+# unique index lets REFRESH ... CONCURRENTLY run without blocking readers.
+VIEW_DDL = (
+    "CREATE MATERIALIZED VIEW IF NOT EXISTS stats_summary AS "
+    "SELECT 'gender' AS metric, gender AS key, count(*) AS count "
+    "FROM actors GROUP BY gender "
+    "UNION ALL "
+    "SELECT 'age', (age / {bucket} * {bucket})::text, count(*) "
+    "FROM actors GROUP BY age / {bucket} * {bucket} "
+    "UNION ALL "
+    "SELECT 'release_date', release_date::text, count(*) "
+    "FROM movies GROUP BY release_date",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_stats_summary "
+    "ON stats_summary (metric, key)",
+)
+
+
+# Create the view with the tables in db.create_all() and drop it first in
+# db.drop_all(), it depends on both. Migration c3e8f1a7d926 creates it for
+# existing databases.
+for statement in VIEW_DDL:
+    event.listen(db.metadata, 'after_create', DDL(
+        statement.format(bucket=STATS_AGE_BUCKET)
+    ).execute_if(dialect='postgresql'))
+event.listen(db.metadata, 'before_drop', DDL(
+    'DROP MATERIALIZED VIEW IF EXISTS stats_summary'
+).execute_if(dialect='postgresql'))
+
+
+# Versions of the tables the statistics are computed from
+def stats_versions():
+    return table_version(Actors), table_version(Movies)
+
+
+# Statistics from the groups, each a (metric, key, count) row
+def summarize(groups):
+    genders, ages, years = [], [], []
+    for metric, key, count in groups:
+        if metric == 'gender':
+            genders.append({'gender': key, 'count': count})
+        elif metric == 'age':
+            ages.append({
+                'age_min': int(key),
+                'age_max': int(key) + STATS_AGE_BUCKET - 1,
+                'count': count
+            })
+        else:
+            years.append({'release_date': int(key), 'count': count})
+    ages.sort(key=lambda group: group['age_min'])
+    years.sort(key=lambda group: group['release_date'])
+    genders.sort(key=lambda group: group['gender'])
+    return {
+        'actors': {
+            'total': sum(group['count'] for group in genders),
+            'by_gender': genders,
+            'by_age': ages
+        },
+        'movies': {
+            'total': sum(group['count'] for group in years),
+            'by_release_date': years
+        }
+    }
+
+
+# One GROUP BY query per metric, each served by an index of its column
+def grouped_stats():
+    bucket = Actors.age / STATS_AGE_BUCKET * STATS_AGE_BUCKET
+    groups = []
+    for metric, column in (
+        ('gender', Actors.gender),
+        ('age', bucket),
+        ('release_date', Movies.release_date),
+    ):
+        rows = db.session.execute(
+            select(column, func.count()).group_by(column)
+        )
+        groups += [(metric, key, count) for key, count in rows]
+    return summarize(groups)
+
+
+## Materialized view
+'''
+StatsView
+Reads the stats_summary view and refreshes it when the tables changed since
+the last refresh, at most once every STATS_REFRESH_INTERVAL seconds per
+worker. Between refreshes the view may lag behind the last writes.
+'''
+class StatsView:
+    def __init__(self, interval=STATS_REFRESH_INTERVAL):
+        self.interval = interval
+        self.versions = None
+        self.refreshed_at = None
+        self._lock = threading.Lock()
+
+    # Return the statistics and whether they are current for versions
+    def read(self, versions):
+        if versions != self.versions and (
+            self.refreshed_at is None or
+            time.monotonic() - self.refreshed_at >= self.interval
+        ):
+            with self._lock:
+                if versions != self.versions:
+                    self.refresh(versions)
+        groups = db.session.execute(
+            text('SELECT metric, key, count FROM stats_summary')
+        ).all()
+        return summarize(groups), versions == self.versions
+
+    # refresh on the primary in a transaction of its own, the request may
+    # be reading from the replica
+    def refresh(self, versions):
+        with db.engine.begin() as connection:
+            connection.execute(
+                text('REFRESH MATERIALIZED VIEW CONCURRENTLY stats_summary')
+            )
+        self.versions = versions
+        self.refreshed_at = time.monotonic()
+
+
+stats_view = StatsView()
+
+
+# Compute the statistics, returns them with whether they reflect the given
+# table versions (the materialized view may lag behind)
+def compute_stats(versions):
+    if STATS_MATERIALIZED_VIEW and db.engine.dialect.name == 'postgresql':
+        return stats_view.read(versions)
+    return grouped_stats(), True
@@ -0,0 +1,110 @@
+import json
+import threading
+import time
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import rsa
+from jose import jwt
+from jose.backends import RSAKey
+
+
+# Key generation with the pure-python rsa backend takes seconds, so each
+# keypair is generated once per process and shared between stand-ins
+@lru_cache(maxsize=None)
+def generate_key(kid, key_size=2048):
+    _, private_key = rsa.newkeys(key_size)
+    pem = private_key.save_pkcs1().decode()
+    public_jwk = RSAKey(pem, 'RS256').public_key().to_dict()
+    public_jwk.update({'kid': kid, 'use': 'sig'})
+    return pem, public_jwk
+
+
+## Local JWKS stand-in
+'''
+LocalJWKS
+Generates an RSA keypair, serves its public half as a JWKS document on
+localhost and mints RS256 tokens signed with the private half, so the auth
+layer can be exercised without reaching Auth0.
+'''
+class LocalJWKS:
+    def __init__(self, kid='local-test-key', key_size=2048):
+        self.kid = kid
+        self.requests = 0
+        self.fail = False
+        self.delay = 0
+        self._keys = {}
+        self._server = None
+        self._thread = None
+        self.add_key(kid, key_size)
+
+    # Add another signing key, e.g. to simulate an Auth0 key rotation
+    def add_key(self, kid, key_size=2048):
+        self._keys[kid] = generate_key(kid, key_size)
+
+    def jwks(self):
+        return {'keys': [jwk for _, jwk in self._keys.values()]}
+
+    # Mint a signed token for the given permissions
+    def token(self, permissions=(), kid=None, issuer=None, audience=None,
+              expires_in=3600, **claims):
+        kid = kid or self.kid
+        now = int(time.time())
+        claims.update({
+            'iss': issuer,
+            'aud': audience,
+            'sub': 'local|test',
+            'iat': now,
+            'exp': now + expires_in,
+            'permissions': list(permissions)
+        })
+        pem, _ = self._keys[kid]
+        return jwt.encode(claims, pem, algorithm='RS256',
+                          headers={'kid': kid})
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f'http://{host}:{port}/.well-known/jwks.json'
+
+    def start(self):
+        store = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                store.requests += 1
+                if store.delay:
+                    time.sleep(store.delay)
+                if store.fail:
+                    self.send_response(503)
+                    self.end_headers()
+                    return
+                body = json.dumps(store.jwks()).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            # keep test output quiet
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
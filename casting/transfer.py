@@ -0,0 +1,192 @@
+import csv
+import gzip
+import io
+import json
+import os
+import time
+import zlib
+
+from sqlalchemy import Integer, select
+
+from casting import db
+from casting.models import (
+    Actors, ImportCheckpoints, Movies, load_rows, unit_of_work
+)
+
+
+# Rows fetched from the server-side cursor and written per CSV chunk
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', 5000))
+
+# Rows read, validated and committed per transaction by an import
+IMPORT_CHUNK_SIZE = int(os.getenv('IMPORT_CHUNK_SIZE', 10000))
+
+# Rejected rows whose errors an import keeps for its report
+IMPORT_MAX_ERRORS = 20
+
+# Tables that can be exported and imported, by name
+TABLES = {
+    'actors': Actors,
+    'movies': Movies,
+}
+
+
+# Yield the whole table as CSV, the header then one chunk of encoded rows per
+# EXPORT_CHUNK_SIZE rows read from a server-side cursor (yield_per), so the
+# memory used does not depend on the size of the table
+def export_csv(model, chunk_size=None):
+    chunk_size = chunk_size or EXPORT_CHUNK_SIZE
+    columns = [getattr(model, name) for name in model.READ_COLUMNS]
+    result = db.session.execute(
+        select(*columns).order_by(model.id)
+        .execution_options(yield_per=chunk_size)
+    )
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(model.READ_COLUMNS)
+    for rows in result.partitions():
+        writer.writerows(rows)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+# Compress a stream of chunks to the gzip format as it goes
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+# Format of an import file from its extension, csv or ndjson
+def file_format(path):
+    name = path[:-3] if path.endswith('.gz') else path
+    if name.endswith(('.ndjson', '.jsonl')):
+        return 'ndjson'
+    return 'csv'
+
+
+## Malformed record
+'''
+MalformedRecord
+Stands for an NDJSON line that is not valid JSON in the records read from
+a file, so the import rejects that line alone and goes on
+'''
+class MalformedRecord(ValueError):
+    pass
+
+
+# Yield the records of a CSV (with a header) or NDJSON file, gzip compressed
+# if its name ends in .gz, one at a time. An NDJSON line that does not parse
+# is yielded as a MalformedRecord.
+def read_records(path, format):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', newline='', encoding='utf-8') as file:
+        if format == 'csv':
+            yield from csv.DictReader(file)
+        else:
+            for number, line in enumerate(file, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError as error:
+                    yield MalformedRecord(
+                        'line {} is not valid JSON: {}'.format(number, error)
+                    )
+
+
+# CSV fields are all text, convert the integer columns back before
+# validation; a value that is not a number is left for validate() to reject
+def coerce(model, record):
+    for column in model.__table__.c:
+        value = record.get(column.name)
+        if isinstance(column.type, Integer) and isinstance(value, str):
+            try:
+                record[column.name] = int(value)
+            except ValueError:
+                pass
+    return record
+
+
+# Load the records read up to position and move the checkpoint there, in
+# one transaction. Returns the positions in records of the ones skipped
+# because their natural key is taken.
+def commit_chunk(model, source, records, position):
+    with unit_of_work():
+        skipped = load_rows(model, records)
+        db.session.merge(ImportCheckpoints(source=source, rows=position))
+    return skipped
+
+
+# Count a committed chunk in the report, its records whose natural key is
+# taken as rejected under their file row numbers
+def count_chunk(model, report, rows, skipped):
+    report['loaded'] += len(rows) - len(skipped)
+    report['rejected'] += len(skipped)
+    problem = 'duplicate ' + ' and '.join(model.NATURAL_KEY)
+    for index in skipped:
+        if len(report['errors']) < IMPORT_MAX_ERRORS:
+            report['errors'].append({'row': rows[index], 'errors': [problem]})
+
+
+# Import a CSV or NDJSON file into a table. The file is read, validated and
+# loaded IMPORT_CHUNK_SIZE rows per transaction; invalid rows and rows
+# whose natural key is taken are skipped and reported. With resume, the rows of the chunks committed by a previous
+# run of the same file are skipped. Returns the counters of the import.
+def import_file(model, path, format=None, chunk_size=None, resume=False):
+    format = format or file_format(path)
+    chunk_size = chunk_size or IMPORT_CHUNK_SIZE
+    source = '{}:{}'.format(model.__tablename__, os.path.abspath(path))[:255]
+
+    skip = 0
+    if resume:
+        checkpoint = db.session.get(ImportCheckpoints, source)
+        skip = checkpoint.rows if checkpoint is not None else 0
+    report = {
+        'skipped': skip,
+        'loaded': 0,
+        'rejected': 0,
+        'errors': []
+    }
+
+    start = time.perf_counter()
+    records = []
+    rows = []
+    position = 0
+    for position, record in enumerate(read_records(path, format), 1):
+        if position <= skip:
+            continue
+        if isinstance(record, MalformedRecord):
+            values, problems = None, [str(record)]
+        else:
+            if format == 'csv':
+                record = coerce(model, record)
+            values, problems = model.validate(record)
+        if problems:
+            report['rejected'] += 1
+            if len(report['errors']) < IMPORT_MAX_ERRORS:
+                report['errors'].append({'row': position, 'errors': problems})
+        else:
+            records.append(values)
+            rows.append(position)
+        if position % chunk_size == 0:
+            skipped = commit_chunk(model, source, records, position)
+            count_chunk(model, report, rows, skipped)
+            records = []
+            rows = []
+    if position > skip:
+        skipped = commit_chunk(model, source, records, position)
+        count_chunk(model, report, rows, skipped)
+    report['errors'].sort(key=lambda error: error['row'])
+
+    seconds = time.perf_counter() - start
+    report['seconds'] = round(seconds, 3)
+    report['rows_per_second'] = round(
+        (position - skip) / seconds) if seconds else 0
+    return report
@@ -7,6 +7,8 @@ from flask import current_app
 
 from alembic import context
 
+from casting.search import SEARCH_MODELS
+
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
 config = context.config
@@ -26,6 +28,13 @@ config.set_main_option(
         '%', '%%'))
 target_metadata = current_app.extensions['migrate'].db.metadata
 
+# prefixes of the SQLite FTS5 tables and names of the PostgreSQL indexes
+# made for full-text search by casting.search
+SEARCH_TABLES = tuple(
+    '{}_search'.format(table) for table in SEARCH_MODELS
+)
+SEARCH_INDEXES = {'ix_{}_search'.format(table) for table in SEARCH_MODELS}
+
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
 # my_important_option = config.get_main_option("my_important_option")
@@ -74,10 +83,30 @@ def run_migrations_online():
     connectable = current_app.extensions['migrate'].db.get_engine()
 
     with connectable.connect() as connection:
+
+        # the pattern_ops indexes of the models only exist on PostgreSQL,
+        # elsewhere an autogenerated migration should not create them. The
+        # search index of each searched table (the FTS5 table and its
+        # shadow tables on SQLite, the search_vector column and its GIN
+        # index on PostgreSQL) is made by DDL outside the metadata, an
+        # autogenerated migration should not drop it.
+        def include_object(object, name, type_, reflected, compare_to):
+            if type_ == 'index' and name.endswith('_pattern'):
+                return connection.dialect.name == 'postgresql'
+            if reflected and compare_to is None:
+                if type_ == 'table':
+                    return not name.startswith(SEARCH_TABLES)
+                if type_ == 'column':
+                    return name != 'search_vector'
+                if type_ == 'index':
+                    return name not in SEARCH_INDEXES
+            return True
+
         context.configure(
             connection=connection,
             target_metadata=target_metadata,
             process_revision_directives=process_revision_directives,
+            include_object=include_object,
             **current_app.extensions['migrate'].configure_args
         )
 
@@ -0,0 +1,32 @@
+"""table versions
+
+Revision ID: 3f1c9a2d7b40
+Revises: ebe85093a8aa
+Create Date: 2026-10-18 09:12:41.204518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c9a2d7b40'
+down_revision = 'ebe85093a8aa'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    table_versions = op.create_table('table_versions',
+    sa.Column('name', sa.String(length=64), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+    op.bulk_insert(table_versions, [
+        {'name': 'actors', 'version': 0},
+        {'name': 'movies', 'version': 0},
+    ])
+
+
+def downgrade():
+    op.drop_table('table_versions')
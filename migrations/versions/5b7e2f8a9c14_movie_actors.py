@@ -0,0 +1,32 @@
+"""movie actors
+
+Revision ID: 5b7e2f8a9c14
+Revises: 8d2e4b6c1f93
+Create Date: 2026-10-18 15:21:43.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b7e2f8a9c14'
+down_revision = '8d2e4b6c1f93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('movie_actors',
+    sa.Column('movie_id', sa.Integer(), nullable=False),
+    sa.Column('actor_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['actor_id'], ['actors.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['movie_id'], ['movies.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('movie_id', 'actor_id')
+    )
+    op.create_index('ix_movie_actors_actor_id', 'movie_actors', ['actor_id', 'movie_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_movie_actors_actor_id', table_name='movie_actors')
+    op.drop_table('movie_actors')
@@ -0,0 +1,43 @@
+"""filter indexes
+
+Revision ID: 8d2e4b6c1f93
+Revises: 3f1c9a2d7b40
+Create Date: 2026-10-18 11:02:17.530964
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d2e4b6c1f93'
+down_revision = '3f1c9a2d7b40'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_actors_age', 'actors', ['age', 'id'], unique=False)
+    op.create_index('ix_actors_gender', 'actors', ['gender', 'id'], unique=False)
+    op.create_index('ix_actors_name', 'actors', ['name', 'id'], unique=False)
+    op.create_index('ix_movies_release_date', 'movies', ['release_date', 'id'], unique=False)
+    op.create_index('ix_movies_title', 'movies', ['title', 'id'], unique=False)
+
+    # prefix searches use LIKE on PostgreSQL, which needs pattern_ops
+    # indexes unless the database collation is C
+    if op.get_bind().dialect.name == 'postgresql':
+        op.create_index('ix_actors_name_pattern', 'actors', ['name'], unique=False,
+                        postgresql_ops={'name': 'varchar_pattern_ops'})
+        op.create_index('ix_movies_title_pattern', 'movies', ['title'], unique=False,
+                        postgresql_ops={'title': 'varchar_pattern_ops'})
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.drop_index('ix_movies_title_pattern', table_name='movies')
+        op.drop_index('ix_actors_name_pattern', table_name='actors')
+    op.drop_index('ix_movies_title', table_name='movies')
+    op.drop_index('ix_movies_release_date', table_name='movies')
+    op.drop_index('ix_actors_name', table_name='actors')
+    op.drop_index('ix_actors_gender', table_name='actors')
+    op.drop_index('ix_actors_age', table_name='actors')
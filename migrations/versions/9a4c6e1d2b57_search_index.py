@@ -0,0 +1,77 @@
+"""search index
+
+Revision ID: 9a4c6e1d2b57
+Revises: 5b7e2f8a9c14
+Create Date: 2026-10-18 16:40:05.274931
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9a4c6e1d2b57'
+down_revision = '5b7e2f8a9c14'
+branch_labels = None
+depends_on = None
+
+# searched text column of each table
+COLUMNS = {'movies': 'title', 'actors': 'name'}
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    for table, column in COLUMNS.items():
+
+        # generated tsvector column with a GIN index
+        if dialect == 'postgresql':
+            op.execute(
+                f"ALTER TABLE {table} ADD COLUMN search_vector tsvector "
+                f"GENERATED ALWAYS AS (to_tsvector('simple', {column})) STORED"
+            )
+            op.execute(
+                f"CREATE INDEX ix_{table}_search ON {table} "
+                f"USING gin (search_vector)"
+            )
+
+        # external content FTS5 table kept in sync by triggers
+        elif dialect == 'sqlite':
+            op.execute(
+                f"CREATE VIRTUAL TABLE {table}_search "
+                f"USING fts5({column}, content='{table}', content_rowid='id')"
+            )
+            op.execute(
+                f"CREATE TRIGGER {table}_search_insert "
+                f"AFTER INSERT ON {table} BEGIN "
+                f"INSERT INTO {table}_search(rowid, {column}) "
+                f"VALUES (new.id, new.{column}); END"
+            )
+            op.execute(
+                f"CREATE TRIGGER {table}_search_delete "
+                f"AFTER DELETE ON {table} BEGIN "
+                f"INSERT INTO {table}_search({table}_search, rowid, {column}) "
+                f"VALUES ('delete', old.id, old.{column}); END"
+            )
+            op.execute(
+                f"CREATE TRIGGER {table}_search_update "
+                f"AFTER UPDATE OF {column} ON {table} BEGIN "
+                f"INSERT INTO {table}_search({table}_search, rowid, {column}) "
+                f"VALUES ('delete', old.id, old.{column}); "
+                f"INSERT INTO {table}_search(rowid, {column}) "
+                f"VALUES (new.id, new.{column}); END"
+            )
+            op.execute(
+                f"INSERT INTO {table}_search({table}_search) VALUES ('rebuild')"
+            )
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    for table in COLUMNS:
+        if dialect == 'postgresql':
+            op.drop_index(f'ix_{table}_search', table_name=table)
+            op.drop_column(table, 'search_vector')
+        elif dialect == 'sqlite':
+            for trigger in ('insert', 'delete', 'update'):
+                op.execute(f'DROP TRIGGER {table}_search_{trigger}')
+            op.execute(f'DROP TABLE {table}_search')
@@ -0,0 +1,32 @@
+"""stats view
+
+Revision ID: c3e8f1a7d926
+Revises: 9a4c6e1d2b57
+Create Date: 2026-10-18 18:12:36.905127
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from casting.stats import STATS_AGE_BUCKET, VIEW_DDL
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3e8f1a7d926'
+down_revision = '9a4c6e1d2b57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # statistics of GET /stats, read when STATS_MATERIALIZED_VIEW is set;
+    # the same statements as db.create_all(), with the STATS_AGE_BUCKET
+    # width summarize() reads the age keys with
+    if op.get_bind().dialect.name == 'postgresql':
+        for statement in VIEW_DDL:
+            op.execute(statement.format(bucket=STATS_AGE_BUCKET))
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute("DROP MATERIALIZED VIEW stats_summary")
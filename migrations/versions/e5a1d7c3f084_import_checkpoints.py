@@ -0,0 +1,28 @@
+"""import checkpoints
+
+Revision ID: e5a1d7c3f084
+Revises: c3e8f1a7d926
+Create Date: 2026-10-18 20:03:51.660418
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5a1d7c3f084'
+down_revision = 'c3e8f1a7d926'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('import_checkpoints',
+    sa.Column('source', sa.String(length=255), nullable=False),
+    sa.Column('rows', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('source')
+    )
+
+
+def downgrade():
+    op.drop_table('import_checkpoints')
@@ -0,0 +1,34 @@
+"""natural keys
+
+Revision ID: f7b2c9d4e618
+Revises: e5a1d7c3f084
+Create Date: 2026-10-18 21:12:40.318205
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f7b2c9d4e618'
+down_revision = 'e5a1d7c3f084'
+branch_labels = None
+depends_on = None
+
+
+# Fails if the tables already hold duplicate names or titles, they have to
+# be merged or renamed first. The unique indexes replace the name and title
+# filter indexes of 8d2e4b6c1f93, which they cover.
+def upgrade():
+    op.create_index('uq_actors_name', 'actors', ['name'], unique=True)
+    op.create_index('uq_movies_title_release_date', 'movies',
+                    ['title', 'release_date'], unique=True)
+    op.drop_index('ix_actors_name', table_name='actors')
+    op.drop_index('ix_movies_title', table_name='movies')
+
+
+def downgrade():
+    op.create_index('ix_movies_title', 'movies', ['title', 'id'], unique=False)
+    op.create_index('ix_actors_name', 'actors', ['name', 'id'], unique=False)
+    op.drop_index('uq_movies_title_release_date', table_name='movies')
+    op.drop_index('uq_actors_name', table_name='actors')
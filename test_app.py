@@ -1,9 +1,27 @@
+import argparse
 import os
 import json
+import gzip
+import importlib.util
+import tempfile
+import threading
+import time
+import tracemalloc
 import unittest
+from contextlib import contextmanager
+from unittest import mock
 from flask_sqlalchemy import SQLAlchemy
-from casting import create_app
-from casting.models import db_drop_and_create_all, Movies, Actors
+from casting import create_app, auth, db, fastjson, replica, seed, transfer
+from casting.auth import JWKSKeyStore, VerifiedTokenCache
+from casting.cache import ResponseCache, response_cache
+from casting.models import db_drop_and_create_all, Movies, Actors, TableVersions
+from casting.models import bulk_insert, savepoint, unit_of_work, ImportCheckpoints
+from casting.pool import InstrumentedQueuePool, engine_options, pool_stats
+from casting.testing import LocalJWKS
+from benchmarks import load, suite
+from sqlalchemy import create_engine, event, exc, inspect, select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateIndex
 from sqlalchemy.orm.session import close_all_sessions
 
 
@@ -45,14 +63,15 @@ class AppTestCase(unittest.TestCase):
             "release_date": 1971
         }
 
-        self.new_name = 'Charlton Heston'
-        self.new_age = 84
-        self.new_gender = 'Male'
+        # the demo actor is Charlton Heston, actor names are unique
+        self.new_name = 'Kim Hunter'
+        self.new_age = 79
+        self.new_gender = 'Female'
 
         self.new_actor = {
-            "name": "Charlton Heston",
-            "age": 84,
-            "gender": "Male"
+            "name": "Kim Hunter",
+            "age": 79,
+            "gender": "Female"
         }
 
         self.update_name = 'Roddy McDowall'
@@ -154,7 +173,7 @@ class AppTestCase(unittest.TestCase):
         jwt = os.getenv("ASSITENT_JWT")
 
         # Define movies route
-        res = self.client().get("/movies/2", headers={"Authorization": f"Bearer {jwt}"})
+        res = self.client().post("/movies/2", headers={"Authorization": f"Bearer {jwt}"})
        
         # create the data dictionary from the URL request
         data = json.loads(res.data)
@@ -182,7 +201,7 @@ class AppTestCase(unittest.TestCase):
         self.assertEqual(data["movies"][0]["title"], self.update_title)
         self.assertEqual(data["movies"][0]["release_date"], self.update_release_date)
         
-    def test_update_movie_unprocessable(self):
+    def test_update_movie_resource_not_found(self):
 
         #Load jwt from environment variables
         jwt = os.getenv("DIRECTOR_JWT")
@@ -194,9 +213,9 @@ class AppTestCase(unittest.TestCase):
         data = json.loads(res.data)
 
         # Check request return
-        self.assertEqual(res.status_code, 422)
+        self.assertEqual(res.status_code, 404)
         self.assertEqual(data["success"], False)
-        self.assertEqual(data["message"], "unprocessable")
+        self.assertEqual(data["message"], "resource not found")
         
     def test_delete_movie_rbac_permission_not_found(self):
         
@@ -319,7 +338,7 @@ class AppTestCase(unittest.TestCase):
         jwt = os.getenv("ASSITENT_JWT")
 
         # Define actors route
-        res = self.client().get("/actors/2", headers={"Authorization": f"Bearer {jwt}"})
+        res = self.client().post("/actors/2", headers={"Authorization": f"Bearer {jwt}"})
 
         # create the data dictionary from the URL request
         data = json.loads(res.data)
@@ -349,7 +368,7 @@ class AppTestCase(unittest.TestCase):
         self.assertEqual(data["actors"][0]["gender"], self.update_gender)
     
 
-    def test_update_actor_unprocessable(self):
+    def test_update_actor_resource_not_found(self):
 
         #Load jwt from environment variables
         jwt = os.getenv("DIRECTOR_JWT")
@@ -361,9 +380,9 @@ class AppTestCase(unittest.TestCase):
         data = json.loads(res.data)
 
         # Check request return
-        self.assertEqual(res.status_code, 422)
+        self.assertEqual(res.status_code, 404)
         self.assertEqual(data["success"], False)
-        self.assertEqual(data["message"], "unprocessable")
+        self.assertEqual(data["message"], "resource not found")
         
     def test_delete_actor(self):
 
@@ -399,6 +418,1732 @@ class AppTestCase(unittest.TestCase):
         self.assertEqual(data["message"], "resource not found")
         
 
+# Test cases below run offline against a local JWKS stand-in and an
+# in-memory database, so they do not need the Auth0 tokens from .env
+class LocalAuthTestCase(unittest.TestCase):
+
+    database_url = "sqlite://"
+
+    @classmethod
+    def setUpClass(cls):
+        cls.jwks = LocalJWKS().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.jwks.stop()
+
+    def setUp(self):
+        self.jwks.fail = False
+        self.jwks.requests = 0
+        response_cache.clear()
+
+        # point the auth module at the local stand-in
+        self.patches = [
+            mock.patch.object(auth, 'AUTH0_DOMAIN', 'casting.test'),
+            mock.patch.object(auth, 'API_AUDIENCE', 'casting'),
+            mock.patch.object(auth, 'jwks_store', JWKSKeyStore(self.jwks.url)),
+            mock.patch.object(auth, 'token_cache', VerifiedTokenCache()),
+            mock.patch.dict(os.environ, {'POSTGRES_URL': self.database_url}),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+        self.app = create_app()
+        self.client = self.app.test_client
+
+        with self.app.app_context():
+            db_drop_and_create_all()
+
+    def tearDown(self):
+        close_all_sessions()
+        for patch in reversed(self.patches):
+            patch.stop()
+
+    # Collect the (statement, parameters) sent to the database within the
+    # block, without the table_versions lookups unless versions is set
+    @contextmanager
+    def capture_statements(self, versions=False):
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            if versions or "table_versions" not in statement:
+                statements.append((statement, parameters))
+
+        with self.app.app_context():
+            engine = db.engine
+            event.listen(engine, "before_cursor_execute", capture)
+            try:
+                yield statements
+            finally:
+                event.remove(engine, "before_cursor_execute", capture)
+
+    # Insert extra actors after the demo row
+    def add_actors(self, count):
+        with self.app.app_context():
+            for i in range(count):
+                Actors(name=f"Actor {i}", age=20 + i, gender="Female").insert()
+
+    # Authorization header for a local token with the given permissions
+    def headers(self, *permissions, **claims):
+        token = self.jwks.token(
+            permissions,
+            issuer='https://casting.test/',
+            audience='casting',
+            **claims
+        )
+        return {"Authorization": f"Bearer {token}"}
+
+
+class JWKSKeyStoreTestCase(LocalAuthTestCase):
+
+    def test_keys_are_fetched_once(self):
+
+        # Several authenticated calls share one JWKS download
+        for _ in range(3):
+            res = self.client().get("/actors", headers=self.headers("get:actors"))
+            self.assertEqual(res.status_code, 200)
+
+        self.assertEqual(self.jwks.requests, 1)
+
+    def test_unknown_kid_forces_refresh(self):
+
+        store = JWKSKeyStore(self.jwks.url, min_refresh_interval=0)
+        self.assertIsNotNone(store.get_key(self.jwks.kid))
+
+        # Simulate a key rotation on the identity provider
+        self.jwks.add_key('rotated-key')
+        self.assertIsNotNone(store.get_key('rotated-key'))
+        self.assertEqual(self.jwks.requests, 2)
+
+        # Unknown kids cannot trigger more than one refresh per interval
+        store.min_refresh_interval = 60
+        self.assertIsNone(store.get_key('no-such-key'))
+        self.assertEqual(self.jwks.requests, 2)
+
+    def test_stale_keys_served_when_endpoint_fails(self):
+
+        store = JWKSKeyStore(self.jwks.url, ttl=0, failure_threshold=2)
+        key = store.get_key(self.jwks.kid)
+
+        # The endpoint goes down: stale keys keep being served
+        self.jwks.fail = True
+        for _ in range(5):
+            self.assertIs(store.get_key(self.jwks.kid), key)
+            store.join()
+
+        # The circuit opened after two failures and stopped fetching
+        self.assertTrue(store.circuit_open())
+        self.assertEqual(self.jwks.requests, 3)
+
+    def test_stale_keys_revalidated_in_background(self):
+
+        store = JWKSKeyStore(self.jwks.url, ttl=0)
+        key = store.get_key(self.jwks.kid)
+
+        # A slow endpoint does not delay the requests holding a stale key
+        self.jwks.delay = 1
+        self.jwks.add_key('background-key')
+        began = time.monotonic()
+        for _ in range(3):
+            self.assertIs(store.get_key(self.jwks.kid), key)
+        self.assertLess(time.monotonic() - began, 0.5)
+
+        store.join()
+        self.jwks.delay = 0
+        self.assertEqual(self.jwks.requests, 2)
+        self.assertIn('background-key', store.keys)
+
+    def test_endpoint_down_without_cached_keys(self):
+
+        self.jwks.fail = True
+        res = self.client().get("/actors", headers=self.headers("get:actors"))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(data["code"], "jwks_unavailable")
+
+    def test_concurrent_refresh_is_single_flight(self):
+
+        store = JWKSKeyStore(self.jwks.url)
+        self.jwks.delay = 0.2
+        keys = []
+
+        def worker():
+            keys.append(store.get_key(self.jwks.kid))
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.jwks.delay = 0
+
+        self.assertEqual(len(keys), 8)
+        self.assertTrue(all(key is keys[0] for key in keys))
+        self.assertEqual(self.jwks.requests, 1)
+
+
+class VerifiedTokenCacheTestCase(LocalAuthTestCase):
+
+    def test_repeat_token_skips_verification(self):
+
+        headers = self.headers("get:actors", "get:movies")
+        with mock.patch.object(
+            auth, 'verify_decode_jwt', wraps=auth.verify_decode_jwt
+        ) as verify:
+            for path in ("/actors", "/movies", "/actors"):
+                res = self.client().get(path, headers=headers)
+                self.assertEqual(res.status_code, 200)
+
+        self.assertEqual(verify.call_count, 1)
+        self.assertEqual(auth.token_cache.stats()["hits"], 2)
+        self.assertEqual(auth.token_cache.stats()["misses"], 1)
+
+    def test_cached_token_still_checks_permissions(self):
+
+        headers = self.headers("get:actors")
+        self.client().get("/actors", headers=headers)
+        res = self.client().get("/movies", headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(data["code"], "unauthorized")
+
+    def test_entries_evicted_at_exp(self):
+
+        cache = VerifiedTokenCache()
+        payload = cache.put("token", {"exp": 1, "permissions": ["get:actors"]})
+
+        self.assertEqual(payload["permissions"], frozenset(["get:actors"]))
+        self.assertIsNone(cache.get("token"))
+        self.assertEqual(cache.stats()["size"], 0)
+
+    def test_cache_is_bounded(self):
+
+        cache = VerifiedTokenCache(maxsize=2)
+        exp = 2 ** 40
+        for token in ("a", "b", "c"):
+            cache.put(token, {"exp": exp})
+        cache.get("b")
+        cache.put("d", {"exp": exp})
+
+        self.assertIsNone(cache.get("a"))
+        self.assertIsNone(cache.get("c"))
+        self.assertIsNotNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("d"))
+
+class PaginationTestCase(LocalAuthTestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        # 25 actors in total, including the demo row
+        self.add_actors(24)
+
+    def test_keyset_pages(self):
+
+        headers = self.headers("get:actors")
+        ids = []
+        cursor = None
+        while True:
+            url = "/actors?limit=10"
+            if cursor is not None:
+                url += f"&after_id={cursor}"
+            data = json.loads(self.client().get(url, headers=headers).data)
+            ids += [actor["id"] for actor in data["actors"]]
+            cursor = data["next_cursor"]
+            if cursor is None:
+                break
+
+        self.assertEqual(ids, list(range(1, 26)))
+
+    def test_offset_fallback(self):
+
+        res = self.client().get("/actors?limit=5&offset=20", headers=self.headers("get:actors"))
+        data = json.loads(res.data)
+
+        self.assertEqual([actor["id"] for actor in data["actors"]], [21, 22, 23, 24, 25])
+        self.assertIsNone(data["next_cursor"])
+
+    def test_page_size_is_capped(self):
+
+        with mock.patch("casting.routes.MAX_PAGE_SIZE", 10):
+            res = self.client().get("/actors?limit=1000", headers=self.headers("get:actors"))
+        data = json.loads(res.data)
+
+        self.assertEqual(len(data["actors"]), 10)
+        self.assertEqual(data["next_cursor"], 10)
+
+    def test_invalid_page_parameters(self):
+
+        res = self.client().get("/movies?after_id=abc", headers=self.headers("get:movies"))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data["message"], "bad request")
+
+class StreamingTestCase(LocalAuthTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.add_actors(24)
+
+    def test_stream_actors_ndjson(self):
+
+        headers = self.headers("get:actors")
+        headers["Accept"] = "application/x-ndjson"
+        with mock.patch("casting.routes.STREAM_BATCH_SIZE", 10):
+            res = self.client().get("/actors", headers=headers)
+            lines = res.get_data(as_text=True).splitlines()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, "application/x-ndjson")
+        self.assertEqual([json.loads(line)["id"] for line in lines], list(range(1, 26)))
+
+    def test_stream_resumes_after_cursor(self):
+
+        headers = self.headers("get:movies")
+        headers["Accept"] = "application/x-ndjson"
+        res = self.client().get("/movies?after_id=1", headers=headers)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.get_data(as_text=True), "")
+
+    def test_json_remains_default(self):
+
+        headers = self.headers("get:actors")
+        headers["Accept"] = "*/*"
+        res = self.client().get("/actors", headers=headers)
+
+        self.assertEqual(res.mimetype, "application/json")
+
+class BulkCreateTestCase(LocalAuthTestCase):
+
+    def test_bulk_create_actors(self):
+
+        records = [
+            {"name": "Kim Hunter", "age": 79, "gender": "Female"},
+            {"name": "", "age": 40, "gender": "Male"},
+            {"name": "Maurice Evans", "age": 87, "gender": "Male"},
+            {"name": "Linda Harrison", "age": "77", "gender": "Female"},
+        ]
+        res = self.client().post("/actors/bulk", json=records, headers=self.headers("post:actors"))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["created"], 2)
+        self.assertEqual(data["ids"], [2, None, 3, None])
+        self.assertEqual([error["index"] for error in data["errors"]], [1, 3])
+        self.assertEqual(data["errors"][1]["errors"], ["age must be an integer"])
+
+        with self.app.app_context():
+            self.assertEqual(Actors.query.get(3).name, "Maurice Evans")
+
+    def test_bulk_create_reports_duplicates(self):
+
+        with self.app.app_context():
+            name = Actors.query.get(1).name
+        records = [
+            {"name": name, "age": 40, "gender": "Male"},
+            {"name": "Kim Hunter", "age": 79, "gender": "Female"},
+            {"name": "Kim Hunter", "age": 79, "gender": "Female"},
+        ]
+        res = self.client().post("/actors/bulk", json=records, headers=self.headers("post:actors"))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["created"], 1)
+        self.assertEqual(data["ids"], [None, 2, None])
+        self.assertEqual(data["errors"], [
+            {"index": 0, "errors": ["duplicate name"]},
+            {"index": 2, "errors": ["duplicate name"]},
+        ])
+
+    def test_bulk_create_movies(self):
+
+        records = [{"title": f"Movie {i}", "release_date": 1970 + i} for i in range(500)]
+        res = self.client().post("/movies/bulk", json=records, headers=self.headers("post:movies"))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["ids"], list(range(2, 502)))
+        with self.app.app_context():
+            self.assertEqual(Movies.query.get(501).title, "Movie 499")
+
+    def test_bulk_create_bad_request(self):
+
+        res = self.client().post("/movies/bulk", json={"title": "Movie"}, headers=self.headers("post:movies"))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data["message"], "bad request")
+
+    def test_bulk_create_too_large(self):
+
+        with mock.patch("casting.routes.MAX_BULK_SIZE", 2):
+            res = self.client().post("/movies/bulk", json=[{}, {}, {}], headers=self.headers("post:movies"))
+
+        self.assertEqual(res.status_code, 413)
+
+    def test_bulk_create_rbac_permission_not_found(self):
+
+        res = self.client().post("/movies/bulk", json=[{}], headers=self.headers("post:actors"))
+
+        self.assertEqual(res.status_code, 403)
+
+class ETagTestCase(LocalAuthTestCase):
+
+    def test_not_modified_until_table_changes(self):
+
+        headers = self.headers("get:movies", "post:movies", "patch:movies")
+        res = self.client().get("/movies", headers=headers)
+        etag = res.headers["ETag"]
+
+        # Same version: 304 without querying the movies
+        with mock.patch("casting.routes.paginate") as paginate:
+            res = self.client().get("/movies", headers=dict(headers, **{"If-None-Match": etag}))
+            self.assertFalse(paginate.called)
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers["ETag"], etag)
+
+        # A write on movies bumps the version
+        self.client().patch("/movies/1", json={"title": "Escape", "release_date": 1971}, headers=headers)
+        res = self.client().get("/movies", headers=dict(headers, **{"If-None-Match": etag}))
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers["ETag"], etag)
+
+    def test_etag_ignores_other_tables(self):
+
+        headers = self.headers("get:actors", "post:movies")
+        etag = self.client().get("/actors", headers=headers).headers["ETag"]
+        self.client().post("/movies/bulk", json=[{"title": "Movie", "release_date": 1970}], headers=headers)
+        res = self.client().get("/actors", headers=dict(headers, **{"If-None-Match": etag}))
+
+        self.assertEqual(res.status_code, 304)
+
+    def test_etag_differs_per_page(self):
+
+        headers = self.headers("get:actors")
+        first = self.client().get("/actors?limit=1", headers=headers).headers["ETag"]
+        second = self.client().get("/actors?limit=2", headers=headers).headers["ETag"]
+
+        self.assertNotEqual(first, second)
+
+class FilterSortTestCase(LocalAuthTestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        # ages 20 to 43, genders alternating, plus the demo row aged 84
+        with self.app.app_context():
+            for i in range(24):
+                gender = "Female" if i % 2 else "Male"
+                Actors(name=f"Actor {i:02}", age=20 + i, gender=gender).insert()
+            for year in (1968, 1970, 1971, 1979, 1980):
+                Movies(title=f"Apes {year}", release_date=year).insert()
+
+    def get(self, url, permission):
+        return json.loads(self.client().get(url, headers=self.headers(permission)).data)
+
+    def test_filter_actors(self):
+
+        data = self.get("/actors?age_min=40&gender=Female", "get:actors")
+        self.assertEqual([actor["age"] for actor in data["actors"]], [41, 43])
+
+        data = self.get("/actors?age_min=40&age_max=42&name=Actor%202", "get:actors")
+        self.assertEqual([actor["name"] for actor in data["actors"]], ["Actor 20", "Actor 21", "Actor 22"])
+
+    def test_filter_movies(self):
+
+        data = self.get("/movies?release_date_min=1970&release_date_max=1979", "get:movies")
+        self.assertEqual([movie["release_date"] for movie in data["movies"]], [1970, 1971, 1979])
+
+        data = self.get("/movies?title=Apes%2019", "get:movies")
+        self.assertEqual(len(data["movies"]), 5)
+
+    def test_filter_prefix_with_last_code_point(self):
+
+        with self.app.app_context():
+            Actors(name="Actor 2\U0010ffff\U0010ffffX", age=30, gender="Male").insert()
+
+        data = self.get("/actors?name=Actor%202%F4%8F%BF%BF", "get:actors")
+        self.assertEqual([actor["name"] for actor in data["actors"]], ["Actor 2\U0010ffff\U0010ffffX"])
+
+        # no upper bound at all, an empty page is a 404 like any other filter
+        res = self.client().get("/actors?name=%F4%8F%BF%BF", headers=self.headers("get:actors"))
+        self.assertEqual(res.status_code, 404)
+
+    def test_sort_with_keyset_pages(self):
+
+        names = []
+        url = "/actors?sort=-age&limit=10"
+        while url:
+            data = self.get(url, "get:actors")
+            names += [actor["age"] for actor in data["actors"]]
+            url = data["next_cursor"] and f"/actors?sort=-age&limit=10&after_id={data['next_cursor']}"
+
+        self.assertEqual(names, [84] + list(range(43, 19, -1)))
+
+    def test_invalid_sort(self):
+
+        res = self.client().get("/actors?sort=gender", headers=self.headers("get:actors"))
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_filtered_queries_use_indexes(self):
+
+        urls = {
+            "/actors?age_min=40&age_max=42": "ix_actors_age",
+            "/actors?gender=Female": "ix_actors_gender",
+            "/actors?name=Actor%201": "uq_actors_name",
+            "/actors?sort=age&after_id=5": "ix_actors_age",
+            "/movies?release_date_min=1970&release_date_max=1979": "ix_movies_release_date",
+            "/movies?title=Apes": "uq_movies_title_release_date",
+        }
+        for url, index in urls.items():
+            with self.capture_statements() as statements:
+                res = self.client().get(url, headers=self.headers("get:actors", "get:movies"))
+            self.assertEqual(res.status_code, 200)
+
+            # EXPLAIN the page query, the last SELECT of the request
+            with self.app.app_context():
+                statement, parameters = [
+                    captured for captured in statements if captured[0].lstrip().startswith("SELECT")
+                ][-1]
+                plan = db.engine.execute("EXPLAIN QUERY PLAN " + statement, parameters).fetchall()
+                self.assertIn(index, " ".join(row[-1] for row in plan), url)
+
+
+    def test_pattern_indexes_only_on_postgresql(self):
+
+        with self.app.app_context():
+            engine = self.app.extensions["sqlalchemy"].db.engine
+            names = {index["name"] for table in ("actors", "movies") for index in inspect(engine).get_indexes(table)}
+        self.assertNotIn("ix_actors_name_pattern", names)
+        self.assertNotIn("ix_movies_title_pattern", names)
+
+        index = next(index for index in Actors.__table__.indexes if index.name == "ix_actors_name_pattern")
+        ddl = str(CreateIndex(index).compile(dialect=postgresql.dialect()))
+        self.assertEqual(ddl, "CREATE INDEX ix_actors_name_pattern ON actors (name varchar_pattern_ops)")
+
+class PoolStatsTestCase(LocalAuthTestCase):
+
+    def test_engine_options(self):
+
+        options = engine_options("postgresql://localhost/casting")
+        self.assertIs(options["poolclass"], InstrumentedQueuePool)
+        self.assertIn("pool_size", options)
+        self.assertTrue(options["pool_pre_ping"])
+
+        # SQLite keeps its own pool
+        self.assertNotIn("pool_size", engine_options("sqlite://"))
+
+    def test_checkout_overflow_and_timeout(self):
+
+        pool_stats.reset()
+        engine = create_engine(
+            "sqlite://", poolclass=InstrumentedQueuePool,
+            pool_size=1, max_overflow=1, pool_timeout=0.05
+        )
+        first = engine.connect()
+        second = engine.connect()
+        with self.assertRaises(exc.TimeoutError):
+            engine.connect()
+
+        # while the overflow connection is out, reusing the pooled one does
+        # not count as overflow
+        first.close()
+        engine.connect().close()
+        second.close()
+
+        stats = pool_stats.snapshot(engine.pool)
+        self.assertEqual(stats["checkouts"], 3)
+        self.assertEqual(stats["overflow_checkouts"], 1)
+        self.assertEqual(stats["overflow_max"], 1)
+        self.assertEqual(stats["timeouts"], 1)
+        self.assertGreaterEqual(stats["wait_max_ms"], 0)
+        self.assertEqual(stats["checked_out"], 0)
+
+    def test_internal_stats_endpoint(self):
+
+        res = self.client().get("/internal/stats", headers=self.headers("get:stats"))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn("timeouts", data["pool"])
+        self.assertEqual(data["token_cache"]["misses"], 1)
+
+        res = self.client().get("/internal/stats", headers=self.headers("get:actors"))
+        self.assertEqual(res.status_code, 403)
+
+class ReadReplicaTestCase(LocalAuthTestCase):
+
+    def setUp(self):
+
+        # two SQLite files stand in for the primary and the replica
+        self.tmp = tempfile.TemporaryDirectory()
+        self.database_url = "sqlite:///" + os.path.join(self.tmp.name, "primary.sqlite")
+        self.replica_dir = os.path.join(self.tmp.name, "replica")
+        os.mkdir(self.replica_dir)
+        self.replica_path = os.path.join(self.replica_dir, "replica.sqlite")
+        replica_engine = create_engine("sqlite:///" + self.replica_path)
+        db.metadata.create_all(replica_engine)
+        replica_engine.execute(Actors.__table__.insert(), name="Replica Actor", age=30, gender="Female")
+        replica_engine.execute(TableVersions.__table__.insert(), name="actors", version=0)
+        replica_engine.dispose()
+
+        self.env = mock.patch.dict(os.environ, {
+            "POSTGRES_REPLICA_URL": "sqlite:///" + self.replica_path
+        })
+        self.env.start()
+        self.health = mock.patch.object(replica, "replica_health", replica.ReplicaHealth())
+        self.health.start()
+        self.writers = mock.patch.object(replica, "recent_writers", replica.RecentWriters())
+        self.writers.start()
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        self.writers.stop()
+        self.health.stop()
+        self.env.stop()
+        self.tmp.cleanup()
+
+    def names(self, headers):
+        data = json.loads(self.client().get("/actors", headers=headers).data)
+        return [actor["name"] for actor in data["actors"]]
+
+    def test_reads_go_to_replica(self):
+
+        self.assertEqual(self.names(self.headers("get:actors")), ["Replica Actor"])
+
+    def test_read_your_writes(self):
+
+        headers = self.headers("get:actors", "post:actors")
+        res = self.client().post("/actors", json={"name": "Kim Hunter", "age": 79, "gender": "Female"}, headers=headers)
+        self.assertEqual(res.status_code, 200)
+
+        # the writer reads from the primary during the window
+        self.assertEqual(self.names(headers), ["Charlton Heston", "Kim Hunter"])
+
+        # other clients keep reading from the replica
+        self.assertEqual(self.names(self.headers("get:actors", sub="local|other")), ["Replica Actor"])
+
+        # after the window the writer is back on the replica
+        with mock.patch.object(replica, "READ_YOUR_WRITES_WINDOW", 0):
+            self.assertEqual(self.names(headers), ["Replica Actor"])
+
+    def test_fallback_to_primary_when_replica_down(self):
+
+        os.remove(self.replica_path)
+        os.rmdir(self.replica_dir)
+
+        self.assertEqual(self.names(self.headers("get:actors")), ["Charlton Heston"])
+        self.assertFalse(replica.replica_health.healthy)
+
+    def test_read_retried_on_primary_when_replica_fails(self):
+
+        headers = self.headers("get:actors")
+        self.assertEqual(self.names(headers), ["Replica Actor"])
+
+        # the replica goes away after its health check passed
+        os.remove(self.replica_path)
+        os.rmdir(self.replica_dir)
+        with self.app.app_context():
+            db.get_engine(self.app, bind="replica").dispose()
+        self.assertTrue(replica.replica_health.healthy)
+
+        self.assertEqual(self.names(headers), ["Charlton Heston"])
+        res = self.client().get("/actors/1", headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertFalse(replica.replica_health.healthy)
+
+    def test_writes_set_no_cookie(self):
+
+        headers = self.headers("get:actors", "post:actors")
+        res = self.client().post("/actors", json={"name": "Kim Hunter", "age": 79, "gender": "Female"}, headers=headers)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn("Set-Cookie", res.headers)
+
+class ResponseCacheTestCase(LocalAuthTestCase):
+
+    def test_repeat_page_served_from_cache(self):
+
+        headers = self.headers("get:movies")
+        first = self.client().get("/movies?limit=5", headers=headers)
+        with mock.patch("casting.routes.paginate") as paginate:
+            second = self.client().get("/movies?limit=5", headers=headers)
+            self.assertFalse(paginate.called)
+
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(second.headers["ETag"], first.headers["ETag"])
+        self.assertEqual(response_cache.stats()["hits"], 1)
+        self.assertEqual(response_cache.stats()["bytes"], len(first.data))
+
+    def test_write_invalidates_its_table_only(self):
+
+        headers = self.headers("get:movies", "get:actors", "patch:movies")
+        self.client().get("/movies", headers=headers)
+        self.client().get("/actors", headers=headers)
+        self.assertEqual(response_cache.stats()["entries"], 2)
+
+        self.client().patch("/movies/1", json={"title": "Escape", "release_date": 1971}, headers=headers)
+        self.assertEqual(response_cache.stats()["entries"], 1)
+        self.assertEqual(response_cache.stats()["invalidations"], 1)
+
+        data = json.loads(self.client().get("/movies", headers=headers).data)
+        self.assertEqual(data["movies"][0]["title"], "Escape")
+
+    def test_rolled_back_write_keeps_entries(self):
+
+        self.client().get("/movies", headers=self.headers("get:movies"))
+        with self.app.app_context():
+            Movies.query.get(1).title = "Escape"
+            db.session.flush()
+            db.session.rollback()
+
+        self.assertEqual(response_cache.stats()["entries"], 1)
+
+    def test_bounded_by_entries_and_bytes(self):
+
+        cache = ResponseCache(maxsize=2, max_bytes=10)
+        cache.put("a", "movies", b"1234")
+        cache.put("b", "movies", b"1234")
+        cache.put("c", "movies", b"1234")
+        self.assertIsNone(cache.get("a"))
+
+        cache.put("d", "actors", b"12345678")
+        stats = cache.stats()
+        self.assertEqual(stats["entries"], 1)
+        self.assertEqual(stats["bytes"], 8)
+        self.assertEqual(stats["evictions"], 3)
+
+    def test_entries_expire(self):
+
+        cache = ResponseCache(ttl=0)
+        cache.put("a", "movies", b"{}")
+
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+class FastJSONTestCase(LocalAuthTestCase):
+
+    def test_backend_selection(self):
+
+        self.assertEqual(fastjson.get_backend("stdlib")[0], "stdlib")
+        with mock.patch.object(fastjson, "orjson", None):
+            self.assertEqual(fastjson.get_backend("auto")[0], "stdlib")
+            self.assertEqual(fastjson.get_backend("orjson")[0], "stdlib")
+        with self.assertRaises(ValueError):
+            fastjson.get_backend("simplejson")
+
+    def test_backends_encode_the_same(self):
+
+        data = {"success": True, "actors": [{"id": 1, "name": "Zoë", "age": 84}]}
+        for name in fastjson.BACKENDS:
+            if name == "orjson" and fastjson.orjson is None:
+                continue
+            self.assertEqual(json.loads(fastjson.BACKENDS[name](data)), data)
+
+    def test_list_rows_match_read(self):
+
+        res = self.client().get("/actors", headers=self.headers("get:actors"))
+        data = json.loads(res.data)
+
+        with self.app.app_context():
+            self.assertEqual(data["actors"], [actor.read() for actor in Actors.query.all()])
+
+class SingleStatementWriteTestCase(LocalAuthTestCase):
+
+    def statements(self, method, url, **kwargs):
+        with self.capture_statements() as statements:
+            res = getattr(self.client(), method)(url, **kwargs)
+        return res, [statement.split()[0] for statement, parameters in statements]
+
+    def test_update_actor_single_statement(self):
+
+        res, statements = self.statements(
+            "patch", "/actors/1",
+            json={"name": "Roddy McDowall", "age": 70, "gender": "Male"},
+            headers=self.headers("patch:actors")
+        )
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["actors"], [{"id": 1, "name": "Roddy McDowall", "age": 70, "gender": "Male"}])
+        # SQLite emulates RETURNING with a SELECT in the same transaction
+        self.assertEqual(statements, ["UPDATE", "SELECT"])
+
+    def test_update_movie_invalid_data(self):
+
+        res = self.client().patch("/movies/1", json={"title": "Escape"}, headers=self.headers("patch:movies"))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data["message"], "unprocessable")
+
+    def test_delete_movie_single_statement(self):
+
+        res, statements = self.statements("delete", "/movies/1", headers=self.headers("delete:movies"))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(statements, ["DELETE"])
+
+        res = self.client().delete("/movies/1", headers=self.headers("delete:movies"))
+        self.assertEqual(res.status_code, 404)
+
+    def test_write_bumps_version(self):
+
+        headers = self.headers("get:actors", "delete:actors")
+        etag = self.client().get("/actors", headers=headers).headers["ETag"]
+        self.client().delete("/actors/1", headers=headers)
+        res = self.client().get("/actors", headers=dict(headers, **{"If-None-Match": etag}))
+
+        self.assertEqual(res.status_code, 404)
+
+
+class UnitOfWorkTestCase(LocalAuthTestCase):
+
+    def count_commits(self):
+        commits = []
+
+        def count(session):
+            commits.append(session)
+
+        event.listen(db.session, "after_commit", count)
+        self.addCleanup(event.remove, db.session, "after_commit", count)
+        return commits
+
+    def test_writes_commit_once(self):
+
+        with self.app.app_context():
+            commits = self.count_commits()
+            with unit_of_work():
+                actor = Actors(name="Kim Hunter", age=79, gender="Female")
+                actor.insert()
+                # flushed, so the new id is already known
+                self.assertIsNotNone(actor.id)
+                Movies(title="Beneath the Planet of the Apes", release_date=1970).insert()
+                bulk_insert(Actors, [{"name": "Linda Harrison", "age": 76, "gender": "Female"}])
+                movie = Movies.query.get(1)
+                movie.title = "Planet of the Apes"
+                movie.update()
+
+            self.assertEqual(len(commits), 1)
+            self.assertEqual(Actors.query.count(), 3)
+            self.assertEqual(Movies.query.get(1).title, "Planet of the Apes")
+
+    def test_error_rolls_back_all(self):
+
+        with self.app.app_context():
+            with self.assertRaises(exc.IntegrityError):
+                with unit_of_work():
+                    Actors(name="Kim Hunter", age=79, gender="Female").insert()
+                    Actors(name="Nobody", age=None, gender="Male").insert()
+
+            self.assertEqual(Actors.query.count(), 1)
+
+    def test_savepoint_keeps_other_writes(self):
+
+        with self.app.app_context():
+            with unit_of_work():
+                Actors(name="Kim Hunter", age=79, gender="Female").insert()
+                try:
+                    with savepoint():
+                        Actors(name="Nobody", age=None, gender="Male").insert()
+                except exc.IntegrityError:
+                    pass
+                Actors(name="Linda Harrison", age=76, gender="Female").insert()
+
+            names = sorted(actor.name for actor in Actors.query.all())
+            self.assertEqual(names, ["Charlton Heston", "Kim Hunter", "Linda Harrison"])
+
+    def test_nested_and_decorator(self):
+
+        @unit_of_work()
+        def cast(name):
+            Actors(name=name, age=50, gender="Male").insert()
+
+        with self.app.app_context():
+            commits = self.count_commits()
+            with unit_of_work():
+                cast("Maurice Evans")
+                cast("James Whitmore")
+
+            self.assertEqual(len(commits), 1)
+            self.assertEqual(Actors.query.count(), 3)
+
+
+class BatchTestCase(LocalAuthTestCase):
+
+    def batch(self, operations, *permissions, **kwargs):
+        headers = self.headers(*permissions)
+        res = self.client().post("/batch", json=dict(kwargs, operations=operations), headers=headers)
+        return res, json.loads(res.data)
+
+    def test_batch_runs_operations_under_one_token_check(self):
+
+        with mock.patch.object(auth, "verify_decode_jwt", wraps=auth.verify_decode_jwt) as verify:
+            res, data = self.batch([
+                {"method": "POST", "path": "/actors", "body": {"name": "Kim Hunter", "age": 79, "gender": "Female"}},
+                {"method": "PATCH", "path": "/movies/1", "body": {"title": "Planet of the Apes", "release_date": 1968}},
+                {"method": "DELETE", "path": "/actors/1"},
+                {"method": "GET", "path": "/actors"},
+            ], "post:actors", "patch:movies", "delete:actors", "get:actors")
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data["success"])
+        self.assertEqual([result["status"] for result in data["results"]], [200, 200, 200, 200])
+        self.assertEqual(data["results"][1]["body"]["movies"][0]["title"], "Planet of the Apes")
+        self.assertEqual([actor["name"] for actor in data["results"][3]["body"]["actors"]], ["Kim Hunter"])
+        self.assertEqual(verify.call_count, 1)
+
+    def test_atomic_batch_rolls_back_on_failure(self):
+
+        res, data = self.batch([
+            {"method": "POST", "path": "/actors", "body": {"name": "Kim Hunter", "age": 79, "gender": "Female"}},
+            {"method": "PATCH", "path": "/movies/99", "body": {"title": "Escape", "release_date": 1971}},
+            {"method": "DELETE", "path": "/actors/1"},
+        ], "post:actors", "patch:movies", "delete:actors", "get:actors")
+
+        self.assertFalse(data["success"])
+        self.assertEqual([result["status"] for result in data["results"]], [200, 404, 424])
+        res = self.client().get("/actors", headers=self.headers("get:actors"))
+        self.assertEqual([actor["name"] for actor in json.loads(res.data)["actors"]], ["Charlton Heston"])
+
+    def test_independent_batch(self):
+
+        res, data = self.batch([
+            {"method": "POST", "path": "/actors", "body": {"name": "Kim Hunter", "age": 79, "gender": "Female"}},
+            {"method": "DELETE", "path": "/actors/99"},
+            {"method": "POST", "path": "/actors", "body": {"name": "Linda Harrison", "age": 76, "gender": "Female"}},
+        ], "post:actors", "delete:actors", atomic=False)
+
+        self.assertFalse(data["success"])
+        self.assertEqual([result["status"] for result in data["results"]], [200, 404, 200])
+        with self.app.app_context():
+            self.assertEqual(Actors.query.count(), 3)
+
+    def test_batch_operation_error_fails_that_operation_only(self):
+
+        operations = [
+            {"method": "POST", "path": "/actors", "body": {"name": "Kim Hunter", "age": 79, "gender": "Female"}},
+            {"method": "PATCH", "path": "/movies/1", "body": "Escape"},
+            {"method": "POST", "path": "/actors", "body": {"name": "Linda Harrison", "age": 76, "gender": "Female"}},
+        ]
+        with mock.patch.object(self.app, "log_exception") as log:
+            res, data = self.batch(operations, "post:actors", "patch:movies", atomic=False)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([result["status"] for result in data["results"]], [200, 500, 200])
+        self.assertEqual(data["results"][1]["body"]["error"], 500)
+        self.assertEqual(log.call_count, 1)
+        with self.app.app_context():
+            self.assertEqual(Actors.query.count(), 3)
+
+        with mock.patch.object(self.app, "log_exception"):
+            res, data = self.batch([
+                {"method": "POST", "path": "/actors", "body": {"name": "Maurice Evans", "age": 87, "gender": "Male"}},
+            ] + operations[1:], "post:actors", "patch:movies")
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([result["status"] for result in data["results"]], [200, 500, 424])
+        with self.app.app_context():
+            self.assertEqual(Actors.query.count(), 3)
+
+    def test_batch_checks_each_permission(self):
+
+        res, data = self.batch([
+            {"method": "POST", "path": "/actors", "body": {"name": "Kim Hunter", "age": 79, "gender": "Female"}},
+            {"method": "DELETE", "path": "/actors/1"},
+        ], "post:actors", atomic=False)
+
+        self.assertEqual([result["status"] for result in data["results"]], [200, 403])
+        self.assertEqual(data["results"][1]["body"]["code"], "unauthorized")
+
+    def test_batch_bad_operations(self):
+
+        res, data = self.batch([
+            {"method": "GET", "path": "/directors"},
+            {"method": "POST", "path": "/batch", "body": {"operations": []}},
+            {"path": 3},
+        ], "get:actors", atomic=False)
+
+        self.assertEqual([result["status"] for result in data["results"]], [404, 400, 400])
+
+        res = self.client().post("/batch", json={"operations": []}, headers=self.headers("get:actors"))
+        self.assertEqual(res.status_code, 400)
+        res = self.client().post("/batch", json={"operations": [{"path": "/actors"}]})
+        self.assertEqual(res.status_code, 401)
+
+    def test_uncommitted_pages_are_not_cached(self):
+
+        self.batch([
+            {"method": "GET", "path": "/actors"},
+            {"method": "POST", "path": "/actors", "body": {"name": "Kim Hunter", "age": 79, "gender": "Female"}},
+            {"method": "GET", "path": "/actors"},
+            {"method": "DELETE", "path": "/actors/99"},
+        ], "get:actors", "post:actors", "delete:actors")
+
+        # the second page was read under a table version that was rolled
+        # back, another worker may commit different rows under it
+        self.assertEqual(response_cache.stats()["entries"], 1)
+
+
+class CastTestCase(LocalAuthTestCase):
+
+    # Add movies with three new actors each, numbered after the ones added
+    # before since titles and names are unique
+    def add_movies(self, count):
+        with self.app.app_context():
+            first = Movies.query.count() - 1
+            for i in range(first, first + count):
+                movie = Movies(title=f"Movie {i}", release_date=1970 + i)
+                movie.cast = [Actors(name=f"Actor {i}.{j}", age=30 + j, gender="Male") for j in range(3)]
+                movie.insert()
+
+    def count_statements(self, url, headers):
+        with self.capture_statements(versions=True) as statements:
+            res = self.client().get(url, headers=headers)
+        return res, len(statements)
+
+    def test_read_cast_and_movies(self):
+
+        res = self.client().get("/movies/1/cast", headers=self.headers("get:movies"))
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["cast"], [{"id": 1, "name": "Charlton Heston", "age": 84, "gender": "Male"}])
+
+        res = self.client().get("/actors/1/movies", headers=self.headers("get:actors"))
+        self.assertEqual(json.loads(res.data)["movies"], [{"id": 1, "title": " Planet of the Apes", "release_date": 1968}])
+
+        res = self.client().get("/movies/99/cast", headers=self.headers("get:movies"))
+        self.assertEqual(res.status_code, 404)
+
+    def test_replace_cast(self):
+
+        self.add_actors(2)
+        headers = self.headers("get:actors", "patch:movies")
+        res = self.client().put("/movies/1/cast", json={"actors": [3, 2]}, headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([actor["id"] for actor in data["cast"]], [2, 3])
+        res = self.client().get("/actors/1/movies", headers=headers)
+        self.assertEqual(json.loads(res.data)["movies"], [])
+
+        res = self.client().put("/movies/1/cast", json={"actors": [99]}, headers=headers)
+        self.assertEqual(res.status_code, 422)
+        res = self.client().put("/movies/99/cast", json={"actors": [2]}, headers=headers)
+        self.assertEqual(res.status_code, 404)
+        res = self.client().put("/movies/1/cast", json={"actors": ["2"]}, headers=headers)
+        self.assertEqual(res.status_code, 400)
+
+    def test_cast_change_bumps_both_tables(self):
+
+        self.add_actors(1)
+        headers = self.headers("get:actors", "get:movies", "patch:movies")
+        actors_etag = self.client().get("/actors?include=movies", headers=headers).headers["ETag"]
+        movies_etag = self.client().get("/movies?include=cast", headers=headers).headers["ETag"]
+        self.client().put("/movies/1/cast", json={"actors": [2]}, headers=headers)
+
+        res = self.client().get("/actors?include=movies", headers=dict(headers, **{"If-None-Match": actors_etag}))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([actor["movies"] for actor in json.loads(res.data)["actors"]],
+                         [[], [{"id": 1, "title": " Planet of the Apes", "release_date": 1968}]])
+        res = self.client().get("/movies?include=cast", headers=dict(headers, **{"If-None-Match": movies_etag}))
+        self.assertEqual(res.status_code, 200)
+
+    def test_delete_actor_leaves_cast(self):
+
+        headers = self.headers("get:movies", "delete:actors")
+        self.client().delete("/actors/1", headers=headers)
+        res = self.client().get("/movies/1/cast", headers=headers)
+
+        self.assertEqual(json.loads(res.data)["cast"], [])
+
+    def test_include_follows_writes_on_the_other_table(self):
+
+        headers = self.headers("get:movies", "patch:actors")
+        res = self.client().get("/movies?include=cast", headers=headers)
+        etag = res.headers["ETag"]
+        self.assertEqual(json.loads(res.data)["movies"][0]["cast"][0]["name"], "Charlton Heston")
+
+        self.client().patch("/actors/1", json={"name": "Roddy McDowall", "age": 70, "gender": "Male"}, headers=headers)
+        res = self.client().get("/movies?include=cast", headers=dict(headers, **{"If-None-Match": etag}))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers["ETag"], etag)
+        self.assertEqual(json.loads(res.data)["movies"][0]["cast"][0]["name"], "Roddy McDowall")
+        with self.app.app_context():
+            self.assertNotIn(etag, [key[-1] for key in response_cache._entries])
+
+    def test_include_cast_statement_count_is_constant(self):
+
+        headers = self.headers("get:movies")
+        self.add_movies(4)
+        res, small = self.count_statements("/movies?include=cast&limit=5", headers)
+        movies = json.loads(res.data)["movies"]
+        self.assertEqual(len(movies), 5)
+        self.assertEqual([actor["name"] for actor in movies[1]["cast"]], ["Actor 0.0", "Actor 0.1", "Actor 0.2"])
+
+        self.add_movies(45)
+        res, large = self.count_statements("/movies?include=cast&limit=50", headers)
+        self.assertEqual(len(json.loads(res.data)["movies"]), 50)
+        self.assertEqual(small, large)
+
+    def test_include_bad_relation(self):
+
+        res = self.client().get("/movies?include=movies", headers=self.headers("get:movies"))
+        self.assertEqual(res.status_code, 400)
+
+
+class SearchTestCase(LocalAuthTestCase):
+
+    def setUp(self):
+        super().setUp()
+        with self.app.app_context():
+            bulk_insert(Movies, [
+                {"title": "Escape from the Planet of the Apes", "release_date": 1971},
+                {"title": "The Ten Commandments", "release_date": 1956},
+                {"title": "Planet Earth", "release_date": 2006},
+            ])
+            Actors(name="Kim Hunter", age=79, gender="Female").insert()
+
+    def search(self, query, *permissions):
+        res = self.client().get("/search?" + query, headers=self.headers(*(permissions or ("get:movies", "get:actors"))))
+        return res, json.loads(res.data)
+
+    def test_search_ranks_matches(self):
+
+        res, data = self.search("q=planet apes")
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([row["id"] for row in data["results"]], [1, 2])
+        self.assertEqual(data["results"][0], {"type": "movies", "id": 1, "title": " Planet of the Apes", "release_date": 1968})
+
+    def test_search_prefixes_and_both_tables(self):
+
+        res, data = self.search("q=c")
+        names = [(row["type"], row["id"]) for row in data["results"]]
+
+        self.assertEqual(sorted(names), [("actors", 1), ("movies", 3)])
+
+        res, data = self.search("q=h")
+        self.assertEqual([row["name"] for row in data["results"]], ["Charlton Heston", "Kim Hunter"])
+
+    def test_search_follows_writes(self):
+
+        headers = self.headers("patch:movies", "delete:movies")
+        self.client().patch("/movies/4", json={"title": "Blue Planet", "release_date": 2001}, headers=headers)
+        self.client().delete("/movies/1", headers=headers)
+        res, data = self.search("q=planet")
+
+        self.assertEqual([row["title"] for row in data["results"]],
+                         ["Blue Planet", "Escape from the Planet of the Apes"])
+
+    def test_search_pages(self):
+
+        res, data = self.search("q=planet&limit=2")
+        self.assertEqual(len(data["results"]), 2)
+        self.assertEqual(data["next_offset"], 2)
+
+        res, data = self.search("q=planet&limit=2&offset=2")
+        self.assertEqual(len(data["results"]), 1)
+        self.assertIsNone(data["next_offset"])
+
+    def test_search_permissions_and_bad_query(self):
+
+        res, data = self.search("q=he", "get:actors")
+        self.assertEqual({row["type"] for row in data["results"]}, {"actors"})
+
+        res, data = self.search("q=he&type=movies", "get:actors")
+        self.assertEqual(res.status_code, 403)
+
+        res, data = self.search('q="*')
+        self.assertEqual(res.status_code, 400)
+
+
+class StatsTestCase(LocalAuthTestCase):
+
+    def setUp(self):
+        super().setUp()
+        with self.app.app_context():
+            bulk_insert(Actors, [
+                {"name": "Kim Hunter", "age": 79, "gender": "Female"},
+                {"name": "Roddy McDowall", "age": 70, "gender": "Male"},
+                {"name": "Linda Harrison", "age": 76, "gender": "Female"},
+            ])
+            bulk_insert(Movies, [
+                {"title": "Beneath the Planet of the Apes", "release_date": 1970},
+                {"title": "Escape from the Planet of the Apes", "release_date": 1971},
+                {"title": "Planet of the Apes", "release_date": 1968},
+            ])
+
+    def get_stats(self):
+        with self.capture_statements(versions=True) as statements:
+            res = self.client().get("/stats", headers=self.headers("get:actors", "get:movies"))
+        return json.loads(res.data), [statement for statement, parameters in statements]
+
+    def test_stats_grouped_in_sql(self):
+
+        data, statements = self.get_stats()
+
+        self.assertEqual(data["actors"]["total"], 4)
+        self.assertEqual(data["actors"]["by_gender"], [{"gender": "Female", "count": 2}, {"gender": "Male", "count": 2}])
+        self.assertEqual(data["actors"]["by_age"], [
+            {"age_min": 70, "age_max": 79, "count": 3},
+            {"age_min": 80, "age_max": 89, "count": 1},
+        ])
+        self.assertEqual(data["movies"]["total"], 4)
+        self.assertEqual(data["movies"]["by_release_date"], [
+            {"release_date": 1968, "count": 2},
+            {"release_date": 1970, "count": 1},
+            {"release_date": 1971, "count": 1},
+        ])
+        self.assertEqual(sum("GROUP BY" in statement for statement in statements), 3)
+
+    def test_stats_cached_until_write(self):
+
+        self.get_stats()
+        data, statements = self.get_stats()
+        self.assertFalse(any("GROUP BY" in statement for statement in statements))
+
+        self.client().delete("/movies/2", headers=self.headers("delete:movies"))
+        data, statements = self.get_stats()
+        self.assertEqual(data["movies"]["total"], 3)
+        self.assertTrue(any("GROUP BY" in statement for statement in statements))
+
+    def test_stats_follow_movie_writes(self):
+
+        self.get_stats()
+        self.assertEqual(response_cache.stats()["entries"], 1)
+
+        self.client().patch("/movies/4", json={"title": "Planet of the Apes", "release_date": 2001},
+                            headers=self.headers("patch:movies"))
+        self.assertEqual(response_cache.stats()["entries"], 0)
+        data, statements = self.get_stats()
+        self.assertEqual(data["movies"]["by_release_date"][0], {"release_date": 1968, "count": 1})
+        self.assertEqual(data["movies"]["by_release_date"][-1], {"release_date": 2001, "count": 1})
+
+    def test_stats_view_migration_uses_age_bucket(self):
+
+        path = os.path.join(os.path.dirname(__file__), "migrations", "versions", "c3e8f1a7d926_stats_view.py")
+        spec = importlib.util.spec_from_file_location("stats_view", path)
+        migration = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(migration)
+        op = mock.Mock()
+        op.get_bind.return_value.dialect.name = "postgresql"
+
+        with mock.patch.object(migration, "op", op), mock.patch.object(migration, "STATS_AGE_BUCKET", 5):
+            migration.upgrade()
+
+        statements = [call.args[0] for call in op.execute.call_args_list]
+        self.assertIn("GROUP BY age / 5 * 5", statements[0])
+        self.assertIn("ix_stats_summary", statements[1])
+
+    def test_stats_needs_both_permissions(self):
+
+        res = self.client().get("/stats", headers=self.headers("get:actors"))
+        self.assertEqual(res.status_code, 403)
+
+
+class ReadByIdTestCase(LocalAuthTestCase):
+
+    def test_read_single_actor(self):
+
+        headers = self.headers("get:actors")
+        res = self.client().get("/actors/1", headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["actors"], [{"id": 1, "name": "Charlton Heston", "age": 84, "gender": "Male"}])
+
+        res = self.client().get("/actors/1", headers=dict(headers, **{"If-None-Match": res.headers["ETag"]}))
+        self.assertEqual(res.status_code, 304)
+
+        res = self.client().get("/actors/99", headers=headers)
+        self.assertEqual(res.status_code, 404)
+
+    def test_read_single_movie_cached(self):
+
+        headers = self.headers("get:movies", "patch:movies")
+        self.client().get("/movies/1", headers=headers)
+        res = self.client().get("/movies/1", headers=headers)
+        self.assertEqual(response_cache.stats()["hits"], 1)
+
+        self.client().patch("/movies/1", json={"title": "Planet of the Apes", "release_date": 1968}, headers=headers)
+        res = self.client().get("/movies/1", headers=headers)
+        self.assertEqual(json.loads(res.data)["movies"][0]["title"], "Planet of the Apes")
+
+    def test_multi_get_keeps_order_and_reports_missing(self):
+
+        self.add_actors(4)
+        with self.capture_statements() as statements:
+            res = self.client().get("/actors?ids=4,99,2,4,1", headers=self.headers("get:actors"))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([actor["id"] for actor in data["actors"]], [4, 2, 1])
+        self.assertEqual(data["missing"], [99])
+        self.assertEqual(len(statements), 1)
+        self.assertIn(" IN ", statements[0][0])
+
+    def test_multi_get_limits(self):
+
+        headers = self.headers("get:movies")
+        res = self.client().get("/movies?ids=1,a", headers=headers)
+        self.assertEqual(res.status_code, 400)
+
+        with mock.patch("casting.routes.MAX_PAGE_SIZE", 2):
+            res = self.client().get("/movies?ids=1,2,3", headers=headers)
+        self.assertEqual(res.status_code, 413)
+
+        res = self.client().get("/movies?ids=1&include=cast", headers=headers)
+        self.assertEqual(json.loads(res.data)["movies"][0]["cast"][0]["name"], "Charlton Heston")
+
+
+class BulkDeleteTestCase(LocalAuthTestCase):
+
+    def delete(self, url, *permissions):
+        with self.capture_statements() as statements:
+            res = self.client().delete(url, headers=self.headers(*(permissions or ("delete:actors",))))
+        return res, [statement.split()[0] for statement, parameters in statements]
+
+    def remaining(self):
+        with self.app.app_context():
+            return [actor.id for actor in Actors.query.order_by(Actors.id)]
+
+    def test_delete_id_list(self):
+
+        self.add_actors(4)
+        res, statements = self.delete("/actors?ids=4,2,99")
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual((data["deleted"], data["ids"], data["dry_run"]), (2, [2, 4], False))
+        self.assertEqual(statements.count("DELETE"), 1)
+        self.assertEqual(self.remaining(), [1, 3, 5])
+
+    def test_delete_range(self):
+
+        self.add_actors(4)
+        res, statements = self.delete("/actors?id_min=2&id_max=4")
+        data = json.loads(res.data)
+
+        self.assertEqual(data["ids"], [2, 3, 4])
+        self.assertEqual(statements.count("DELETE"), 1)
+        self.assertEqual(self.remaining(), [1, 5])
+
+    def test_delete_range_over_the_maximum(self):
+
+        self.add_actors(4)
+        with mock.patch("casting.routes.MAX_BULK_SIZE", 3):
+            res, statements = self.delete("/actors?id_min=2&id_max=100000")
+            self.assertEqual(res.status_code, 413)
+            self.assertNotIn("DELETE", statements)
+            self.assertEqual(self.remaining(), [1, 2, 3, 4, 5])
+
+            res, statements = self.delete("/actors?id_min=3&id_max=100000")
+        self.assertEqual(json.loads(res.data)["ids"], [3, 4, 5])
+        self.assertEqual(self.remaining(), [1, 2])
+
+    def test_dry_run(self):
+
+        self.add_actors(2)
+        res, statements = self.delete("/actors?id_min=1&id_max=2&dry_run=true")
+        data = json.loads(res.data)
+
+        self.assertEqual((data["deleted"], data["ids"], data["dry_run"]), (2, [1, 2], True))
+        self.assertNotIn("DELETE", statements)
+        self.assertEqual(self.remaining(), [1, 2, 3])
+
+    def test_delete_movies_removes_cast(self):
+
+        res, statements = self.delete("/movies?ids=1", "delete:movies")
+        res = self.client().get("/actors/1/movies", headers=self.headers("get:actors"))
+
+        self.assertEqual(json.loads(res.data)["movies"], [])
+
+    def test_bad_selection(self):
+
+        for url in ("/actors", "/actors?id_min=3&id_max=2", "/actors?id_min=1", "/actors?ids=1&id_min=1&id_max=2"):
+            res, statements = self.delete(url)
+            self.assertEqual(res.status_code, 400)
+
+        with mock.patch("casting.routes.MAX_BULK_SIZE", 2):
+            res, statements = self.delete("/actors?ids=1,2,3")
+        self.assertEqual(res.status_code, 413)
+
+        res, statements = self.delete("/actors?ids=1", "delete:movies")
+        self.assertEqual(res.status_code, 403)
+
+
+class ExportTestCase(LocalAuthTestCase):
+
+    def add_rows(self, count):
+        with self.app.app_context():
+            first = Actors.query.count() - 1
+            bulk_insert(Actors, [
+                {"name": f"Actor {i}", "age": 20 + i % 60, "gender": "Female" if i % 2 else "Male"}
+                for i in range(first, first + count)
+            ])
+
+    # Peak memory allocated while reading a streamed export
+    def export_peak(self):
+        res = self.client().get("/actors/export", headers=self.headers("get:actors"), buffered=False)
+        tracemalloc.start()
+        try:
+            size = sum(len(chunk) for chunk in res.response)
+            return size, tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+            res.close()
+
+    def test_export_csv(self):
+
+        self.add_rows(2)
+        res = self.client().get("/actors/export", headers=self.headers("get:actors"))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, "text/csv")
+        self.assertEqual(res.headers["Content-Disposition"], "attachment; filename=actors.csv")
+        self.assertEqual(res.data.decode().splitlines(), [
+            "id,name,age,gender",
+            "1,Charlton Heston,84,Male",
+            "2,Actor 0,20,Male",
+            "3,Actor 1,21,Female",
+        ])
+
+    def test_export_gzip(self):
+
+        self.add_rows(100)
+        headers = self.headers("get:movies", "get:actors")
+        plain = self.client().get("/actors/export", headers=headers).data
+        res = self.client().get("/actors/export", headers=dict(headers, **{"Accept-Encoding": "gzip"}))
+
+        self.assertEqual(res.headers["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(res.data), plain)
+
+    def test_export_memory_is_flat(self):
+
+        with mock.patch("casting.transfer.EXPORT_CHUNK_SIZE", 100):
+            self.add_rows(1000)
+            small_size, small_peak = self.export_peak()
+            self.add_rows(9000)
+            large_size, large_peak = self.export_peak()
+
+        self.assertGreater(large_size, 9 * small_size)
+        self.assertLess(large_peak, 2 * small_peak)
+
+    def test_export_command(self):
+
+        self.add_rows(10)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "movies.csv.gz")
+            result = self.app.test_cli_runner().invoke(args=["export", "movies", "-o", path])
+            with gzip.open(path, "rt") as file:
+                lines = file.read().splitlines()
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(lines, ["id,title,release_date", "1, Planet of the Apes,1968"])
+
+
+class ImportTestCase(LocalAuthTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def write(self, name, text):
+        path = os.path.join(self.directory.name, name)
+        with open(path, "w") as file:
+            file.write(text)
+        return path
+
+    def names(self):
+        with self.app.app_context():
+            return [actor.name for actor in Actors.query.order_by(Actors.id)][1:]
+
+    def test_import_csv_in_chunks(self):
+
+        path = self.write("actors.csv", "id,name,age,gender\n" + "".join(
+            f"{i},Actor {i},{20 + i},Female\n" for i in range(25)
+        ) + "99,Nobody,old,Male\n")
+        commits = []
+
+        def count(session):
+            commits.append(session)
+
+        with self.app.app_context():
+            event.listen(db.session, "after_commit", count)
+            try:
+                report = transfer.import_file(Actors, path, chunk_size=10)
+            finally:
+                event.remove(db.session, "after_commit", count)
+
+        self.assertEqual((report["loaded"], report["rejected"]), (25, 1))
+        self.assertEqual(report["errors"], [{"row": 26, "errors": ["age must be an integer"]}])
+        self.assertEqual(len(commits), 3)
+        self.assertEqual(self.names(), [f"Actor {i}" for i in range(25)])
+
+    def test_import_ndjson_command(self):
+
+        path = self.write("movies.ndjson", '{"title": "Beneath the Planet of the Apes", "release_date": 1970}\n\n'
+                                          '{"title": "Escape from the Planet of the Apes", "release_date": 1971}\n')
+        result = self.app.test_cli_runner().invoke(args=["import", "movies", path])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Imported 2 movies (0 rejected, 0 skipped)", result.output)
+        self.assertIn("rows/s", result.output)
+
+    def test_import_resumes_after_failure(self):
+
+        path = self.write("actors.csv", "name,age,gender\n" + "".join(
+            f"Actor {i},{20 + i},Male\n" for i in range(30)
+        ))
+        with self.app.app_context():
+            # the third chunk fails
+            load_rows = transfer.load_rows
+            calls = []
+
+            def failing(model, records):
+                calls.append(len(records))
+                if len(calls) == 3:
+                    raise exc.OperationalError("INSERT", {}, Exception("disk full"))
+                return load_rows(model, records)
+
+            with mock.patch("casting.transfer.load_rows", failing):
+                with self.assertRaises(exc.OperationalError):
+                    transfer.import_file(Actors, path, chunk_size=10)
+            self.assertEqual(db.session.get(ImportCheckpoints, "actors:" + path).rows, 20)
+
+            report = transfer.import_file(Actors, path, chunk_size=10, resume=True)
+
+        self.assertEqual((report["skipped"], report["loaded"]), (20, 10))
+        self.assertEqual(self.names(), [f"Actor {i}" for i in range(30)])
+
+    def test_import_rejects_malformed_ndjson_lines(self):
+
+        path = self.write("actors.ndjson", '{"name": "Kim Hunter", "age": 79, "gender": "Female"}\n'
+                                          '{"name": "Maurice Evans", "age": \n'
+                                          '\n'
+                                          '{"name": "Linda Harrison", "age": 76, "gender": "Female"}\n')
+        with self.app.app_context():
+            report = transfer.import_file(Actors, path, chunk_size=2)
+            checkpoint = db.session.get(ImportCheckpoints, "actors:" + path).rows
+
+        self.assertEqual((report["loaded"], report["rejected"]), (2, 1))
+        self.assertEqual(report["errors"][0]["row"], 2)
+        self.assertTrue(report["errors"][0]["errors"][0].startswith("line 2 is not valid JSON"))
+        self.assertEqual(checkpoint, 3)
+        self.assertEqual(self.names(), ["Kim Hunter", "Linda Harrison"])
+
+    def test_import_rejects_duplicates(self):
+
+        path = self.write("actors.csv", "name,age,gender\n" + "".join(
+            f"Actor {i},{20 + i},Male\n" for i in range(3)
+        ) + "Actor 0,50,Male\n")
+        with self.app.app_context():
+            report = transfer.import_file(Actors, path, chunk_size=2)
+            again = transfer.import_file(Actors, path, chunk_size=2)
+
+        self.assertEqual((report["loaded"], report["rejected"]), (3, 1))
+        self.assertEqual(report["errors"], [{"row": 4, "errors": ["duplicate name"]}])
+        self.assertEqual((again["loaded"], again["rejected"]), (0, 4))
+        self.assertEqual([error["row"] for error in again["errors"]], [1, 2, 3, 4])
+        self.assertEqual(self.names(), [f"Actor {i}" for i in range(3)])
+
+class SeedTestCase(LocalAuthTestCase):
+
+    def rows(self, model):
+        with self.app.app_context():
+            columns = [getattr(model, name) for name in model.READ_COLUMNS[1:]]
+            return [tuple(row) for row in db.session.execute(select(*columns).order_by(model.id))][1:]
+
+    def test_seed_command(self):
+
+        result = self.app.test_cli_runner().invoke(args=["seed", "--actors", "50", "--movies", "20"])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Seeded 50 actors in", result.output)
+        self.assertIn("Seeded 20 movies in", result.output)
+        actors = self.rows(Actors)
+        self.assertEqual(len(actors), 50)
+        self.assertEqual(len(self.rows(Movies)), 20)
+        self.assertEqual(len({name for name, age, gender in actors}), 50)
+        for name, age, gender in actors:
+            self.assertEqual(Actors.validate({"name": name, "age": age, "gender": gender})[1], [])
+
+    def test_seed_is_deterministic(self):
+
+        with self.app.app_context():
+            seed.seed_table(Movies, 25, chunk_size=7)
+            seed.seed_table(Movies, 15, chunk_size=100)
+        first = self.rows(Movies)
+        with self.app.app_context():
+            db_drop_and_create_all()
+            seed.seed_table(Movies, 40, chunk_size=40)
+
+        self.assertEqual(self.rows(Movies), first)
+        self.assertEqual(len(set(first)), 40)
+        self.assertEqual(first[:25], [tuple(row.values()) for row in seed.generate_rows(Movies, 1, 25)])
+
+    def test_seed_continues_after_deletes(self):
+
+        with self.app.app_context():
+            seed.seed_table(Actors, 10)
+            Actors.query.filter(Actors.id.in_([3, 4])).delete(synchronize_session=False)
+            db.session.commit()
+            report = seed.seed_table(Actors, 5)
+
+        names = [name for name, age, gender in self.rows(Actors)]
+        self.assertEqual(report["rows"], 5)
+        self.assertEqual(len(names), 13)
+        self.assertEqual(len(set(names)), 13)
+
+    def test_seed_distribution(self):
+
+        rows = list(seed.generate_rows(Actors, 0, 5000, seed=7))
+
+        self.assertNotEqual(rows, list(seed.generate_rows(Actors, 0, 5000)))
+        genders = {gender: sum(row["gender"] == gender for row in rows) for gender in seed.GENDERS}
+        self.assertGreater(genders["Female"], 2000)
+        self.assertGreater(genders["Male"], 2000)
+        self.assertGreater(genders["Non-binary"], 50)
+        ages = sorted(row["age"] for row in rows)
+        self.assertTrue(20 <= ages[len(ages) // 2] <= 60)
+        self.assertGreater(max(len(row["name"]) for row in rows) - min(len(row["name"]) for row in rows), 15)
+
+class UpsertTestCase(LocalAuthTestCase):
+
+    def put(self, path, body, *permissions):
+        res = self.client().put(path, json=body, headers=self.headers(*(permissions or ("post:actors", "patch:actors"))))
+        return res, json.loads(res.data)
+
+    def test_upsert_actors(self):
+
+        roster = [
+            {"name": "Charlton Heston", "age": 84, "gender": "Male"},
+            {"name": "Kim Hunter", "age": 79, "gender": "Female"},
+            {"name": "Roddy McDowall", "age": 70, "gender": "Male"},
+        ]
+        res, data = self.put("/actors", roster)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual((data["inserted"], data["updated"], data["unchanged"]), (2, 0, 1))
+
+        roster[1]["age"] = 80
+        version = self.version("actors")
+        res, data = self.put("/actors", roster)
+
+        self.assertEqual((data["inserted"], data["updated"], data["unchanged"]), (0, 1, 2))
+        self.assertEqual(self.version("actors"), version + 1)
+        res = self.client().get("/actors?name=Kim", headers=self.headers("get:actors"))
+        self.assertEqual(json.loads(res.data)["actors"][0]["age"], 80)
+
+        version = self.version("actors")
+        res, data = self.put("/actors", roster)
+
+        self.assertEqual((data["inserted"], data["updated"], data["unchanged"]), (0, 0, 3))
+        self.assertEqual(self.version("actors"), version)
+
+    def version(self, name):
+        with self.app.app_context():
+            return db.session.get(TableVersions, name).version
+
+    def test_upsert_movies_keyed_on_title_and_release_date(self):
+
+        res, data = self.put("/movies", [
+            {"title": " Planet of the Apes", "release_date": 1968},
+            {"title": " Planet of the Apes", "release_date": 2001},
+            {"title": "Beneath the Planet of the Apes", "release_date": 1970},
+            {"title": "Beneath the Planet of the Apes", "release_date": 1970},
+            {"title": "Escape", "release_date": "1971"},
+        ], "post:movies", "patch:movies")
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual((data["inserted"], data["updated"], data["unchanged"]), (2, 0, 1))
+        self.assertEqual(data["errors"], [
+            {"index": 3, "errors": ["duplicate of record 2"]},
+            {"index": 4, "errors": ["release_date must be an integer"]},
+        ])
+        with self.app.app_context():
+            self.assertEqual(Movies.query.count(), 3)
+
+    def test_upsert_needs_post_and_patch(self):
+
+        res, data = self.put("/actors", [{"name": "Kim Hunter", "age": 79, "gender": "Female"}], "post:actors")
+        self.assertEqual(res.status_code, 403)
+        res, data = self.put("/actors", [{"name": "Kim Hunter", "age": 79, "gender": "Female"}], "patch:actors")
+        self.assertEqual(res.status_code, 403)
+        with self.app.app_context():
+            self.assertEqual(Actors.query.count(), 1)
+
+class BenchmarkSuiteTestCase(unittest.TestCase):
+
+    def test_suite_covers_every_route(self):
+
+        with mock.patch.object(auth, 'AUTH0_DOMAIN', auth.AUTH0_DOMAIN), \
+                mock.patch.object(auth, 'API_AUDIENCE', auth.API_AUDIENCE), \
+                mock.patch.object(auth, 'jwks_store', auth.jwks_store), \
+                mock.patch.object(auth, 'token_cache', auth.token_cache), \
+                mock.patch.dict(os.environ):
+            document = suite.run([20], repeat=2, warmup=1)
+
+        results = document["results"]
+        self.assertEqual(document["meta"]["rows"], [20])
+        self.assertIn("auth.verify_decode_jwt", results)
+        self.assertIn("models.actors_query_all_read@20", results)
+        for endpoint in suite.ROUTES:
+            self.assertGreater(results[f"routes.{endpoint}@20"]["median_ms"], 0)
+
+    def test_compare_reports_regressions_above_threshold(self):
+
+        baseline = {"results": {"a": {"median_ms": 1.0}, "b": {"median_ms": 2.0}, "c": {"median_ms": 1.0}}}
+        current = {"results": {"a": {"median_ms": 1.15}, "b": {"median_ms": 3.0}, "d": {"median_ms": 9.0}}}
+
+        self.assertEqual(suite.compare(baseline, current, 0.2), [
+            {"name": "b", "baseline_ms": 2.0, "current_ms": 3.0, "ratio": 1.5}
+        ])
+        self.assertEqual(suite.compare(baseline, current, 0.1)[0]["name"], "a")
+
+class LoadGeneratorTestCase(unittest.TestCase):
+
+    def step(self, concurrency, rate, errors=0.0):
+        return {"concurrency": concurrency, "requests_per_second": rate, "p99_ms": concurrency * 10.0, "error_rate": errors}
+
+    def test_saturation_point(self):
+
+        steps = [self.step(1, 100), self.step(2, 190), self.step(4, 300), self.step(8, 310), self.step(16, 320)]
+        self.assertEqual(load.saturation(steps), {"concurrency": 4, "requests_per_second": 300, "p99_ms": 40.0})
+
+        # errors cap the load the server is considered to handle
+        steps[2]["error_rate"] = 0.05
+        self.assertEqual(load.saturation(steps)["concurrency"], 2)
+        self.assertIsNone(load.saturation([self.step(1, 100, 0.5)]))
+
+        results = [
+            {"server": "1x1", "saturation": {"concurrency": 2, "requests_per_second": 150, "p99_ms": 9}},
+            {"server": "2x4", "saturation": {"concurrency": 8, "requests_per_second": 400, "p99_ms": 30}},
+            {"server": "4x1", "saturation": None},
+        ]
+        self.assertEqual(load.recommend(results)["server"], "2x4")
+
+    def test_percentiles_and_arguments(self):
+
+        values = list(range(1, 101))
+        self.assertEqual([load.percentile(values, p) for p in (0.5, 0.95, 0.99)], [50, 95, 99])
+        self.assertIsNone(load.percentile([], 0.5))
+        self.assertEqual(load.parse_server("2x4"), (2, 4))
+        self.assertEqual(load.parse_server("3"), (3, 1))
+        self.assertEqual(load.parse_mix("get_actors=3,delete_movie"), {"get_actors": 3.0, "delete_movie": 1.0})
+        with self.assertRaises(argparse.ArgumentTypeError):
+            load.parse_mix("get_everything=1")
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()